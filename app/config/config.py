@@ -1,6 +1,7 @@
 """ App settings """
 
 import os
+import secrets
 
 
 class Settings:
@@ -8,12 +9,139 @@ class Settings:
     POSTGRES_USER: str = os.environ.get('POSTGRES_USER')
     POSTGRES_PASSWORD: str = os.environ.get('POSTGRES_PASSWORD')
     POSTGRES_DB: str = os.environ.get('POSTGRES_DB')
-    POSTGRES_PORT: int = os.environ.get('POSTGRES_PORT')
+    POSTGRES_PORT: int = int(os.environ.get('POSTGRES_PORT', 5432))
     POSTGRES_HOST: str = os.environ.get('POSTGRES_HOST')
-    POSTGRES_MAX_CONNECTIONS: int = os.environ.get('POSTGRES_MAX_CONNECTIONS')
-    POSTGRES_MIN_CONNECTIONS: int = os.environ.get('POSTGRES_MIN_CONNECTIONS')
+    POSTGRES_MAX_CONNECTIONS: int = int(os.environ.get('POSTGRES_MAX_CONNECTIONS', 20))
+    POSTGRES_MIN_CONNECTIONS: int = int(os.environ.get('POSTGRES_MIN_CONNECTIONS', 1))
+    POSTGRES_ACQUIRE_TIMEOUT_SECS: float = float(os.environ.get('POSTGRES_ACQUIRE_TIMEOUT_SECS', 5))
+    POSTGRES_HEALTH_CHECK_TIMEOUT_SECS: float = float(
+        os.environ.get('POSTGRES_HEALTH_CHECK_TIMEOUT_SECS', 2))
+    # Idle connections above the minimum are closed after this delay
+    POSTGRES_MAX_IDLE_SECS: float = float(os.environ.get('POSTGRES_MAX_IDLE_SECS', 300))
+    POSTGRES_CONNECT_RETRY_SECS: float = float(os.environ.get('POSTGRES_CONNECT_RETRY_SECS', 2))
+    # Request deadlines, from the header capped by REQUEST_MAX_TIMEOUT_SECS or the default
+    # of the longest matching "METHOD /path/prefix=secs" entry of REQUEST_ROUTE_TIMEOUTS.
+    # REQUEST_MAX_TIMEOUT_SECS is also the statement_timeout of the connections.
+    REQUEST_TIMEOUT_HEADER: str = os.environ.get('REQUEST_TIMEOUT_HEADER', 'X-Request-Timeout')
+    REQUEST_TIMEOUT_SECS: float = float(os.environ.get('REQUEST_TIMEOUT_SECS', 30))
+    REQUEST_MAX_TIMEOUT_SECS: float = float(os.environ.get('REQUEST_MAX_TIMEOUT_SECS', 600))
+    REQUEST_ROUTE_TIMEOUTS: dict = {
+        route.strip(): float(secs) for route, _, secs in (
+            entry.rpartition('=') for entry in os.environ.get(
+                'REQUEST_ROUTE_TIMEOUTS', 'POST /users/bulk=600,GET /users=600').split(','))
+        if route.strip()}
+
+    # Admission control of the primary checkouts: the concurrency limit shrinks when queries
+    # get LATENCY_TOLERANCE times slower than usual, and at most MAX_QUEUE checkouts wait
+    ADMISSION_ENABLED: bool = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+    ADMISSION_MIN_LIMIT: int = int(os.environ.get('ADMISSION_MIN_LIMIT', 2))
+    ADMISSION_MAX_QUEUE: int = int(os.environ.get('ADMISSION_MAX_QUEUE', 100))
+    ADMISSION_LATENCY_TOLERANCE: float = float(os.environ.get('ADMISSION_LATENCY_TOLERANCE', 2))
+    # Optional read replicas, comma separated "host" or "host:port".
+    # POSTGRES_REPLICA_BALANCING is "round_robin" or "least_busy".
+    POSTGRES_REPLICA_HOSTS: list = [host.strip() for host in
+                                    os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',')
+                                    if host.strip()]
+    POSTGRES_REPLICA_BALANCING: str = os.environ.get('POSTGRES_REPLICA_BALANCING', 'round_robin')
+    POSTGRES_REPLICA_MAX_CONNECTIONS: int = int(
+        os.environ.get('POSTGRES_REPLICA_MAX_CONNECTIONS', POSTGRES_MAX_CONNECTIONS))
+    # Reads of a user go to the primary for this long after a write by this worker, and the
+    # reads of a client for this long after its write through any worker, told by a cookie
+    # signed with READ_YOUR_WRITES_SECRET. Set the secret when several servers share the load.
+    READ_YOUR_WRITES_SECS: float = float(os.environ.get('READ_YOUR_WRITES_SECS', 5))
+    READ_YOUR_WRITES_COOKIE: str = os.environ.get('READ_YOUR_WRITES_COOKIE', 'last_write')
+    READ_YOUR_WRITES_SECRET: str = (os.environ.get('READ_YOUR_WRITES_SECRET')
+                                    or secrets.token_hex(32))
+    # A replica that failed a checkout gets no reads for this long
+    POSTGRES_REPLICA_RETRY_SECS: float = float(os.environ.get('POSTGRES_REPLICA_RETRY_SECS', 30))
 
     CODE_VALIDITY_PERIOD_SECS: int = 60
 
+    # Retry-After sent with 503 responses when the server is busy
+    RETRY_AFTER_SECS: int = int(os.environ.get('RETRY_AFTER_SECS', 1))
+
+    # "thread" or "process", bcrypt releases the GIL so threads use every core
+    HASHING_EXECUTOR: str = os.environ.get('HASHING_EXECUTOR', 'thread')
+    HASHING_WORKERS: int = int(os.environ.get('HASHING_WORKERS', os.cpu_count() or 1))
+    # Jobs allowed to wait for a worker before answering 503
+    HASHING_MAX_QUEUE: int = int(os.environ.get('HASHING_MAX_QUEUE', 64))
+
+    # bcrypt cost of new hashes, older hashes are replaced on login.
+    # python -m benchmarks.bcrypt_cost suggests one for a target time.
+    BCRYPT_ROUNDS: int = int(os.environ.get('BCRYPT_ROUNDS', 12))
+    BCRYPT_REHASH_ON_LOGIN: bool = os.environ.get('BCRYPT_REHASH_ON_LOGIN', 'true').lower() == 'true'
+
+    # Bulk user creation
+    BULK_BATCH_SIZE: int = int(os.environ.get('BULK_BATCH_SIZE', 500))
+    BULK_MAX_ITEM_BYTES: int = int(os.environ.get('BULK_MAX_ITEM_BYTES', 64 * 1024))
+    # Hashing jobs a bulk request may keep in the pool, half of the workers by default
+    BULK_HASHING_CONCURRENCY: int = int(os.environ.get('BULK_HASHING_CONCURRENCY',
+                                                       max(1, HASHING_WORKERS // 2)))
+
+    # User listing, disabled until an admin key is set
+    ADMIN_API_KEY: str = os.environ.get('ADMIN_API_KEY')
+    LIST_DEFAULT_LIMIT: int = int(os.environ.get('LIST_DEFAULT_LIMIT', 1000))
+    LIST_MAX_LIMIT: int = int(os.environ.get('LIST_MAX_LIMIT', 100000))
+    # Rows fetched from the server side cursor at once
+    LIST_PREFETCH: int = int(os.environ.get('LIST_PREFETCH', 500))
+
+    # Activation mails, MAIL_TRANSPORT is "log", "file" or "smtp"
+    MAIL_TRANSPORT: str = os.environ.get('MAIL_TRANSPORT', 'log')
+    MAIL_FILE_PATH: str = os.environ.get('MAIL_FILE_PATH', 'mails.jsonl')
+    MAIL_FROM: str = os.environ.get('MAIL_FROM', 'no-reply@example.com')
+    SMTP_HOST: str = os.environ.get('SMTP_HOST', 'localhost')
+    SMTP_PORT: int = int(os.environ.get('SMTP_PORT', 25))
+    SMTP_TIMEOUT_SECS: float = float(os.environ.get('SMTP_TIMEOUT_SECS', 10))
+    OUTBOX_BATCH_SIZE: int = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+    OUTBOX_CONCURRENCY: int = int(os.environ.get('OUTBOX_CONCURRENCY', 10))
+    OUTBOX_POLL_SECS: float = float(os.environ.get('OUTBOX_POLL_SECS', 1))
+    OUTBOX_SEND_TIMEOUT_SECS: float = float(os.environ.get('OUTBOX_SEND_TIMEOUT_SECS', 30))
+    # Messages of a worker that died are sent again after the lease
+    OUTBOX_LEASE_SECS: float = float(os.environ.get('OUTBOX_LEASE_SECS', 120))
+    OUTBOX_MAX_ATTEMPTS: int = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+    OUTBOX_BACKOFF_BASE_SECS: float = float(os.environ.get('OUTBOX_BACKOFF_BASE_SECS', 2))
+    OUTBOX_BACKOFF_MAX_SECS: float = float(os.environ.get('OUTBOX_BACKOFF_MAX_SECS', 300))
+
+    # Deletion of the users not activated RETENTION seconds after their creation,
+    # paused while more than PURGE_MAX_POOL_USAGE of the connections are in use
+    PURGE_ENABLED: bool = os.environ.get('PURGE_ENABLED', 'true').lower() == 'true'
+    PURGE_RETENTION_SECS: float = float(os.environ.get('PURGE_RETENTION_SECS', 86400))
+    PURGE_BATCH_SIZE: int = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+    PURGE_INTERVAL_SECS: float = float(os.environ.get('PURGE_INTERVAL_SECS', 300))
+    PURGE_BATCH_PAUSE_SECS: float = float(os.environ.get('PURGE_BATCH_PAUSE_SECS', 0.5))
+    PURGE_MAX_POOL_USAGE: float = float(os.environ.get('PURGE_MAX_POOL_USAGE', 0.5))
+
+    # Rate limits of the routes checking credentials, per worker
+    RATE_LIMIT_ENABLED: bool = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_IP_PER_SEC: float = float(os.environ.get('RATE_LIMIT_IP_PER_SEC', 20))
+    RATE_LIMIT_IP_BURST: float = float(os.environ.get('RATE_LIMIT_IP_BURST', 40))
+    RATE_LIMIT_EMAIL_PER_SEC: float = float(os.environ.get('RATE_LIMIT_EMAIL_PER_SEC', 5))
+    RATE_LIMIT_EMAIL_BURST: float = float(os.environ.get('RATE_LIMIT_EMAIL_BURST', 10))
+    RATE_LIMIT_ACTIVATION_PER_MIN: float = float(os.environ.get('RATE_LIMIT_ACTIVATION_PER_MIN', 10))
+    RATE_LIMIT_ACTIVATION_BURST: float = float(os.environ.get('RATE_LIMIT_ACTIVATION_BURST', 5))
+    RATE_LIMIT_MAX_KEYS: int = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+
+    # Verified credentials cache, a max size of 0 disables it.
+    # Other workers may serve a stale is_activated for up to the TTL.
+    CREDENTIALS_CACHE_TTL_SECS: int = int(os.environ.get('CREDENTIALS_CACHE_TTL_SECS', 60))
+    CREDENTIALS_CACHE_MAX_BYTES: int = int(os.environ.get('CREDENTIALS_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+
+    # Rendered GET /user/{id} responses, a max of 0 entries disables the cache
+    USER_RESPONSE_CACHE_TTL_SECS: float = float(os.environ.get('USER_RESPONSE_CACHE_TTL_SECS', 5))
+    USER_RESPONSE_CACHE_MAX_ENTRIES: int = int(
+        os.environ.get('USER_RESPONSE_CACHE_MAX_ENTRIES', 10000))
+
+    # Logging, "text" or "json" lines. When the queue is full records are dropped,
+    # or with the "block" policy the caller waits.
+    LOG_LEVEL: str = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    LOG_FORMAT: str = os.environ.get('LOG_FORMAT', 'text')
+    LOG_QUEUE_SIZE: int = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+    LOG_QUEUE_POLICY: str = os.environ.get('LOG_QUEUE_POLICY', 'drop')
+
+    # Shared directory for the metrics of every worker, unset with a single worker
+    METRICS_DIR: str = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_SECS: float = float(os.environ.get('METRICS_FLUSH_SECS', 5))
+    EVENT_LOOP_LAG_INTERVAL_SECS: float = float(os.environ.get('EVENT_LOOP_LAG_INTERVAL_SECS', 0.5))
+
     TESTING: bool = os.environ.get('TEST')
     TESTING_DB: str = os.environ.get('TESTING_DB')
@@ -0,0 +1,124 @@
+""" Admission control of the checkouts of the primary pool
+
+Checkouts above the concurrency limit wait in a bounded FIFO queue until their
+deadline. The limit adapts to the query latencies, each compared to the long
+term average of the same query: it grows by one per window of queries while
+they stay close to their average, and shrinks by DECREASE_FACTOR when they slow
+down. A checkout that would wait longer than its deadline is refused at once.
+"""
+import asyncio
+from collections import deque
+
+DECREASE_FACTOR: float = 0.9
+# Weight of a new latency in the long term average of its query
+BASELINE_WEIGHT: float = 0.01
+MIN_WINDOW: int = 10
+
+
+class AdmissionRejectedError(Exception):
+    """ Raised when a checkout is shed or waits past its deadline """
+
+
+class AdaptiveLimiter:
+    """ AIMD concurrency limit with a FIFO queue of checkouts """
+    def __init__(self, max_limit: int, min_limit: int, max_queue: int, tolerance: float):
+        self.max_limit = max_limit
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.max_queue = max_queue
+        self.tolerance = tolerance
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._waiters = deque()
+        self._baselines = {}
+        self._window_sum = 0.0
+        self._window_count = 0
+        # Average time a slot is held, to estimate the wait of a new checkout
+        self.hold_secs = 0.0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    @property
+    def queue_length(self):
+        """ Checkouts waiting for a slot """
+        return len(self._waiters)
+
+    def _capacity(self):
+        """ Slots allowed by the current limit """
+        return max(self.min_limit, int(self.limit))
+
+    def expected_wait(self):
+        """ Seconds a new checkout would wait behind the queue """
+        return (len(self._waiters) + 1) * self.hold_secs / self._capacity()
+
+    async def acquire(self, timeout: float):
+        """ Take a slot, waiting at most timeout seconds """
+        if self.in_flight < self._capacity() and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue or self.expected_wait() > timeout:
+            self.shed += 1
+            raise AdmissionRejectedError(
+                f"{len(self._waiters)} database checkouts already waiting")
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as error:
+            self._discard(future)
+            self.timed_out += 1
+            raise AdmissionRejectedError(f"No database slot after {timeout}s") from error
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted as the caller went away
+                self.release()
+            else:
+                self._discard(future)
+            raise
+        self.admitted += 1
+
+    def release(self, hold_secs: float = None):
+        """ Give a slot back, with the time it was held """
+        self.in_flight -= 1
+        if hold_secs is not None:
+            self.hold_secs = hold_secs if self.hold_secs == 0.0 else (
+                0.9 * self.hold_secs + 0.1 * hold_secs)
+        self._wake()
+
+    def observe(self, name: str, latency: float):
+        """ Adapt the limit to a query latency, once per window of queries """
+        baseline = self._baselines.get(name)
+        if baseline is None or baseline <= 0.0:
+            baseline = latency
+        self._baselines[name] = (1 - BASELINE_WEIGHT) * baseline + BASELINE_WEIGHT * latency
+        self._window_sum += latency / baseline if baseline > 0.0 else 1.0
+        self._window_count += 1
+        if self._window_count < max(MIN_WINDOW, self._capacity()):
+            return
+        average = self._window_sum / self._window_count
+        self._window_sum = 0.0
+        self._window_count = 0
+        if average > self.tolerance:
+            self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+            self._wake()
+
+    def _discard(self, future):
+        """ Remove a waiter that gave up """
+        try:
+            self._waiters.remove(future)
+        except ValueError:
+            pass
+
+    def _wake(self):
+        """ Hand the free slots to the oldest waiters """
+        while self._waiters and self.in_flight < self._capacity():
+            future = self._waiters.popleft()
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
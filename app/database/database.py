@@ -1,47 +1,337 @@
 """ Database related functions """
-import psycopg2
-from psycopg2 import pool
+import asyncio
+import time
+import asyncpg
 from ..config.config import Settings
+from ..internal.deadline import DeadlineExceededError, remaining as deadline_remaining
 from ..internal.log_config import logger
+from ..internal.metrics import DB_READS, POOL_ACQUIRE_TIMEOUTS, POOL_ACQUIRE_WAIT, metrics
+from .admission import AdaptiveLimiter, AdmissionRejectedError
+from .migrations import migrate
+from .queries import RegistryConnection, registry
+from .replicas import RecentWrites, ReplicaBalancer, parse_hosts
 
 
-def init_tables(conn):
-    """ Init tables if they do not exist """
-    try:
-        with conn.cursor() as curs:
-            logger.info("Initializing tables")
-            curs.execute("""
-                CREATE TABLE IF NOT EXISTS public.users
-                (id serial PRIMARY KEY, email varchar(50) NOT NULL, password varchar(100) NOT NULL,
-                code varchar(4) NOT NULL, is_activated boolean DEFAULT false NOT NULL, created_at timestamp DEFAULT now() NOT NULL,
-                UNIQUE(email),
-                CONSTRAINT correct_email CHECK (email ~* '^[A-Za-z0-9._+%-]+@[A-Za-z0-9.-]+[.][A-Za-z]+$'),
-                CONSTRAINT email_min_size_check CHECK (char_length(email) > 6),
-                CONSTRAINT code_size_check CHECK (char_length(code) = 4))
-            """)
-            curs.execute("CREATE INDEX IF NOT EXISTS id_idx ON public.users (id)")
-            curs.execute("CREATE INDEX IF NOT EXISTS email_idx ON public.users (email)")
-        conn.commit()
-    except (psycopg2.DatabaseError) as error:
-        logger.error(error)
-
-try:
-    postgresql_db = Settings.POSTGRES_DB
-    if Settings.TESTING:
-        postgresql_db = Settings.TESTING_DB
-    logger.info("Connecting to database")
-    postgreSQL_pool = pool.SimpleConnectionPool(
-        Settings.POSTGRES_MIN_CONNECTIONS,
-        Settings.POSTGRES_MAX_CONNECTIONS,
-        database = postgresql_db,
-        user = Settings.POSTGRES_USER,
-        host = Settings.POSTGRES_HOST,
-        password = Settings.POSTGRES_PASSWORD,
-        port = Settings.POSTGRES_PORT
-    )
-    # Init tables if not created
-    init_tables(postgreSQL_pool.getconn())
-except (psycopg2.DatabaseError) as connect_error:
-    logger.error(connect_error)
-finally:
-    logger.info("Connected to database")
+class PoolTimeoutError(Exception):
+    """ Raised when no connection could be acquired in time """
+
+
+class _Acquire:
+    """ Async context manager returning a pooled connection, of a replica if one is given
+
+    Checkouts of the primary first take a slot of the admission control. A wait cut
+    short by the deadline of the request ends in a DeadlineExceededError, any other
+    in a PoolTimeoutError.
+    """
+    def __init__(self, database, timeout, replica=None):
+        self.database = database
+        self.timeout = timeout
+        self.replica = replica
+        self.pool = None
+        self.conn = None
+        self.admission = None
+        self.acquired_at = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        # A request never waits for a connection past its deadline
+        left = deadline_remaining()
+        capped = left is not None and left < self.timeout
+        if capped:
+            self.timeout = left
+        try:
+            if not self.database.is_ready():
+                await self.database.wait_ready(self.timeout)
+            if self.replica is None and self.database.admission is not None:
+                remaining = max(0.001, self.timeout - (time.perf_counter() - start))
+                await self.database.admission.acquire(remaining)
+                self.admission = self.database.admission
+            remaining = max(0.001, self.timeout - (time.perf_counter() - start))
+            self.pool = self.replica or self.database.pool
+            try:
+                self.conn = await self.pool.acquire(timeout=remaining)
+            except asyncio.TimeoutError:
+                # No time left to read from the primary, the next reads avoid the replica
+                # whether it is busy or silently unreachable
+                if self.replica is not None:
+                    logger.warning("Replica checkout timed out, leaving it out for a while")
+                    self.database.balancer.mark_failed(self.replica)
+                raise
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as error:
+                if self.replica is None:
+                    raise
+                logger.warning("Replica unavailable, reading from the primary: %s", error)
+                self.database.balancer.mark_failed(self.replica)
+                DB_READS.inc(labels=("fallback",))
+                remaining = max(0.001, self.timeout - (time.perf_counter() - start))
+                self.pool = self.database.pool
+                self.conn = await self.pool.acquire(timeout=remaining)
+        except BaseException as error:
+            if self.admission is not None:
+                self.admission.release()
+                self.admission = None
+            if isinstance(error, asyncio.TimeoutError):
+                POOL_ACQUIRE_TIMEOUTS.inc()
+            # The deadline cut the wait short, a 504 and not an exhausted pool. A checkout
+            # shed by the admission control without waiting stays a 503.
+            waited = isinstance(error, asyncio.TimeoutError) or isinstance(
+                error.__cause__, asyncio.TimeoutError)
+            if capped and waited and isinstance(error, (asyncio.TimeoutError,
+                                                        AdmissionRejectedError)):
+                raise DeadlineExceededError(
+                    "No connection available before the deadline of the request") from error
+            if isinstance(error, asyncio.TimeoutError):
+                raise PoolTimeoutError(
+                    f"No connection available after {self.timeout}s") from error
+            if isinstance(error, AdmissionRejectedError):
+                # Answered like an exhausted pool, a 503 for requests
+                raise PoolTimeoutError(str(error)) from error
+            raise
+        finally:
+            POOL_ACQUIRE_WAIT.observe(time.perf_counter() - start)
+        self.acquired_at = time.perf_counter()
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        try:
+            await self.pool.release(self.conn)
+        finally:
+            if self.admission is not None:
+                self.admission.release(time.perf_counter() - self.acquired_at)
+
+
+class Database:
+    """ asyncpg connection pool opened and closed by the app lifespan
+
+    The pool is opened in the background so the worker starts serving at once,
+    requests wait for it up to POSTGRES_ACQUIRE_TIMEOUT_SECS.
+    """
+    def __init__(self):
+        self.pool = None
+        self.replicas = []
+        self.balancer = None
+        self.recent_writes = RecentWrites(Settings.READ_YOUR_WRITES_SECS)
+        self.admission = None
+        if Settings.ADMISSION_ENABLED:
+            self.admission = AdaptiveLimiter(Settings.POSTGRES_MAX_CONNECTIONS,
+                                             Settings.ADMISSION_MIN_LIMIT,
+                                             Settings.ADMISSION_MAX_QUEUE,
+                                             Settings.ADMISSION_LATENCY_TOLERANCE)
+            registry.latency_observer = self.admission.observe
+        self._ready = None
+        self._task = None
+
+    def start(self):
+        """ Open the pool, set up the schema and warm up the connections in the background """
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._initialize())
+
+    async def _initialize(self):
+        """ Retry until the database is reachable """
+        while True:
+            try:
+                await self.connect()
+                async with self.pool.acquire() as conn:
+                    await migrate(conn)
+                await self.warm_up(self.pool)
+                await self.connect_replicas()
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError,
+                    asyncio.TimeoutError) as error:
+                logger.error("Database initialization failed: %s", error)
+                if self.pool is not None:
+                    self.pool.terminate()
+                    self.pool = None
+                await asyncio.sleep(Settings.POSTGRES_CONNECT_RETRY_SECS)
+                continue
+            self._ready.set()
+            logger.info("Database ready")
+            return
+
+    def is_ready(self):
+        """ True once the pool is open and the schema set up """
+        return self._ready is not None and self._ready.is_set()
+
+    async def wait_ready(self, timeout: float = None):
+        """ Wait for the initialization, raise PoolTimeoutError after timeout seconds """
+        if self._ready is None:
+            raise PoolTimeoutError("The database is not started")
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError as error:
+            raise PoolTimeoutError(f"The database is not ready after {timeout}s") from error
+
+    async def warm_up(self, pool):
+        """ Prepare every registered statement on the connections opened with a pool """
+        conns = [await pool.acquire() for _ in range(Settings.POSTGRES_MIN_CONNECTIONS)]
+        try:
+            for conn in conns:
+                await registry.prepare_all(conn)
+        finally:
+            for conn in conns:
+                await pool.release(conn)
+
+    @staticmethod
+    def _database_name():
+        """ Database of the app, the test one when testing """
+        if Settings.TESTING:
+            return Settings.TESTING_DB
+        return Settings.POSTGRES_DB
+
+    @staticmethod
+    async def _create_pool(host: str, port: int, max_size: int):
+        """ Pool of connections to a server """
+        return await asyncpg.create_pool(
+            min_size=min(Settings.POSTGRES_MIN_CONNECTIONS, max_size),
+            max_size=max_size,
+            max_inactive_connection_lifetime=Settings.POSTGRES_MAX_IDLE_SECS,
+            connection_class=RegistryConnection,
+            # Backstop for the queries of a worker that could not cancel them
+            server_settings={'statement_timeout': str(int(Settings.REQUEST_MAX_TIMEOUT_SECS * 1000))},
+            database=Database._database_name(),
+            user=Settings.POSTGRES_USER,
+            host=host,
+            password=Settings.POSTGRES_PASSWORD,
+            port=port
+        )
+
+    async def migrate_once(self):
+        """ Apply the pending migrations on a connection of its own, before any worker starts """
+        conn = await asyncpg.connect(database=self._database_name(), user=Settings.POSTGRES_USER,
+                                     host=Settings.POSTGRES_HOST,
+                                     password=Settings.POSTGRES_PASSWORD,
+                                     port=Settings.POSTGRES_PORT,
+                                     timeout=Settings.POSTGRES_ACQUIRE_TIMEOUT_SECS)
+        try:
+            return await migrate(conn)
+        finally:
+            await conn.close()
+
+    async def connect(self):
+        """ Open the pool """
+        logger.info("Connecting to database")
+        self.pool = await self._create_pool(Settings.POSTGRES_HOST, Settings.POSTGRES_PORT,
+                                            Settings.POSTGRES_MAX_CONNECTIONS)
+        logger.info("Connected to database")
+
+    async def connect_replicas(self):
+        """ Open a pool per replica, the unreachable ones are left out """
+        for host, port in parse_hosts(Settings.POSTGRES_REPLICA_HOSTS, Settings.POSTGRES_PORT):
+            try:
+                pool = await self._create_pool(host, port,
+                                               Settings.POSTGRES_REPLICA_MAX_CONNECTIONS)
+                await self.warm_up(pool)
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError,
+                    asyncio.TimeoutError) as error:
+                logger.error("Replica %s:%s left out: %s", host, port, error)
+                continue
+            self.replicas.append(pool)
+            logger.info("Connected to replica %s:%s", host, port)
+        if self.replicas:
+            self.balancer = ReplicaBalancer(self.replicas, Settings.POSTGRES_REPLICA_BALANCING,
+                                            Settings.POSTGRES_REPLICA_RETRY_SECS)
+
+    async def close(self):
+        """ Stop the initialization and close the pool """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._ready = None
+        for pool in self.replicas:
+            await pool.close()
+        self.replicas = []
+        self.balancer = None
+        if self.pool is not None:
+            logger.info("Closing connection to database")
+            await self.pool.close()
+            self.pool = None
+            logger.info("Connection to database closed")
+
+    def acquire(self):
+        """ Check out a connection, waiting at most POSTGRES_ACQUIRE_TIMEOUT_SECS """
+        return _Acquire(self, Settings.POSTGRES_ACQUIRE_TIMEOUT_SECS)
+
+    def acquire_read(self, key: str = None, recent_write: bool = False):
+        """ Check out a connection for read-only queries
+
+        It comes from a replica, unless there is no healthy one, the client wrote
+        recently, or key was written by this worker within READ_YOUR_WRITES_SECS.
+        """
+        replica = None
+        if self.balancer is not None and not recent_write and not (
+                key is not None and self.recent_writes.contains(key)):
+            replica = self.balancer.pick()
+        if replica is None:
+            DB_READS.inc(labels=("primary",))
+            return self.acquire()
+        DB_READS.inc(labels=("replica",))
+        return _Acquire(self, Settings.POSTGRES_ACQUIRE_TIMEOUT_SECS, replica)
+
+    def mark_written(self, key: str):
+        """ Send the reads of key to the primary for a while """
+        if self.replicas:
+            self.recent_writes.mark(key)
+
+    async def check_health(self):
+        """ Return True if a connection can be acquired and answers a query """
+        if not self.is_ready():
+            return False
+        try:
+            # Straight from the pool, a probe must not take an admission slot of the requests
+            conn = await self.pool.acquire(timeout=Settings.POSTGRES_HEALTH_CHECK_TIMEOUT_SECS)
+            try:
+                await conn.fetchval("SELECT 1", timeout=Settings.POSTGRES_HEALTH_CHECK_TIMEOUT_SECS)
+            finally:
+                await self.pool.release(conn)
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError,
+                asyncio.TimeoutError, PoolTimeoutError) as error:
+            logger.error(error)
+            return False
+        return True
+
+    def in_use_ratio(self):
+        """ Share of the allowed connections checked out """
+        if self.pool is None:
+            return 0.0
+        return (self.pool.get_size() - self.pool.get_idle_size()) / self.pool.get_max_size()
+
+    def pool_usage(self):
+        """ Connections in use, idle and allowed, for the metrics """
+        if self.pool is None:
+            return []
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return [(("in_use",), size - idle), (("idle",), idle),
+                (("max",), self.pool.get_max_size())]
+
+    def replica_usage(self):
+        """ Connections in use and idle of each replica, for the metrics """
+        samples = []
+        for index, pool in enumerate(self.replicas):
+            idle = pool.get_idle_size()
+            samples.append(((str(index), "in_use"), pool.get_size() - idle))
+            samples.append(((str(index), "idle"), idle))
+        return samples
+
+
+database = Database()
+
+metrics.callback("db_pool_connections", "Connections of the pool by state",
+                 database.pool_usage, ("state",))
+metrics.callback("db_admission_limit", "Adaptive limit of the concurrent primary checkouts",
+                 lambda: [] if database.admission is None else [((), database.admission.limit)])
+metrics.callback("db_admission_queue_length", "Primary checkouts waiting for a slot",
+                 lambda: [] if database.admission is None else [
+                     ((), database.admission.queue_length)])
+metrics.callback("db_admission_checkouts_total", "Primary checkouts by admission result",
+                 lambda: [] if database.admission is None else [
+                     (("admitted",), database.admission.admitted),
+                     (("queued",), database.admission.queued),
+                     (("shed",), database.admission.shed),
+                     (("timed_out",), database.admission.timed_out)],
+                 ("result",), metric_type="counter")
+metrics.callback("db_replica_connections", "Connections of the replica pools by state",
+                 database.replica_usage, ("replica", "state"))
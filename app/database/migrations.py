@@ -0,0 +1,134 @@
+""" Versioned schema migrations
+
+Migrations are applied in order, each in its own transaction together with its
+row in schema_migrations. Statements that cannot run in a transaction, like the
+concurrent index builds, run before it and must be safe to run again after a
+failure. A session advisory lock makes the workers starting together apply them
+once, the others only read the current version.
+"""
+import asyncio
+from ..internal.log_config import logger
+
+# Key of the advisory lock serializing the migrations of the workers
+MIGRATIONS_LOCK_ID = 7_245_019
+# Pause between two tries of the lock
+MIGRATIONS_LOCK_RETRY_SECS = 0.5
+
+
+class Migration:
+    """ Schema change applied once, its statements run in a single transaction """
+    def __init__(self, version: int, name: str, *statements: str, before: tuple = ()):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        # Run one by one outside the transaction, before it
+        self.before = before
+
+
+def cover_users_email(version: int, name: str, *include: str, before: tuple = ()):
+    """ Migration replacing the unique email constraint by one covering the given columns
+
+    The index is built concurrently so the writes go on meanwhile, a build that
+    failed leaves an invalid index dropped by the next attempt. The constraint then
+    takes the index over, renaming it, under a lock held only for the swap.
+    """
+    return Migration(
+        version, name,
+        "ALTER TABLE public.users DROP CONSTRAINT users_email_key, "
+        "ADD CONSTRAINT users_email_key UNIQUE USING INDEX users_email_cover_idx",
+        before=(*before,
+                "DROP INDEX CONCURRENTLY IF EXISTS public.users_email_cover_idx",
+                "CREATE UNIQUE INDEX CONCURRENTLY users_email_cover_idx ON public.users (email) "
+                f"INCLUDE ({', '.join(include)})"))
+
+
+MIGRATIONS = [
+    # Schema of the deployments created before the migrations, every statement is a no-op there
+    Migration(1, "create users and outbox", """
+        CREATE TABLE IF NOT EXISTS public.users
+        (id serial PRIMARY KEY, email varchar(50) NOT NULL, password varchar(100) NOT NULL,
+        code varchar(4) NOT NULL, is_activated boolean DEFAULT false NOT NULL, created_at timestamp DEFAULT now() NOT NULL,
+        UNIQUE(email),
+        CONSTRAINT correct_email CHECK (email ~* '^[A-Za-z0-9._+%-]+@[A-Za-z0-9.-]+[.][A-Za-z]+$'),
+        CONSTRAINT email_min_size_check CHECK (char_length(email) > 6),
+        CONSTRAINT code_size_check CHECK (char_length(code) = 4))
+    """, """
+        CREATE TABLE IF NOT EXISTS public.outbox
+        (id bigserial PRIMARY KEY, idempotency_key varchar(100) NOT NULL UNIQUE,
+        kind varchar(30) NOT NULL,
+        user_id integer NOT NULL REFERENCES public.users (id) ON DELETE CASCADE,
+        recipient varchar(50) NOT NULL, payload jsonb NOT NULL,
+        attempts integer DEFAULT 0 NOT NULL, next_attempt_at timestamp DEFAULT now() NOT NULL,
+        sent_at timestamp, last_error text, created_at timestamp DEFAULT now() NOT NULL)
+    """, """
+        CREATE INDEX IF NOT EXISTS outbox_pending_idx ON public.outbox (next_attempt_at)
+        WHERE sent_at IS NULL
+    """),
+    # Duplicates of the primary key and unique constraint indexes
+    Migration(2, "drop redundant users indexes",
+              "DROP INDEX IF EXISTS public.id_idx",
+              "DROP INDEX IF EXISTS public.email_idx"),
+    # The credentials lookup reads every column it returns from the index
+    cover_users_email(3, "cover the credentials lookup",
+                      "password", "id", "created_at", "is_activated"),
+    # Small index of the users waiting for activation, for the cleanup
+    Migration(4, "index not activated users", """
+        CREATE INDEX IF NOT EXISTS users_not_activated_idx ON public.users (created_at)
+        WHERE NOT is_activated
+    """),
+    # Bumped by every change of the user response, it is part of its ETag. The column
+    # has a constant default, adding it rewrites nothing, and the index needs it first
+    cover_users_email(5, "add users version",
+                      "password", "id", "created_at", "is_activated", "version",
+                      before=("ALTER TABLE public.users ADD COLUMN IF NOT EXISTS "
+                              "version integer DEFAULT 1 NOT NULL",)),
+]
+
+
+async def current_version(conn):
+    """ Version of the last applied migration, 0 on an empty database """
+    if not await conn.fetchval("SELECT to_regclass('public.schema_migrations') IS NOT NULL"):
+        return 0
+    return await conn.fetchval("SELECT coalesce(max(version), 0) FROM public.schema_migrations")
+
+async def lock(conn):
+    """ Wait for the migrations lock between tries
+
+    A session blocked in pg_advisory_lock keeps a snapshot open, which the
+    concurrent index builds of the lock holder wait for: a deadlock.
+    """
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATIONS_LOCK_ID):
+        await asyncio.sleep(MIGRATIONS_LOCK_RETRY_SECS)
+
+async def migrate(conn, migrations=MIGRATIONS):
+    """ Apply the pending migrations and return how many were applied """
+    if await current_version(conn) >= migrations[-1].version:
+        return 0
+    await lock(conn)
+    try:
+        # Migrations may run longer than requests, reset when the connection is released
+        await conn.execute("SET statement_timeout = 0")
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS public.schema_migrations
+            (version integer PRIMARY KEY, name varchar(100) NOT NULL,
+            applied_at timestamp DEFAULT now() NOT NULL)
+        """)
+        # Another worker may have applied them while this one waited for the lock
+        version = await current_version(conn)
+        applied = 0
+        for migration in migrations:
+            if migration.version <= version:
+                continue
+            logger.info("Applying migration %s: %s", migration.version, migration.name)
+            for statement in migration.before:
+                await conn.execute(statement)
+            async with conn.transaction():
+                for statement in migration.statements:
+                    await conn.execute(statement)
+                await conn.execute(
+                    "INSERT INTO public.schema_migrations (version, name) VALUES ($1, $2)",
+                    migration.version, migration.name)
+            applied += 1
+        return applied
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
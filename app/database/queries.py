@@ -0,0 +1,255 @@
+""" Registry of the prepared statements used by the app """
+import asyncio
+import time
+import asyncpg
+from ..internal.deadline import DeadlineExceededError, remaining
+from ..internal.metrics import QUERY_DURATION
+
+
+class RegistryConnection(asyncpg.Connection):
+    """ Connection keeping the statements prepared on it
+
+    A reconnect creates a new connection with an empty registry, so statements
+    are prepared again transparently on their next use.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = {}
+
+
+class Query:
+    """ Handle of a statement, prepared lazily once per connection """
+    def __init__(self, name: str, sql: str, registry=None):
+        self.name = name
+        self.sql = sql
+        self.registry = registry
+        self.calls = 0
+        self.prepares = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+        self.duration = QUERY_DURATION.labels(name)
+
+    async def _statement(self, conn):
+        """ Return the statement prepared on this connection """
+        statement = conn.prepared_statements.get(self.name)
+        if statement is None:
+            statement = await conn.prepare(self.sql)
+            conn.prepared_statements[self.name] = statement
+            self.prepares += 1
+        return statement
+
+    async def prepare(self, conn):
+        """ Prepare the statement on this connection ahead of its first use """
+        await self._statement(conn)
+
+    async def _run(self, conn, method: str, args):
+        """ Run the statement, preparing it again if the server dropped it
+
+        The query is cancelled on the server if it outlives the request deadline.
+        """
+        start = time.perf_counter()
+        timeout = remaining()
+        try:
+            try:
+                statement = await self._statement(conn)
+                return await getattr(statement, method)(*args, timeout=timeout)
+            except (asyncpg.InvalidCachedStatementError,
+                    asyncpg.InvalidSQLStatementNameError):
+                conn.prepared_statements.pop(self.name, None)
+                statement = await self._statement(conn)
+                return await getattr(statement, method)(*args, timeout=remaining())
+        except asyncio.TimeoutError as error:
+            if timeout is None:
+                raise
+            raise DeadlineExceededError(f"Query {self.name} cancelled at the deadline") from error
+        finally:
+            elapsed = time.perf_counter() - start
+            self.duration.observe(elapsed)
+            if self.registry is not None and self.registry.latency_observer is not None:
+                self.registry.latency_observer(self.name, elapsed)
+            self.calls += 1
+            self.total_secs += elapsed
+            if elapsed > self.max_secs:
+                self.max_secs = elapsed
+
+    async def fetchrow(self, conn, *args):
+        """ Run the statement and return the first row """
+        return await self._run(conn, 'fetchrow', args)
+
+    async def fetch(self, conn, *args):
+        """ Run the statement and return every row """
+        return await self._run(conn, 'fetch', args)
+
+    async def cursor(self, conn, *args, prefetch: int):
+        """ Iterate over the rows with a server side cursor, inside a transaction """
+        self.calls += 1
+        statement = await self._statement(conn)
+        async for row in statement.cursor(*args, prefetch=prefetch, timeout=remaining()):
+            yield row
+
+    async def fetchval(self, conn, *args):
+        """ Run the statement and return the first column of the first row """
+        return await self._run(conn, 'fetchval', args)
+
+    def stats(self):
+        """ Timing counters of the statement """
+        return {
+            "calls": self.calls,
+            "prepares": self.prepares,
+            "total_secs": self.total_secs,
+            "max_secs": self.max_secs,
+            "mean_secs": self.total_secs / self.calls if self.calls else 0.0,
+        }
+
+
+class QueryRegistry:
+    """ Central list of the statements of the app """
+    def __init__(self):
+        self.queries = {}
+        # Called with the name and duration of every query, for the admission control
+        self.latency_observer = None
+
+    def register(self, name: str, sql: str):
+        """ Add a statement and return its handle """
+        if name in self.queries:
+            raise ValueError(f"Query {name} is already registered")
+        query = Query(name, sql, self)
+        self.queries[name] = query
+        return query
+
+    async def prepare_all(self, conn):
+        """ Prepare every statement on this connection """
+        for query in self.queries.values():
+            await query.prepare(conn)
+
+    def stats(self):
+        """ Timing counters of every statement """
+        return {name: query.stats() for name, query in self.queries.items()}
+
+
+registry = QueryRegistry()
+
+GET_CREDENTIALS = registry.register("get_credentials", """
+    SELECT id, email, created_at, is_activated, password, version FROM public.users
+    WHERE email = $1
+""")
+
+# The activation mail is queued in the outbox by the same statement
+INSERT_USER = registry.register("insert_user", """
+    WITH new_user AS (
+        INSERT INTO public.users (email, password, code)
+        VALUES ($1, $2, $3)
+        RETURNING id, email, created_at, is_activated, code
+    ), mail AS (
+        INSERT INTO public.outbox (idempotency_key, kind, user_id, recipient, payload)
+        SELECT 'activation-' || id, 'activation', id, email,
+        jsonb_build_object('user_id', id, 'code', code)
+        FROM new_user
+    )
+    SELECT id, email, created_at, is_activated FROM new_user
+""")
+
+# Rows not returned already existed
+INSERT_USERS = registry.register("insert_users", """
+    WITH new_users AS (
+        INSERT INTO public.users (email, password, code)
+        SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::varchar[])
+        ON CONFLICT (email) DO NOTHING
+        RETURNING id, email, code
+    ), mails AS (
+        INSERT INTO public.outbox (idempotency_key, kind, user_id, recipient, payload)
+        SELECT 'activation-' || id, 'activation', id, email,
+        jsonb_build_object('user_id', id, 'code', code)
+        FROM new_users
+    )
+    SELECT id, email FROM new_users
+""")
+
+# Keyset pagination on the primary key, a None filter matches every row
+LIST_USERS = registry.register("list_users", """
+    SELECT id, email, created_at, is_activated FROM public.users
+    WHERE id > $1
+    and ($2::boolean IS NULL or is_activated = $2)
+    and ($3::timestamp IS NULL or created_at >= $3)
+    and ($4::timestamp IS NULL or created_at < $4)
+    ORDER BY id
+    LIMIT $5
+""")
+
+# Only matches a user that can be activated, concurrent calls cannot both succeed
+ACTIVATE_USER = registry.register("activate_user", """
+    UPDATE public.users SET is_activated = true, version = version + 1
+    WHERE id = $1 and email = $2 and code = $3 and NOT is_activated
+    and created_at > now() - make_interval(secs => $4)
+    RETURNING id
+""")
+
+# Only replaces the hash that was checked, a concurrent change wins
+UPDATE_PASSWORD = registry.register("update_password", """
+    UPDATE public.users SET password = $3 WHERE id = $1 and password = $2
+    RETURNING id
+""")
+
+# Explains why ACTIVATE_USER matched nothing, the expiry is what is left
+GET_ACTIVATION = registry.register("get_activation", """
+    SELECT code, is_activated FROM public.users
+    WHERE id = $1 and email = $2
+""")
+
+# Batch of the expired users, SKIP LOCKED leaves the rows of live requests and other workers.
+# Their outbox rows are deleted by the foreign key cascade.
+PURGE_USERS = registry.register("purge_users", """
+    WITH purged AS (
+        DELETE FROM public.users
+        WHERE id IN (
+            SELECT id FROM public.users
+            WHERE NOT is_activated and created_at < now() - make_interval(secs => $1)
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+    )
+    SELECT count(*) FROM purged
+""")
+
+# Lease due messages: a worker that dies leaves them to be retried after the lease.
+# Messages older than $4 are not sent anymore, the code they carry has expired.
+CLAIM_OUTBOX = registry.register("claim_outbox", """
+    UPDATE public.outbox SET attempts = attempts + 1,
+    next_attempt_at = now() + make_interval(secs => $2)
+    WHERE id IN (
+        SELECT id FROM public.outbox
+        WHERE sent_at IS NULL and next_attempt_at <= now() and attempts < $3
+        and created_at > now() - make_interval(secs => $4)
+        ORDER BY next_attempt_at
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, idempotency_key, kind, recipient, payload, attempts
+""")
+
+MARK_OUTBOX_SENT = registry.register("mark_outbox_sent", """
+    UPDATE public.outbox SET sent_at = now(), last_error = NULL WHERE id = any($1::bigint[])
+""")
+
+RETRY_OUTBOX = registry.register("retry_outbox", """
+    UPDATE public.outbox SET next_attempt_at = now() + make_interval(secs => $2), last_error = $3
+    WHERE id = $1
+""")
+
+# Batch of the messages past their age limit, sent or not they will never be sent again.
+# A message still leased may be in delivery, it is left to a later purge.
+PURGE_OUTBOX = registry.register("purge_outbox", """
+    WITH purged AS (
+        DELETE FROM public.outbox
+        WHERE id IN (
+            SELECT id FROM public.outbox
+            WHERE created_at < now() - make_interval(secs => $1)
+            and (sent_at IS NOT NULL or next_attempt_at <= now())
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+    )
+    SELECT count(*) FROM purged
+""")
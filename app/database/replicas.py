@@ -0,0 +1,106 @@
+""" Routing of the read-only queries to the replicas """
+from collections import OrderedDict
+import hashlib
+import hmac
+import time
+
+
+def parse_hosts(hosts: list, default_port: int):
+    """ (host, port) pairs of "host" or "host:port" entries """
+    addresses = []
+    for entry in hosts:
+        host, separator, port = entry.rpartition(":")
+        if separator and port.isdigit():
+            addresses.append((host, int(port)))
+        else:
+            addresses.append((entry, default_port))
+    return addresses
+
+
+def _signature(value: str, secret: str):
+    """ HMAC of a token value """
+    return hmac.new(secret.encode(), value.encode(), hashlib.sha256).hexdigest()
+
+def sign_write(written_at: float, secret: str):
+    """ Token of the time of a write, sent to the client in the read your writes cookie """
+    value = f"{written_at:.3f}"
+    return f"{value}.{_signature(value, secret)}"
+
+def written_within(token: str, secret: str, window_secs: float, now: float = None):
+    """ True if a valid token records a write less than window_secs ago """
+    # The cookie comes from the client, compare_digest only takes ASCII strings
+    if not token or not token.isascii():
+        return False
+    value, _, signature = token.rpartition(".")
+    if not hmac.compare_digest(signature.encode(), _signature(value, secret).encode()):
+        return False
+    try:
+        written_at = float(value)
+    except ValueError:
+        return False
+    now = time.time() if now is None else now
+    return now - window_secs < written_at <= now + window_secs
+
+
+class RecentWrites:
+    """ Keys written less than window_secs ago, read from the primary until replicas catch up """
+    def __init__(self, window_secs: float):
+        self.window_secs = window_secs
+        # Insertion order is deadline order since the window is the same for every key
+        self.deadlines = OrderedDict()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def mark(self, key: str, now: float = None):
+        """ Record a write of key """
+        now = time.monotonic() if now is None else now
+        self.deadlines.pop(key, None)
+        self.deadlines[key] = now + self.window_secs
+        self._expire(now)
+
+    def contains(self, key: str, now: float = None):
+        """ True if key was written within the window """
+        now = time.monotonic() if now is None else now
+        deadline = self.deadlines.get(key)
+        return deadline is not None and deadline > now
+
+    def _expire(self, now: float):
+        """ Forget the keys whose window is over """
+        while self.deadlines:
+            key, deadline = next(iter(self.deadlines.items()))
+            if deadline > now:
+                return
+            del self.deadlines[key]
+
+
+class ReplicaBalancer:
+    """ Pick a replica pool, in turn or the one with the fewest connections in use
+
+    A replica that failed a checkout is left out for retry_secs.
+    """
+    def __init__(self, pools: list, strategy: str, retry_secs: float = 30):
+        self.pools = pools
+        self.strategy = strategy
+        self.retry_secs = retry_secs
+        self._next = 0
+        self._failed_until = {}
+
+    def mark_failed(self, pool, now: float = None):
+        """ Send no reads to a pool for a while """
+        now = time.monotonic() if now is None else now
+        self._failed_until[pool] = now + self.retry_secs
+
+    def pick(self, now: float = None):
+        """ Pool for the next read, None when every replica failed recently """
+        now = time.monotonic() if now is None else now
+        pools = [pool for pool in self.pools if self._failed_until.get(pool, 0) <= now]
+        if not pools:
+            return None
+        start = self._next % len(pools)
+        self._next += 1
+        if self.strategy != "least_busy":
+            return pools[start]
+        # Rotating the candidates spreads the reads among equally idle replicas
+        candidates = pools[start:] + pools[:start]
+        return min(candidates, key=lambda pool: pool.get_size() - pool.get_idle_size())
@@ -0,0 +1,58 @@
+""" Queries on the users table """
+from . import queries
+
+
+async def get_credentials(conn, email: str):
+    """ Fetch a user and its password hash by email """
+    return await queries.GET_CREDENTIALS.fetchrow(conn, email)
+
+async def insert_user(conn, email: str, hashed_password: str, code: str):
+    """ Insert a user and return the created row """
+    return await queries.INSERT_USER.fetchrow(conn, email, hashed_password, code)
+
+async def iter_users(conn, after_id: int, is_activated, created_after, created_before,
+                     limit: int, prefetch: int):
+    """ Stream users with an id above after_id, must run inside a transaction """
+    async for row in queries.LIST_USERS.cursor(conn, after_id, is_activated, created_after,
+                                               created_before, limit, prefetch=prefetch):
+        yield row
+
+async def insert_users(conn, emails: list, hashed_passwords: list, codes: list):
+    """ Insert many users in one statement, skip existing emails and return the created rows """
+    return await queries.INSERT_USERS.fetch(conn, emails, hashed_passwords, codes)
+
+async def activate_user(conn, user_id: int, email: str, code: str, validity_secs: float):
+    """ Activate a user if the code is correct and still valid, return True on success """
+    activated_id = await queries.ACTIVATE_USER.fetchval(conn, user_id, email, code,
+                                                        float(validity_secs))
+    return activated_id is not None
+
+async def update_password(conn, user_id: int, old_hash: str, new_hash: str):
+    """ Replace the password hash if it is still old_hash, return True on success """
+    return await queries.UPDATE_PASSWORD.fetchval(conn, user_id, old_hash, new_hash) is not None
+
+async def get_activation(conn, user_id: int, email: str):
+    """ Fetch the activation state of a user """
+    return await queries.GET_ACTIVATION.fetchrow(conn, user_id, email)
+
+async def purge_users(conn, retention_secs: float, limit: int):
+    """ Delete at most limit users not activated after retention_secs, return how many """
+    return await queries.PURGE_USERS.fetchval(conn, float(retention_secs), limit)
+
+async def claim_outbox(conn, limit: int, lease_secs: float, max_attempts: int,
+                       max_age_secs: float):
+    """ Lease due outbox messages and return them """
+    return await queries.CLAIM_OUTBOX.fetch(conn, limit, float(lease_secs), max_attempts,
+                                            float(max_age_secs))
+
+async def purge_outbox(conn, age_secs: float, limit: int):
+    """ Delete a batch of outbox messages older than age_secs and return how many """
+    return await queries.PURGE_OUTBOX.fetchval(conn, float(age_secs), limit)
+
+async def mark_outbox_sent(conn, message_ids: list):
+    """ Mark outbox messages as sent """
+    await queries.MARK_OUTBOX_SENT.fetch(conn, message_ids)
+
+async def retry_outbox(conn, message_id: int, delay_secs: float, error: str):
+    """ Schedule the next attempt of an outbox message """
+    await queries.RETRY_OUTBOX.fetch(conn, message_id, float(delay_secs), error)
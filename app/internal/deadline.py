@@ -0,0 +1,120 @@
+""" Per request deadlines and cancellation of abandoned requests
+
+The deadline comes from the REQUEST_TIMEOUT_HEADER header, capped by
+REQUEST_MAX_TIMEOUT_SECS, or from the default of the route. Queries and
+connection checkouts never wait past it: asyncpg cancels a query on the server
+when its timeout expires. When the client disconnects before the response is
+complete, the request task is cancelled, which cancels its query the same way
+and gives the connection back to the pool.
+"""
+import asyncio
+import contextvars
+import time
+from ..config.config import Settings
+from .log_config import logger
+from .metrics import metrics
+
+REQUESTS_CANCELLED = metrics.counter("http_requests_cancelled_total",
+                                     "Requests cancelled because the client disconnected")
+
+# time.monotonic() value after which the current request is abandoned
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceededError(Exception):
+    """ Raised when the deadline of the request is over """
+
+
+def remaining():
+    """ Seconds left before the deadline, None without a deadline """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceededError("The deadline of the request is over")
+    return left
+
+def route_timeout(method: str, path: str):
+    """ Timeout of the longest matching route prefix, REQUEST_TIMEOUT_SECS otherwise """
+    timeout = Settings.REQUEST_TIMEOUT_SECS
+    matched = -1
+    for route, secs in Settings.REQUEST_ROUTE_TIMEOUTS.items():
+        route_method, _, prefix = route.partition(" ")
+        if route_method == method and path.startswith(prefix) and len(prefix) > matched:
+            timeout = secs
+            matched = len(prefix)
+    return timeout
+
+def request_timeout(scope):
+    """ Timeout asked by the client, or the default of the route """
+    header = Settings.REQUEST_TIMEOUT_HEADER.lower().encode()
+    for name, value in scope["headers"]:
+        if name == header:
+            try:
+                timeout = float(value)
+            except ValueError:
+                break
+            if timeout > 0:
+                return min(timeout, Settings.REQUEST_MAX_TIMEOUT_SECS)
+            break
+    return route_timeout(scope["method"], scope["path"])
+
+
+class DeadlineMiddleware:
+    """ ASGI middleware setting the deadline and cancelling abandoned requests
+
+    It reads the messages of the client itself to notice a disconnect while the app
+    works, and hands them over to the app one body chunk at a time.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        current_deadline.set(time.monotonic() + request_timeout(scope))
+        messages = asyncio.Queue()
+        response_complete = False
+
+        async def receive_from_queue():
+            message = await messages.get()
+            messages.task_done()
+            return message
+
+        async def send_wrapper(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        task = asyncio.create_task(self.app(scope, receive_from_queue, send_wrapper))
+
+        async def pump():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    if not response_complete:
+                        REQUESTS_CANCELLED.inc()
+                        logger.info("Client disconnected, cancelling %s %s",
+                                    scope["method"], scope["path"])
+                        task.cancel()
+                    return
+                if message.get("more_body", False):
+                    # Read the next chunk only once the app took this one
+                    await messages.join()
+
+        pump_task = asyncio.create_task(pump())
+        try:
+            await task
+        except asyncio.CancelledError:
+            if not task.done():
+                # The server cancelled this request
+                task.cancel()
+                raise
+            if not task.cancelled():
+                raise
+        finally:
+            pump_task.cancel()
@@ -1,17 +1,106 @@
-""" Loging config file """
+""" Loging config file
+
+Records are put on a bounded queue by the request path and written to the
+console by a listener thread, so a slow stdout never stalls the event loop.
+"""
+import atexit
+import copy
+import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
 import uvicorn
+from ..config.config import Settings
 
 FORMAT: str = "%(levelprefix)s %(asctime)s | %(message)s"
 
-logger = logging.getLogger('simple_example')
-logger.setLevel(logging.DEBUG)
 
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
+class JSONFormatter(logging.Formatter):
+    """ One compact JSON object per line """
+    def format(self, record):
+        line = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, separators=(",", ":"), default=str)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """ Queue handler dropping records, or blocking, when the queue is full """
+    def __init__(self, log_queue, block: bool):
+        super().__init__(log_queue)
+        self.block = block
+        self.dropped = 0
+
+    def prepare(self, record):
+        """ Merge the arguments now, formatting is left to the listener """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 
-formatter = uvicorn.logging.DefaultFormatter(FORMAT)
+def _console_handler():
+    """ Handler writing formatted records to the console """
+    handler = logging.StreamHandler()
+    handler.setLevel(Settings.LOG_LEVEL)
+    if Settings.LOG_FORMAT == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(uvicorn.logging.DefaultFormatter(FORMAT))
+    return handler
 
-ch.setFormatter(formatter)
+def start_listener():
+    """ Start the thread writing queued records """
+    global listener
+    if listener is None:
+        listener = QueueListener(ch.queue, _console_handler(), respect_handler_level=True)
+        listener.start()
+
+def stop_listener():
+    """ Write the remaining records and stop the thread """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def _after_fork():
+    """ Threads and locks do not survive a fork, give the child its own queue and listener """
+    global listener
+    listener = None
+    ch.queue = queue.Queue(maxsize=Settings.LOG_QUEUE_SIZE)
+    start_listener()
+
+
+logger = logging.getLogger('simple_example')
+logger.setLevel(Settings.LOG_LEVEL)
+logger.propagate = False
+
+ch = BoundedQueueHandler(queue.Queue(maxsize=Settings.LOG_QUEUE_SIZE),
+                         block=Settings.LOG_QUEUE_POLICY == "block")
 
 logger.addHandler(ch)
+
+listener = None
+start_listener()
+atexit.register(stop_listener)
+os.register_at_fork(after_in_child=_after_fork)
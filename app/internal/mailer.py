@@ -0,0 +1,79 @@
+""" Transports delivering the mails of the outbox """
+from abc import ABC, abstractmethod
+import asyncio
+from email.message import EmailMessage
+import json
+import smtplib
+from ..config.config import Settings
+from .log_config import logger
+
+
+class Mail:
+    """ Mail built from an outbox message """
+    def __init__(self, idempotency_key: str, recipient: str, subject: str, body: str):
+        self.idempotency_key = idempotency_key
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+
+
+class MailTransport(ABC):
+    """ Base class of the transports """
+    @abstractmethod
+    async def send(self, mail: Mail):
+        """ Deliver a mail, raise on failure so it is retried """
+
+
+class LogTransport(MailTransport):
+    """ Write the mail to the logs, for local use """
+    async def send(self, mail: Mail):
+        logger.info("Mail '%s' to %s: %s", mail.subject, mail.recipient, mail.body)
+
+
+class FileTransport(MailTransport):
+    """ Append each mail as a JSON line to a file, for tests """
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, line: str):
+        """ Append a line, from a worker thread """
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
+    async def send(self, mail: Mail):
+        line = json.dumps({"idempotency_key": mail.idempotency_key, "to": mail.recipient,
+                           "subject": mail.subject, "body": mail.body})
+        await asyncio.to_thread(self._write, line)
+
+
+class SMTPTransport(MailTransport):
+    """ Send through an SMTP server, the idempotency key is the Message-ID """
+    def __init__(self, host: str, port: int, sender: str, timeout: float):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+
+    def _send(self, message: EmailMessage):
+        """ Blocking SMTP exchange, from a worker thread """
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+    async def send(self, mail: Mail):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = mail.recipient
+        message["Subject"] = mail.subject
+        message["Message-ID"] = f"<{mail.idempotency_key}@{self.sender.split('@')[-1]}>"
+        message.set_content(mail.body)
+        await asyncio.to_thread(self._send, message)
+
+
+def build_transport():
+    """ Transport selected by MAIL_TRANSPORT """
+    if Settings.MAIL_TRANSPORT == "file":
+        return FileTransport(Settings.MAIL_FILE_PATH)
+    if Settings.MAIL_TRANSPORT == "smtp":
+        return SMTPTransport(Settings.SMTP_HOST, Settings.SMTP_PORT, Settings.MAIL_FROM,
+                             Settings.SMTP_TIMEOUT_SECS)
+    return LogTransport()
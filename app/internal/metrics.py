@@ -0,0 +1,348 @@
+""" Prometheus style metrics
+
+Every observation happens on the event loop thread, so counters are plain
+numbers updated without locks. With several workers, each one writes a
+snapshot of its metrics to METRICS_DIR and /metrics merges the snapshots.
+Counters and histograms of exited workers are kept, their gauges are dropped.
+The launcher merges the snapshots of exited workers into metrics-exited.json.
+"""
+import asyncio
+from bisect import bisect_left
+import json
+import os
+import time
+from ..config.config import Settings
+from .log_config import ch, logger
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+# Archived worker pids remembered until their own snapshot files are removed
+ABSORBED_PIDS = 64
+
+
+class Counter:
+    """ Monotonic counter with optional labels """
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount: float = 1, labels=()):
+        """ Add to the counter of these label values """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """ (label values, value) pairs """
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class HistogramChild:
+    """ Bucket counts of one set of label values """
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last slot counts observations above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """ Count an observation """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram:
+    """ Histogram with fixed buckets and optional labels """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.children = {}
+
+    def labels(self, *values):
+        """ Child of these label values, keep it to observe without lookups """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float):
+        """ Observe on the child without labels """
+        self.labels().observe(value)
+
+    def samples(self):
+        """ (label values, {counts, sum}) pairs """
+        return [[list(labels), {"counts": list(child.counts), "sum": child.sum}]
+                for labels, child in self.children.items()]
+
+
+class CallbackMetric:
+    """ Gauge or counter read from a callback when metrics are collected """
+    def __init__(self, name: str, documentation: str, callback, labelnames=(),
+                 metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.type = metric_type
+
+    def samples(self):
+        """ (label values, value) pairs returned by the callback """
+        return [[list(labels), value] for labels, value in self.callback()]
+
+
+class MetricsRegistry:
+    """ Metrics of this process and their merge across workers """
+    def __init__(self, directory: str = None):
+        self.directory = directory
+        self.metrics = {}
+
+    def register(self, metric):
+        """ Add a metric and return it """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        """ Register a counter """
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        """ Register a histogram """
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback, labelnames=(),
+                 metric_type: str = "gauge"):
+        """ Register a gauge or counter whose samples come from a callback """
+        return self.register(CallbackMetric(name, documentation, callback, labelnames,
+                                            metric_type))
+
+    def snapshot(self):
+        """ JSON serializable state of every metric of this process """
+        metrics = []
+        for metric in self.metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as error:
+                logger.error("Cannot collect %s: %s", metric.name, error)
+                continue
+            metrics.append({"name": metric.name, "type": metric.type,
+                            "help": metric.documentation, "labelnames": list(metric.labelnames),
+                            "buckets": list(getattr(metric, "buckets", ())),
+                            "samples": samples})
+        return {"pid": os.getpid(), "metrics": metrics}
+
+    def _path(self, pid: int):
+        """ Snapshot file of a worker """
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def flush(self):
+        """ Write the snapshot of this process for the other workers """
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(os.getpid())
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(self.snapshot(), file)
+        os.replace(f"{path}.tmp", path)
+
+    def _load(self, path: str):
+        """ Snapshot written by a worker, None if missing or being replaced """
+        try:
+            with open(path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _snapshots(self):
+        """ Fresh snapshot of this process and the last one of every other worker """
+        snapshots = [self.snapshot()]
+        if not self.directory or not os.path.isdir(self.directory):
+            return snapshots
+        absorbed = set()
+        for filename in os.listdir(self.directory):
+            if not filename.startswith("metrics-") or not filename.endswith(".json"):
+                continue
+            snapshot = self._load(os.path.join(self.directory, filename))
+            if snapshot is None:
+                continue
+            if snapshot['pid'] is None:
+                # Exited workers merged by archive(), their own files may still be there
+                absorbed.update(snapshot['absorbed'])
+                snapshot['alive'] = False
+                snapshots.append(snapshot)
+            elif snapshot['pid'] != os.getpid():
+                snapshot['alive'] = _is_alive(snapshot['pid'])
+                snapshots.append(snapshot)
+        return [snapshot for snapshot in snapshots if snapshot['pid'] not in absorbed]
+
+    def archive(self, pid: int):
+        """ Merge the counters and histograms of an exited worker into one snapshot
+
+        Called by the launcher, so recycled workers do not pile up files in METRICS_DIR.
+        """
+        if not self.directory:
+            return
+        worker = self._load(self._path(pid))
+        if worker is None:
+            return
+        worker['alive'] = False
+        exited = self._load(self._path("exited")) or {"pid": None, "absorbed": [], "metrics": []}
+        exited['alive'] = False
+        merged = _merge([exited, worker])
+        snapshot = {"pid": None, "absorbed": (exited['absorbed'] + [pid])[-ABSORBED_PIDS:],
+                    "metrics": [{**metric, "samples": [[list(labels), value] for labels, value
+                                                       in metric['samples'].items()]}
+                                for metric in merged.values()]}
+        path = self._path("exited")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(snapshot, file)
+        os.replace(f"{path}.tmp", path)
+        os.remove(self._path(pid))
+
+    def clear(self):
+        """ Remove the snapshots of a previous run """
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if filename.startswith("metrics-"):
+                os.remove(os.path.join(self.directory, filename))
+
+    def render(self):
+        """ Prometheus text format of the metrics of every worker """
+        merged = _merge(self._snapshots())
+        lines = []
+        for name, metric in merged.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in metric['samples'].items():
+                pairs = list(zip(metric['labelnames'], labels))
+                if metric['type'] != "histogram":
+                    lines.append(f"{name}{_format_labels(pairs)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric['buckets']) + ["+Inf"], value['counts']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(pairs + [('le', bound)])} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{_format_labels(pairs)} {value['sum']}")
+                lines.append(f"{name}_count{_format_labels(pairs)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _merge(snapshots):
+    """ Sum the samples of the snapshots by metric and labels, gauges of exited workers dropped """
+    merged = {}
+    for snapshot in snapshots:
+        for metric in snapshot['metrics']:
+            if metric['type'] == "gauge" and not snapshot.get('alive', True):
+                continue
+            entry = merged.setdefault(metric['name'], {**metric, "samples": {}})
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                if metric['type'] == "histogram":
+                    current = entry['samples'].setdefault(
+                        key, {"counts": [0] * len(value['counts']), "sum": 0.0})
+                    current['counts'] = [a + b for a, b in
+                                         zip(current['counts'], value['counts'])]
+                    current['sum'] += value['sum']
+                else:
+                    entry['samples'][key] = entry['samples'].get(key, 0) + value
+    return merged
+
+def _format_labels(pairs):
+    """ {name="value",...} or an empty string """
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _is_alive(pid: int):
+    """ True if the process still exists """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsMiddleware:
+    """ ASGI middleware timing every HTTP request by route template """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            # The client went away, as logged by nginx
+            if status[0] == 500:
+                status[0] = 499
+            raise
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "<unmatched>"
+            REQUEST_DURATION.labels(scope["method"], path, str(status[0])).observe(
+                time.perf_counter() - start)
+
+
+async def monitor_event_loop_lag(interval: float):
+    """ Measure how late the loop wakes up a sleeping task """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+async def flush_periodically(interval: float):
+    """ Write the snapshot of this worker at a fixed interval """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            metrics.flush()
+        except OSError as error:
+            logger.error(error)
+
+
+metrics = MetricsRegistry(Settings.METRICS_DIR)
+
+REQUEST_DURATION = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route",
+    ("method", "route", "status"))
+POOL_ACQUIRE_WAIT = metrics.histogram(
+    "db_pool_acquire_wait_seconds", "Time waited to check out a database connection")
+POOL_ACQUIRE_TIMEOUTS = metrics.counter(
+    "db_pool_acquire_timeouts_total", "Checkouts that gave up waiting for a connection")
+DB_READS = metrics.counter(
+    "db_reads_total", "Read-only checkouts by target, fallback when a replica failed",
+    ("target",))
+QUERY_DURATION = metrics.histogram(
+    "db_query_duration_seconds", "Database time by registered query", ("query",))
+BCRYPT_DURATION = metrics.histogram(
+    "bcrypt_duration_seconds", "bcrypt time including the wait for a worker", ("operation",))
+EVENT_LOOP_LAG = metrics.histogram(
+    "event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+LOG_RECORDS_DROPPED = metrics.callback(
+    "log_records_dropped_total", "Log records dropped because the queue was full",
+    lambda: [((), ch.dropped)], metric_type="counter")
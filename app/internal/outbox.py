@@ -0,0 +1,126 @@
+""" Background delivery of the mails queued in the outbox table """
+import asyncio
+import json
+import random
+import asyncpg
+from ..config.config import Settings
+from ..database import repository
+from ..database.database import PoolTimeoutError, database
+from .log_config import logger
+from .mailer import Mail, build_transport
+from .metrics import metrics
+
+OUTBOX_MESSAGES = metrics.counter("outbox_messages_total", "Outbox deliveries by result",
+                                  ("result",))
+
+
+def backoff_delay(attempts: int, base_secs: float, max_secs: float):
+    """ Exponential delay before the next attempt, with jitter to spread retries """
+    delay = min(max_secs, base_secs * 2 ** (attempts - 1))
+    return delay * (0.5 + random.random() / 2)
+
+def build_mail(message):
+    """ Mail of an outbox row """
+    payload = json.loads(message['payload'])
+    if message['kind'] == "activation":
+        return Mail(message['idempotency_key'], message['recipient'], "Your activation code",
+                    f"Your activation code is {payload['code']}. "
+                    f"It is valid for {Settings.CODE_VALIDITY_PERIOD_SECS} seconds.")
+    raise ValueError(f"Unknown outbox message kind {message['kind']}")
+
+
+class OutboxWorker:
+    """ Drain the outbox in batches with a bounded number of concurrent sends """
+    def __init__(self, transport=None):
+        self.transport = transport
+        self._task = None
+        self._wakeup = None
+
+    def notify(self):
+        """ Wake the worker up after queuing messages """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        """ Start draining in the background """
+        if self.transport is None:
+            self.transport = build_transport()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """ Stop draining, leased messages are retried after the lease """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        """ Drain until cancelled, waiting for a notification or the poll interval when idle """
+        await database.wait_ready()
+        while True:
+            try:
+                claimed = await self.drain_once()
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError,
+                    PoolTimeoutError) as error:
+                logger.error(error)
+                claimed = 0
+            if claimed < Settings.OUTBOX_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), Settings.OUTBOX_POLL_SECS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _deliver(self, semaphore, message):
+        """ Send one message, return the error or None """
+        async with semaphore:
+            try:
+                await asyncio.wait_for(self.transport.send(build_mail(message)),
+                                       Settings.OUTBOX_SEND_TIMEOUT_SECS)
+            except Exception as error:
+                return repr(error)
+        return None
+
+    async def drain_once(self):
+        """ Send one batch of due messages and return how many were claimed """
+        async with database.acquire() as conn:
+            messages = await repository.claim_outbox(conn, Settings.OUTBOX_BATCH_SIZE,
+                                                     Settings.OUTBOX_LEASE_SECS,
+                                                     Settings.OUTBOX_MAX_ATTEMPTS,
+                                                     Settings.CODE_VALIDITY_PERIOD_SECS)
+        if not messages:
+            return 0
+
+        semaphore = asyncio.Semaphore(Settings.OUTBOX_CONCURRENCY)
+        errors = await asyncio.gather(*(self._deliver(semaphore, message)
+                                        for message in messages))
+
+        sent = [message['id'] for message, error in zip(messages, errors) if error is None]
+        async with database.acquire() as conn:
+            if sent:
+                await repository.mark_outbox_sent(conn, sent)
+            for message, error in zip(messages, errors):
+                if error is None:
+                    continue
+                if message['attempts'] >= Settings.OUTBOX_MAX_ATTEMPTS:
+                    logger.error("Giving up on mail %s after %s attempts: %s",
+                                 message['idempotency_key'], message['attempts'], error)
+                    OUTBOX_MESSAGES.inc(labels=("failed",))
+                else:
+                    logger.warning("Mail %s failed, attempt %s: %s",
+                                   message['idempotency_key'], message['attempts'], error)
+                    OUTBOX_MESSAGES.inc(labels=("retry",))
+                await repository.retry_outbox(conn, message['id'],
+                                              backoff_delay(message['attempts'],
+                                                            Settings.OUTBOX_BACKOFF_BASE_SECS,
+                                                            Settings.OUTBOX_BACKOFF_MAX_SECS),
+                                              error)
+        OUTBOX_MESSAGES.inc(len(sent), labels=("sent",))
+        return len(messages)
+
+
+outbox_worker = OutboxWorker()
@@ -0,0 +1,82 @@
+""" Background deletion of the users that were never activated and of the old outbox messages """
+import asyncio
+import asyncpg
+from ..config.config import Settings
+from ..database import repository
+from ..database.database import PoolTimeoutError, database
+from .log_config import logger
+from .metrics import metrics
+
+USERS_PURGED = metrics.counter("users_purged_total",
+                               "Users deleted because they were not activated in time")
+OUTBOX_PURGED = metrics.counter("outbox_messages_purged_total",
+                                "Outbox messages deleted once their code expired")
+PURGE_BATCHES = metrics.counter("purge_batches_total", "Purge batches by result", ("result",))
+
+
+class PurgeWorker:
+    """ Delete expired users and outbox messages in batches, pausing while the pool is busy """
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        """ Start purging in the background """
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """ Stop purging, a batch in progress is rolled back """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        """ Purge until cancelled, every PURGE_INTERVAL_SECS """
+        await database.wait_ready()
+        while True:
+            try:
+                purged = await self.purge()
+                pruned = await self.purge_outbox()
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError,
+                    PoolTimeoutError) as error:
+                logger.error(error)
+                PURGE_BATCHES.inc(labels=("error",))
+            else:
+                if purged:
+                    logger.info("Purged %s users not activated", purged)
+                if pruned:
+                    logger.info("Purged %s outbox messages", pruned)
+            await asyncio.sleep(Settings.PURGE_INTERVAL_SECS)
+
+    async def purge(self):
+        """ Delete users not activated until a batch is short, return how many """
+        # A user must not be deleted while its code can still be used
+        retention_secs = max(Settings.PURGE_RETENTION_SECS, Settings.CODE_VALIDITY_PERIOD_SECS)
+        return await self._batches(repository.purge_users, retention_secs, USERS_PURGED)
+
+    async def purge_outbox(self):
+        """ Delete the outbox messages, sent or given up, once their code expired """
+        return await self._batches(repository.purge_outbox, Settings.CODE_VALIDITY_PERIOD_SECS,
+                                   OUTBOX_PURGED)
+
+    async def _batches(self, delete, age_secs: float, counter):
+        """ Delete batches until none is full or the pool gets busy, return how many rows """
+        purged = 0
+        while True:
+            if database.in_use_ratio() > Settings.PURGE_MAX_POOL_USAGE:
+                PURGE_BATCHES.inc(labels=("throttled",))
+                return purged
+            async with database.acquire() as conn:
+                deleted = await delete(conn, age_secs, Settings.PURGE_BATCH_SIZE)
+            PURGE_BATCHES.inc(labels=("done",))
+            counter.inc(deleted)
+            purged += deleted
+            if deleted < Settings.PURGE_BATCH_SIZE:
+                return purged
+            await asyncio.sleep(Settings.PURGE_BATCH_PAUSE_SECS)
+
+
+purge_worker = PurgeWorker()
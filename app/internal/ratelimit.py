@@ -0,0 +1,162 @@
+""" Token bucket rate limiting of the authenticated routes
+
+Buckets are keyed by client IP and by the email of the Basic credentials, and
+are checked before the credentials are looked up or hashed. The default backend
+keeps them in memory, per worker; a shared backend can be plugged in by
+implementing RateLimitBackend.
+"""
+from abc import ABC, abstractmethod
+import base64
+import binascii
+from collections import OrderedDict
+import math
+import time
+import zlib
+from ..config.config import Settings
+from .metrics import metrics
+
+RATE_LIMIT_REQUESTS = metrics.counter("ratelimit_requests_total",
+                                      "Rate limited route requests by rule and result",
+                                      ("rule", "result"))
+
+
+class Rule:
+    """ Refill rate and burst of a family of buckets """
+    def __init__(self, name: str, rate_per_sec: float, burst: float):
+        self.name = name
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+
+
+class RateLimitBackend(ABC):
+    """ Storage of the buckets """
+    @abstractmethod
+    async def take(self, rule: Rule, key: str):
+        """ Take a token, return (allowed, seconds until a token is available) """
+
+    def reset(self):
+        """ Forget every bucket """
+
+
+class MemoryBackend(RateLimitBackend):
+    """ Buckets in memory, split in shards each evicting its least recently used keys """
+    def __init__(self, max_keys: int, shards: int = 16):
+        self.shards = [OrderedDict() for _ in range(shards)]
+        self.max_keys_per_shard = max(1, max_keys // shards)
+        self.evictions = 0
+
+    def size(self):
+        """ Number of buckets """
+        return sum(len(shard) for shard in self.shards)
+
+    def take_now(self, rule: Rule, key: str, now: float):
+        """ Take a token at the given time """
+        bucket_key = f"{rule.name}:{key}"
+        shard = self.shards[zlib.crc32(bucket_key.encode()) % len(self.shards)]
+        bucket = shard.get(bucket_key)
+        if bucket is None:
+            tokens = rule.burst
+            if len(shard) >= self.max_keys_per_shard:
+                shard.popitem(last=False)
+                self.evictions += 1
+        else:
+            tokens = min(rule.burst, bucket[0] + (now - bucket[1]) * rule.rate_per_sec)
+            shard.move_to_end(bucket_key)
+        if tokens >= 1:
+            shard[bucket_key] = (tokens - 1, now)
+            return True, 0.0
+        shard[bucket_key] = (tokens, now)
+        return False, (1 - tokens) / rule.rate_per_sec
+
+    async def take(self, rule: Rule, key: str):
+        return self.take_now(rule, key, time.monotonic())
+
+    def reset(self):
+        for shard in self.shards:
+            shard.clear()
+
+
+def basic_auth_email(headers):
+    """ Email of the Basic credentials of the request, None without valid ones """
+    for name, value in headers:
+        if name != b"authorization":
+            continue
+        scheme, _, encoded = value.partition(b" ")
+        if scheme.lower() != b"basic":
+            return None
+        try:
+            decoded = base64.b64decode(encoded, validate=True).decode("utf-8")
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+        email, separator, _ = decoded.partition(":")
+        return email.lower() if separator else None
+    return None
+
+
+class RateLimiter:
+    """ Rules applied to the routes that check credentials """
+    def __init__(self, backend: RateLimitBackend):
+        self.backend = backend
+        self.ip_rule = Rule("ip", Settings.RATE_LIMIT_IP_PER_SEC, Settings.RATE_LIMIT_IP_BURST)
+        self.email_rule = Rule("email", Settings.RATE_LIMIT_EMAIL_PER_SEC,
+                               Settings.RATE_LIMIT_EMAIL_BURST)
+        # Bounds code guesses within the validity of an activation code
+        self.activation_rule = Rule("activation", Settings.RATE_LIMIT_ACTIVATION_PER_MIN / 60,
+                                    Settings.RATE_LIMIT_ACTIVATION_BURST)
+
+    def rules(self, scope):
+        """ (rule, key) pairs applying to a request """
+        path = scope["path"]
+        is_activation = path.startswith("/users/activate/")
+        if not (is_activation or path.startswith("/user/")):
+            return []
+        client = scope.get("client")
+        checks = [(self.ip_rule, client[0] if client else "unknown")]
+        email = basic_auth_email(scope["headers"])
+        if email is not None:
+            checks.append((self.email_rule, email))
+            if is_activation:
+                checks.append((self.activation_rule, email))
+        return checks
+
+    async def check(self, scope):
+        """ None if the request is allowed, else the seconds to wait """
+        for rule, key in self.rules(scope):
+            allowed, retry_after = await self.backend.take(rule, key)
+            RATE_LIMIT_REQUESTS.inc(labels=(rule.name, "allowed" if allowed else "limited"))
+            if not allowed:
+                return retry_after
+        return None
+
+    def reset(self):
+        """ Forget every bucket """
+        self.backend.reset()
+
+
+class RateLimitMiddleware:
+    """ ASGI middleware answering 429 before the app does any work """
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not Settings.RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        retry_after = await self.limiter.check(scope)
+        if retry_after is None:
+            await self.app(scope, receive, send)
+            return
+        await send({"type": "http.response.start", "status": 429,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"retry-after", str(math.ceil(retry_after)).encode())]})
+        await send({"type": "http.response.body", "body": b'{"detail":"Too many requests"}'})
+
+
+memory_backend = MemoryBackend(Settings.RATE_LIMIT_MAX_KEYS)
+rate_limiter = RateLimiter(memory_backend)
+
+metrics.callback("ratelimit_buckets", "Rate limit buckets in memory",
+                 lambda: [((), memory_backend.size())])
+metrics.callback("ratelimit_evictions_total", "Rate limit buckets evicted to bound memory",
+                 lambda: [((), memory_backend.evictions)], metric_type="counter")
@@ -1,19 +1,40 @@
 """ Main file of the API """
+import asyncio
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 from .routers import users
-from .database.database import postgreSQL_pool
+from .config.config import Settings
+from .database.database import PoolTimeoutError, database
+from .internal.deadline import DeadlineExceededError, DeadlineMiddleware
 from .internal.log_config import logger
+from .internal.outbox import outbox_worker
+from .internal.purge import purge_worker
+from .internal.ratelimit import RateLimitMiddleware, rate_limiter
+from .internal.metrics import (MetricsMiddleware, flush_periodically, metrics,
+                               monitor_event_loop_lag)
+from .utils.hashing import HashingQueueFullError, password_hasher
 
 @asynccontextmanager
 async def lifespan(app):
     """ Startup and close methods """
+    # Connect and init tables in the background, /readyz tells when it is done
+    database.start()
+    tasks = [asyncio.create_task(monitor_event_loop_lag(Settings.EVENT_LOOP_LAG_INTERVAL_SECS)),
+             asyncio.create_task(flush_periodically(Settings.METRICS_FLUSH_SECS))]
+    outbox_worker.start()
+    if Settings.PURGE_ENABLED:
+        purge_worker.start()
     yield
+    await purge_worker.stop()
+    await outbox_worker.stop()
+    for task in tasks:
+        task.cancel()
+    metrics.flush()
+    # Stop hashing workers
+    password_hasher.shutdown()
     # Close connection at shutdown
-    if postgreSQL_pool:
-        logger.info("Closing connection to database")
-        postgreSQL_pool.closeall()
-        logger.info("Connection to database closed")
+    await database.close()
 
 app = FastAPI(
     title="FastAPI API",
@@ -34,11 +55,53 @@ To read and activate a user you must be logged in.
     """,
     summary="This API is used to create and activate users",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan)
 app.include_router(users.router)
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(DeadlineMiddleware)
+
+
+@app.exception_handler(HashingQueueFullError)
+@app.exception_handler(PoolTimeoutError)
+async def server_busy_handler(request: Request, exc: Exception):
+    """ Ask the client to retry later when hashing workers or connections are exhausted """
+    logger.warning("Server busy: %s", exc)
+    return JSONResponse(status_code=503,
+                        content={"detail": "The server is busy, please retry later"},
+                        headers={"Retry-After": str(Settings.RETRY_AFTER_SECS)})
+
+
+@app.exception_handler(DeadlineExceededError)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceededError):
+    """ The work was cancelled at the deadline of the request """
+    logger.warning("Deadline exceeded: %s", exc)
+    return JSONResponse(status_code=504, content={"detail": "The request took too long"})
 
 
 @app.get("/")
 async def root():
     """ root route """
     return {"message": "ok"}
+
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """ Liveness, the worker answers requests """
+    return {"status": "ok"}
+
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """ Readiness, the database is initialized and answers a query """
+    if not await database.check_health():
+        return JSONResponse(status_code=503, content={"status": "not ready"})
+    return {"status": "ready"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    """ Metrics of every worker in the Prometheus text format """
+    return PlainTextResponse(metrics.render(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
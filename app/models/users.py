@@ -1,5 +1,6 @@
 """ Model for Users """
-from pydantic import BaseModel
+from datetime import datetime
+from pydantic import BaseModel, Field
 
 class CreateUsers(BaseModel):
     """ Class of Users to create """
@@ -21,5 +22,21 @@ class UserResponse(BaseModel):
     """ Class of User response"""
     id: int
     email: str
-    created_at: str
+    created_at: datetime
     is_activated: bool
+
+    @classmethod
+    def from_row(cls, row):
+        """ Build from a row starting with id, email, created_at, is_activated without validation """
+        return cls.model_construct(id=row[0], email=row[1], created_at=row[2], is_activated=row[3])
+
+class Principal(UserResponse):
+    """ Authenticated user, loaded once by the credentials check """
+    # Row version, for the ETag only
+    version: int = Field(default=1, exclude=True)
+
+    @classmethod
+    def from_row(cls, row):
+        """ Build from a credentials row, whose version follows the password """
+        return cls.model_construct(id=row[0], email=row[1], created_at=row[2], is_activated=row[3],
+                                   version=row[5])
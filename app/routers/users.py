@@ -1,148 +1,358 @@
 """ Routes for User model """
+import asyncio
+from datetime import datetime, timezone
+import math
 from random import randint
-import psycopg2
-import bcrypt
-from psycopg2.extras import RealDictCursor
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.encoders import jsonable_encoder
-from ..models.users import CreateUsers, UserResponse
-from ..database.database import postgreSQL_pool
+import secrets
+import time
+import asyncpg
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.security import APIKeyHeader, HTTPBasic, HTTPBasicCredentials
+from fastapi.responses import ORJSONResponse, Response
+from ..models.users import CreateUsers, Principal, UserResponse
+from ..database import repository
+from ..database.database import PoolTimeoutError, database
+from ..database.replicas import sign_write, written_within
+from ..internal.deadline import DeadlineExceededError
 from ..internal.log_config import logger
+from ..internal.metrics import metrics
+from ..internal.outbox import outbox_worker
 from ..config.config import Settings
-from ..utils.helpers import hash_password
+from ..utils.credentials_cache import credentials_cache
+from ..utils.hashing import password_hasher
+from ..utils.response_cache import etag_matches, user_etag, user_responses
+from ..utils.helpers import validate_new_user
+from ..utils.single_flight import SingleFlight
+from ..utils.streaming import NDJSONResponse, iter_json_objects
 
 router = APIRouter()
 
 security = HTTPBasic()
 
-def check_credentials(credentials: HTTPBasicCredentials = Depends(security)):
-    """ Check credentials """
-    username = credentials.username
-    password = credentials.password
+admin_key = APIKeyHeader(name="X-Admin-Key", auto_error=False)
+
+# Concurrent requests with the same credentials share one lookup and one bcrypt check
+credential_checks = SingleFlight()
+
+metrics.callback("credential_checks_total", "Credential lookups and bcrypt checks run",
+                 lambda: [((), credential_checks.calls)], metric_type="counter")
+metrics.callback("credential_checks_shared_total",
+                 "Credential checks answered by a concurrent identical check",
+                 lambda: [((), credential_checks.shared)], metric_type="counter")
+PASSWORD_REHASHES = metrics.counter("password_rehashes_total",
+                                    "Hashes of another cost replaced after a login", ("result",))
+
+# Keeps the background rehashes referenced until they are done
+rehash_tasks = set()
+
+def generate_code():
+    """ Generate a random 4 digits code """
+    return str(randint(1, 9999)).zfill(4)
+
+async def rehash_password(user_id: int, email: str, old_hash: str, password: str):
+    """ Replace a hash made with another cost than BCRYPT_ROUNDS """
+    try:
+        new_hash = await password_hasher.rehash_password(password)
+        if new_hash is None:
+            PASSWORD_REHASHES.inc(labels=("skipped",))
+            return
+        async with database.acquire() as conn:
+            updated = await repository.update_password(conn, user_id, old_hash, new_hash)
+    except (asyncpg.PostgresError, PoolTimeoutError) as error:
+        logger.error(error)
+        PASSWORD_REHASHES.inc(labels=("error",))
+        return
+    if updated:
+        database.mark_written(email)
+    PASSWORD_REHASHES.inc(labels=("updated" if updated else "conflict",))
+
+def remember_write(response: Response):
+    """ Send the reads of this client to the primary for a while, whichever worker serves them """
+    if database.replicas:
+        response.set_cookie(Settings.READ_YOUR_WRITES_COOKIE,
+                            sign_write(time.time(), Settings.READ_YOUR_WRITES_SECRET),
+                            max_age=math.ceil(Settings.READ_YOUR_WRITES_SECS),
+                            httponly=True, samesite="lax")
+
+def wrote_recently(request: Request):
+    """ True if the read your writes cookie of the client is still valid """
+    if not database.replicas:
+        return False
+    return written_within(request.cookies.get(Settings.READ_YOUR_WRITES_COOKIE),
+                          Settings.READ_YOUR_WRITES_SECRET, Settings.READ_YOUR_WRITES_SECS)
+
+async def read_user(fetch, email: str, recent_write: bool):
+    """ Row of a user, from the primary after a recent write of the client or of this worker
+
+    A miss is not looked up again on the primary, unknown emails would double
+    the queries and load the primary.
+    """
+    async with database.acquire_read(email, recent_write) as conn:
+        return await fetch(conn, email)
 
+async def verify_credentials(username: str, password: str, recent_write: bool = False):
+    """ Look the user up, check the password and return the authenticated user """
     try:
-        conn = postgreSQL_pool.getconn()
-        with conn.cursor(cursor_factory=RealDictCursor) as curs:
-            curs.execute("SELECT email, password FROM public.users WHERE email = %s",
-                            (username,))
-            result = curs.fetchone()
-    except (psycopg2.DatabaseError) as error:
+        result = await read_user(repository.get_credentials, username, recent_write)
+    except asyncpg.PostgresError as error:
         logger.error(error)
         raise HTTPException(status_code=500, detail="An error has occured") from error
-    finally:
-        postgreSQL_pool.putconn(conn)
-    json_result = jsonable_encoder(result)
-    if json_result is None:
+    if result is None:
         raise HTTPException(status_code=400, detail="Incorrect email or password")
 
-    password_check = bcrypt.checkpw(password.encode('utf-8'),
-                                    json_result['password'].encode('utf-8'))
+    password_check = await password_hasher.check_password(password, result['password'])
     if password_check is not True:
         raise HTTPException(status_code=400, detail="Incorrect email or password")
 
-    return username
+    # The password is only known now, the login does not wait for the new hash
+    if Settings.BCRYPT_REHASH_ON_LOGIN and password_hasher.needs_rehash(result['password']):
+        task = asyncio.create_task(rehash_password(result['id'], result['email'],
+                                                   result['password'], password))
+        rehash_tasks.add(task)
+        task.add_done_callback(rehash_tasks.discard)
+
+    principal = Principal.from_row(result)
+    credentials_cache.put(username, password, principal)
+    return principal
+
+async def check_credentials(request: Request,
+                            credentials: HTTPBasicCredentials = Depends(security)):
+    """ Check credentials and return the authenticated user """
+    username = credentials.username
+    password = credentials.password
+
+    # Skip the lookup and bcrypt for recently verified credentials
+    principal = credentials_cache.get(username, password)
+    if principal is not None:
+        return principal
+
+    # Only callers read from the same servers share a check
+    recent_write = wrote_recently(request)
+    return await credential_checks.do((credentials_cache.digest(username, password), recent_write),
+                                      verify_credentials, username, password, recent_write)
+
+def check_admin(key: str = Depends(admin_key)):
+    """ Check the admin key """
+    if Settings.ADMIN_API_KEY in [None, '']:
+        raise HTTPException(status_code=403, detail="The admin key is not configured")
+    if key is None or not secrets.compare_digest(key, Settings.ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Incorrect admin key")
 
 @router.get("/user/{user_id}", tags=["users"], status_code=200, response_model=UserResponse)
-async def get_users(user_id: int, username: str = Depends(check_credentials)):
+async def get_users(user_id: int, request: Request,
+                    principal: Principal = Depends(check_credentials)):
     """ Get a user """
-    try:
-        conn = postgreSQL_pool.getconn()
-        with conn.cursor(cursor_factory=RealDictCursor) as curs:
-            # Fetch from db
-            curs.execute("""
-                         SELECT id, email, created_at, is_activated FROM public.users
-                         WHERE id = %s and email = %s
-                         """,
-                         (user_id, username))
-            result = curs.fetchone()
-    except (psycopg2.DatabaseError) as error:
-        logger.error(error)
-        raise HTTPException(status_code=500, detail="An error has occured") from error
-    finally:
-        postgreSQL_pool.putconn(conn)
-
-    if result is None:
+    # A user can only read itself, which was already loaded by the credentials check
+    if principal.id != user_id:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return jsonable_encoder(result)
+    # The principal is the row read by the authentication or cached with the credentials,
+    # a change made through another worker shows once the credentials cache entry expires
+    etag = user_etag(principal)
+    # Clients must revalidate, the response depends on the credentials
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    body = user_responses.get(user_id, etag)
+    if body is None:
+        # Already a trusted row, skip the response model validation
+        body = orjson.dumps(principal.model_dump())
+        user_responses.put(user_id, etag, body)
+    return Response(body, media_type="application/json", headers=headers)
 
 @router.post("/users", tags=["users"], status_code=201, response_model=UserResponse)
 async def create_user(user: CreateUsers):
     """ Create a user """
-    # Check if password is empty
-    if user.password in [None, '']:
-        raise HTTPException(status_code=400, detail="The password is empty")
-    # Check if password is too short (< 8 chars)
-    if len(user.password) < 8:
-        raise HTTPException(status_code=400,
-                detail="The password must be at least 8 characters. Consider having a shorter one")
+    # Check the password and email before hashing
+    error = validate_new_user(user.email, user.password)
+    if error is not None:
+        raise HTTPException(status_code=400, detail=error)
+    # Hash password in the worker pool before taking a connection
+    hashed_password = await password_hasher.hash_password(user.password)
+    code = generate_code()
     try:
-        conn = postgreSQL_pool.getconn()
-        # Generate a random 4 digits code
-        code = str(randint(1, 9999)).zfill(4)
-        # Hash password
-        hashed_password = hash_password(user.password)
-        with conn.cursor(cursor_factory=RealDictCursor) as curs:
+        async with database.acquire() as conn:
             # Insert in db
-            curs.execute("""
-                INSERT INTO public.users (email, password, code)
-                VALUES (%s, %s, %s)
-                RETURNING *;
-                """,
-                (user.email, hashed_password, code))
-            new_user = curs.fetchone()
-        conn.commit()
-    except (psycopg2.DatabaseError) as error:
+            new_user = await repository.insert_user(conn, user.email, hashed_password, code)
+    except asyncpg.UniqueViolationError as error:
+        logger.error(error)
+        raise HTTPException(status_code=400, detail="The email already exists") from error
+    except asyncpg.CheckViolationError as error:
         logger.error(error)
-        if "duplicate" in error.pgerror:
-            raise HTTPException(status_code=400, detail="The email already exists") from error
-        if "correct_email" in error.pgerror or "email_min_size_check" in error.pgerror:
+        if error.constraint_name in ["correct_email", "email_min_size_check"]:
             raise HTTPException(status_code=400, detail="The email is incorrect") from error
-        if "value too long" in error.pgerror:
-            raise HTTPException(status_code=400,
-                                detail="The email is over 50 characters") from error
-
         raise HTTPException(status_code=500, detail="An error has occured") from error
-    finally:
-        postgreSQL_pool.putconn(conn)
+    except asyncpg.StringDataRightTruncationError as error:
+        logger.error(error)
+        raise HTTPException(status_code=400,
+                            detail="The email is over 50 characters") from error
+    except asyncpg.PostgresError as error:
+        logger.error(error)
+        raise HTTPException(status_code=500, detail="An error has occured") from error
+
+    credentials_cache.invalidate(new_user['email'])
+    user_responses.invalidate(new_user['id'])
+    database.mark_written(new_user['email'])
+    # The activation mail was queued with the user, send it now
+    outbox_worker.notify()
+    logger.info("User %s created", new_user['id'])
+    response = ORJSONResponse(UserResponse.from_row(new_user).model_dump(), status_code=201)
+    remember_write(response)
+    return response
 
-    # Send the email
-    # send_email()
-    logger.info("An email with the activation code '%s' has been sent to %s",
-                new_user['code'], new_user['email'])
-    return jsonable_encoder(new_user)
+async def create_users_batch(batch: list):
+    """ Create a batch of (index, item) and return one result per item """
+    results = {}
+    valid = {}
+    for index, item in batch:
+        try:
+            user = CreateUsers.model_validate(item)
+        except ValueError:
+            results[index] = {"index": index, "status": "invalid", "detail": "The user is invalid"}
+            continue
+        error = validate_new_user(user.email, user.password)
+        if error is not None:
+            results[index] = {"index": index, "email": user.email, "status": "invalid",
+                              "detail": error}
+        elif user.email in valid:
+            results[index] = {"index": index, "email": user.email, "status": "duplicate",
+                              "detail": "The email already exists"}
+        else:
+            valid[user.email] = (index, user)
+
+    if valid:
+        users = list(valid.values())
+        hashed_passwords = await password_hasher.hash_passwords(
+            [user.password for _, user in users], Settings.BULK_HASHING_CONCURRENCY)
+        codes = [generate_code() for _ in users]
+        try:
+            async with database.acquire() as conn:
+                created = await repository.insert_users(conn, list(valid), hashed_passwords, codes)
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, PoolTimeoutError,
+                DeadlineExceededError) as error:
+            # The status line is already sent, the items of this batch are reported as errors
+            logger.error(error)
+            created = None
+        created_by_email = {} if created is None else {row['email']: row for row in created}
+        for index, user in users:
+            new_user = created_by_email.get(user.email)
+            if created is None:
+                results[index] = {"index": index, "email": user.email, "status": "error",
+                                  "detail": "An error has occured"}
+            elif new_user is None:
+                results[index] = {"index": index, "email": user.email, "status": "duplicate",
+                                  "detail": "The email already exists"}
+            else:
+                credentials_cache.invalidate(user.email)
+                database.mark_written(user.email)
+                results[index] = {"index": index, "email": user.email, "status": "created",
+                                  "id": new_user['id']}
+
+    if created:
+        outbox_worker.notify()
+    return [results[index] for index, _ in batch]
+
+async def create_users_stream(chunks):
+    """ Create users as they are read from the body and yield their results """
+    batch = []
+    index = 0
+    try:
+        async for item in iter_json_objects(chunks, Settings.BULK_MAX_ITEM_BYTES):
+            batch.append((index, item))
+            index += 1
+            if len(batch) >= Settings.BULK_BATCH_SIZE:
+                for result in await create_users_batch(batch):
+                    yield result
+                batch = []
+    except ValueError as error:
+        parse_error = str(error)
+    else:
+        parse_error = None
+    if batch:
+        for result in await create_users_batch(batch):
+            yield result
+    if parse_error is not None:
+        yield {"index": index, "status": "invalid", "detail": parse_error}
+
+@router.post("/users/bulk", tags=["users"], status_code=200,
+             response_class=NDJSONResponse,
+             openapi_extra={"requestBody": {"content": {
+                 "application/json": {"schema": {
+                     "type": "array", "items": CreateUsers.model_json_schema()}},
+                 "application/x-ndjson": {"schema": CreateUsers.model_json_schema()}}}})
+async def create_users(request: Request):
+    """ Create users from a JSON array or NDJSON body, one result line per user """
+    return NDJSONResponse(create_users_stream(request.stream()), reads_request=True)
+
+async def list_users_stream(after_id: int, is_activated, created_after, created_before,
+                            limit: int):
+    """ Yield users one at a time from a server side cursor """
+    try:
+        async with database.acquire_read() as conn:
+            async with conn.transaction(readonly=True):
+                async for row in repository.iter_users(conn, after_id, is_activated,
+                                                       created_after, created_before, limit,
+                                                       Settings.LIST_PREFETCH):
+                    yield {"id": row['id'], "email": row['email'],
+                           "created_at": row['created_at'], "is_activated": row['is_activated']}
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, PoolTimeoutError,
+            DeadlineExceededError) as error:
+        # The status line is already sent, end the stream with an error line
+        logger.error(error)
+        yield {"error": "An error has occured"}
+
+@router.get("/users", tags=["users"], status_code=200, response_class=NDJSONResponse,
+            dependencies=[Depends(check_admin)])
+async def list_users(after_id: int = 0, is_activated: bool | None = None,
+                     created_after: datetime | None = None,
+                     created_before: datetime | None = None,
+                     limit: int = Query(default=Settings.LIST_DEFAULT_LIMIT, ge=1,
+                                        le=Settings.LIST_MAX_LIMIT)):
+    """ List users ordered by id, one JSON user per line
+
+    Pass the id of the last user received as after_id to get the next page.
+    """
+    # created_at is stored without time zone, in UTC
+    if created_after is not None and created_after.tzinfo is not None:
+        created_after = created_after.astimezone(timezone.utc).replace(tzinfo=None)
+    if created_before is not None and created_before.tzinfo is not None:
+        created_before = created_before.astimezone(timezone.utc).replace(tzinfo=None)
+    return NDJSONResponse(list_users_stream(after_id, is_activated, created_after,
+                                            created_before, limit))
 
 @router.patch("/users/activate/{user_id}", tags=["users"], status_code=200)
-async def activate_user(user_id: int, code: str, username: str = Depends(check_credentials)):
+async def activate_user(user_id: int, code: str, response: Response,
+                        principal: Principal = Depends(check_credentials)):
     """ Activate a user """
+    # A user can only activate itself
+    if principal.id != user_id:
+        raise HTTPException(status_code=404, detail="The user was not found")
+    username = principal.email
     try:
-        conn = postgreSQL_pool.getconn()
-        with conn.cursor(cursor_factory=RealDictCursor) as curs:
-            curs.execute("""
-                         SELECT code, is_activated, extract(epoch from (now() - created_at)) as delay
-                         FROM public.users
-                         WHERE id = %s and email = %s
-                         """,
-                         (user_id, username))
-            result = curs.fetchone()
+        async with database.acquire() as conn:
+            # Set the user as activated if every condition holds
+            activated = await repository.activate_user(conn, user_id, username, code,
+                                                       Settings.CODE_VALIDITY_PERIOD_SECS)
+            if not activated:
+                # Find out why only on the failure path
+                result = await repository.get_activation(conn, user_id, username)
+    except asyncpg.PostgresError as error:
+        logger.error(error)
+        raise HTTPException(status_code=500, detail="An error has occured") from error
+
+    if not activated:
         if result is None:
             raise HTTPException(status_code=404, detail="The user was not found")
         if result['code'] != code:
             raise HTTPException(status_code=400, detail="The code provided is incorrect")
         if result['is_activated']:
             raise HTTPException(status_code=400, detail="The user is already activated")
-        if result['delay'] >= Settings.CODE_VALIDITY_PERIOD_SECS:
-            raise HTTPException(status_code=400, detail="The code is no longer available")
-        with conn.cursor(cursor_factory=RealDictCursor) as curs:
-            # Set the user as activated
-            curs.execute("UPDATE public.users SET is_activated = true WHERE id = %s",
-                         (user_id,))
-            conn.commit()
-    except (psycopg2.DatabaseError) as error:
-        logger.error(error)
-        raise HTTPException(status_code=500, detail="An error has occured") from error
-    finally:
-        postgreSQL_pool.putconn(conn)
+        raise HTTPException(status_code=400, detail="The code is no longer available")
 
+    credentials_cache.invalidate(username)
+    user_responses.invalidate(user_id)
+    database.mark_written(username)
+    remember_write(response)
     return {"message": "User activated"}
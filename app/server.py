@@ -0,0 +1,232 @@
+""" Production server pre-forking several workers
+
+python -m app.server imports the app once, binds the socket and forks
+SERVER_WORKERS workers sharing it, the core count by default. The connection
+and hashing budgets, POSTGRES_MAX_CONNECTIONS, POSTGRES_REPLICA_MAX_CONNECTIONS
+and HASHING_WORKERS, are for the whole server and split evenly between workers.
+
+The pending migrations are applied once before forking, so the workers
+starting together find the schema up to date.
+
+SIGHUP recycles the workers one at a time, the next one is stopped once the
+previous one is replaced, so the connection budget holds meanwhile. The new
+workers are forked from the app loaded at startup: neither the code nor the
+settings are reloaded, the server must be restarted to deploy. SIGTERM and
+SIGINT stop every worker gracefully. A worker exits after SERVER_MAX_REQUESTS
+requests, plus a random jitter so they do not all exit together, and is replaced.
+"""
+import asyncio
+import os
+import random
+import signal
+import tempfile
+import time
+
+# Settings of the launcher, the app reads its own once the budgets are split
+SERVER_HOST: str = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT: int = int(os.environ.get('SERVER_PORT', 8000))
+SERVER_MAX_REQUESTS: int = int(os.environ.get('SERVER_MAX_REQUESTS', 0))
+SERVER_MAX_REQUESTS_JITTER: int = int(os.environ.get('SERVER_MAX_REQUESTS_JITTER',
+                                                     SERVER_MAX_REQUESTS // 10))
+SERVER_GRACEFUL_TIMEOUT_SECS: float = float(os.environ.get('SERVER_GRACEFUL_TIMEOUT_SECS', 30))
+
+# Exit code of a worker whose lifespan startup failed
+STARTUP_FAILURE = 3
+# Delay before replacing a worker that failed, so a broken app is not forked in a loop
+RESPAWN_DELAY_SECS: float = 1.0
+# Time left to the lifespan shutdown after the graceful timeout, before SIGKILL
+KILL_MARGIN_SECS: float = 10.0
+TICK_SECS: float = 0.2
+
+
+def plan(environ, cpu_count: int):
+    """ Number of workers and the settings splitting the budgets between them """
+    workers = max(1, int(environ.get('SERVER_WORKERS') or cpu_count))
+    connections = int(environ.get('POSTGRES_MAX_CONNECTIONS', 20))
+    # Every worker needs a connection, never go over the budget
+    workers = min(workers, max(1, connections))
+
+    def share(name, default):
+        return str(max(1, int(environ.get(name, default)) // workers))
+
+    overrides = {'POSTGRES_MAX_CONNECTIONS': share('POSTGRES_MAX_CONNECTIONS', 20),
+                 'HASHING_WORKERS': share('HASHING_WORKERS', cpu_count)}
+    if 'POSTGRES_REPLICA_MAX_CONNECTIONS' in environ:
+        overrides['POSTGRES_REPLICA_MAX_CONNECTIONS'] = share(
+            'POSTGRES_REPLICA_MAX_CONNECTIONS', 20)
+    overrides['POSTGRES_MIN_CONNECTIONS'] = str(min(
+        int(environ.get('POSTGRES_MIN_CONNECTIONS', 1)),
+        int(overrides['POSTGRES_MAX_CONNECTIONS'])))
+    if workers > 1 and not environ.get('METRICS_DIR'):
+        overrides['METRICS_DIR'] = os.path.join(tempfile.gettempdir(), 'fastapi-api-metrics')
+    return workers, overrides
+
+def request_limit():
+    """ Requests served by a new worker before it is replaced, None for no limit """
+    if SERVER_MAX_REQUESTS <= 0:
+        return None
+    return SERVER_MAX_REQUESTS + random.randint(0, SERVER_MAX_REQUESTS_JITTER)
+
+def run_worker(config, sockets):
+    """ Serve in a forked worker, return its exit code """
+    import uvicorn
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    # The activation codes come from random, workers must not share its state
+    random.seed()
+    server = uvicorn.Server(config)
+    server.run(sockets=sockets)
+    return 0 if server.started else STARTUP_FAILURE
+
+
+class Arbiter:
+    """ Keep the workers running and replace them when they exit """
+    def __init__(self, config, sockets, count: int, logger, metrics):
+        self.config = config
+        self.sockets = sockets
+        self.count = count
+        self.logger = logger
+        self.metrics = metrics
+        # pid -> time.monotonic() of its SIGKILL once asked to stop, None while serving
+        self.workers = {}
+        self.restarting = []
+        self.stopping = False
+        self.spawn_after = 0.0
+
+    def spawn(self):
+        """ Fork a worker """
+        limit = request_limit()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = None
+            return
+        from .internal.log_config import stop_listener
+        code = 1
+        try:
+            self.config.limit_max_requests = limit
+            code = run_worker(self.config, self.sockets)
+        except BaseException as error:
+            self.logger.exception(error)
+        finally:
+            # Nothing of the master runs in the worker, not even its atexit handlers
+            stop_listener()
+            os._exit(code)
+
+    def terminate(self, pid: int):
+        """ Ask a worker to finish its requests and exit """
+        self.workers[pid] = time.monotonic() + SERVER_GRACEFUL_TIMEOUT_SECS + KILL_MARGIN_SECS
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        """ Forget the exited workers """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            code = os.waitstatus_to_exitcode(status)
+            expected = self.workers.pop(pid, None) is not None
+            self.metrics.archive(pid)
+            if code == 0 or expected:
+                self.logger.info("Worker %s exited", pid)
+            else:
+                self.logger.error("Worker %s exited with %s", pid, code)
+                self.spawn_after = time.monotonic() + RESPAWN_DELAY_SECS
+
+    def kill_overdue(self):
+        """ Kill the workers still running past their graceful timeout """
+        now = time.monotonic()
+        for pid, kill_at in self.workers.items():
+            if kill_at is not None and now > kill_at:
+                self.logger.error("Worker %s did not stop in time, killing it", pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def restart_next(self):
+        """ Stop the next worker to recycle once the previous one is replaced """
+        if len(self.workers) < self.count or any(kill_at is not None
+                                                for kill_at in self.workers.values()):
+            return
+        while self.restarting:
+            pid = self.restarting.pop(0)
+            if pid in self.workers:
+                self.terminate(pid)
+                return
+
+    def handle_stop(self, sig, frame):
+        """ SIGTERM or SIGINT """
+        if not self.stopping:
+            self.stopping = True
+            for pid, kill_at in self.workers.items():
+                if kill_at is None:
+                    self.terminate(pid)
+
+    def handle_restart(self, sig, frame):
+        """ SIGHUP """
+        if self.stopping:
+            return
+        self.logger.info("Recycling %s workers, the code is not reloaded", len(self.workers))
+        self.restarting = list(self.workers)
+
+    def run(self):
+        """ Supervise the workers until they all stopped """
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        while self.tick():
+            time.sleep(TICK_SECS)
+
+    def tick(self):
+        """ Reap, replace and stop workers, return False once stopped """
+        self.reap()
+        if self.stopping:
+            if not self.workers:
+                return False
+        else:
+            self.restart_next()
+            while len(self.workers) < self.count and time.monotonic() >= self.spawn_after:
+                self.spawn()
+        self.kill_overdue()
+        return True
+
+
+def main():
+    """ Split the budgets, import the app once and fork the workers """
+    workers, overrides = plan(os.environ, os.cpu_count() or 1)
+    os.environ.update(overrides)
+    # Imported after the budgets are split, the workers start from this loaded app
+    import asyncpg
+    import uvicorn
+    from .database.database import database
+    from .internal.log_config import logger
+    from .internal.metrics import metrics
+    from .main import app
+
+    config = uvicorn.Config(app, host=SERVER_HOST, port=SERVER_PORT,
+                            timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT_SECS)
+    config.load()
+    sock = config.bind_socket()
+    metrics.clear()
+    # The workers would all wait for the migrations lock, whichever gets it first
+    try:
+        asyncio.run(database.migrate_once())
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError,
+            asyncio.TimeoutError) as error:
+        logger.error("Migrations left to the workers: %s", error)
+    logger.info("Starting %s workers with %s connections each", workers,
+                overrides['POSTGRES_MAX_CONNECTIONS'])
+    try:
+        Arbiter(config, [sock], workers, logger, metrics).run()
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    main()
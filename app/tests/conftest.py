@@ -1,41 +1,84 @@
-""" Configuration file for pytest """
+""" Configuration file for pytest
+
+The migrations run once on a template database, then every pytest-xdist worker
+gets its own copy of it, so workers never see the rows of each other.
+"""
+import asyncio
 import os
+import asyncpg
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 
+TEMPLATE_DB = "fastapi_db_template"
+
 os.environ["TEST"] = "True"
-os.environ["TESTING_DB"] = "fastapi_db_test"
+# One database per xdist worker, "gw0", "gw1"... or "main" without xdist
+os.environ["TESTING_DB"] = f"fastapi_db_test_{os.environ.get('PYTEST_XDIST_WORKER', 'main')}"
+# Tests run the purge themselves, the background one would delete their users
+os.environ["PURGE_ENABLED"] = "false"
+# The cheapest bcrypt cost, the tests check the logic and not the cost
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+def _admin_connection():
+    """ Connection to the main database to create and drop the test ones """
+    con = psycopg2.connect(
+        dbname=os.environ.get('POSTGRES_DB'),
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=os.environ.get('POSTGRES_PORT'),
+        host=os.environ.get('POSTGRES_HOST'))
+    con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    return con
+
+async def _migrate_template():
+    """ Apply the migrations to the template database """
+    # Imported once the environment above is set, the settings are read on import
+    from ..database.migrations import migrate
+    conn = await asyncpg.connect(
+        database=TEMPLATE_DB,
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=os.environ.get('POSTGRES_PORT'),
+        host=os.environ.get('POSTGRES_HOST'))
+    try:
+        await migrate(conn)
+        # Ids of created users stay away from the fixed ids of the fixtures
+        await conn.execute("ALTER SEQUENCE public.users_id_seq RESTART WITH 1000")
+    finally:
+        await conn.close()
+
+def _is_controller(config):
+    """ True for the process distributing the tests to xdist workers """
+    return not hasattr(config, "workerinput") and bool(getattr(config.option, "numprocesses", 0))
 
 def pytest_configure(config):
-    """ Create test database before everything """
+    """ Create the template once and the database of this worker """
     try:
-        con = psycopg2.connect(
-            dbname=os.environ.get('POSTGRES_DB'),
-            user=os.environ.get('POSTGRES_USER'),
-            password=os.environ.get('POSTGRES_PASSWORD'),
-            port=os.environ.get('POSTGRES_PORT'),
-            host=os.environ.get('POSTGRES_HOST'))
-        con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        con = _admin_connection()
         cur = con.cursor()
-        cur.execute("CREATE DATABASE fastapi_db_test OWNER fastapi_db")
+        if not hasattr(config, "workerinput"):
+            cur.execute(f"DROP DATABASE IF EXISTS {TEMPLATE_DB} WITH (FORCE)")
+            cur.execute(f"CREATE DATABASE {TEMPLATE_DB} OWNER fastapi_db")
+            asyncio.run(_migrate_template())
+        if not _is_controller(config):
+            cur.execute(f"DROP DATABASE IF EXISTS {os.environ['TESTING_DB']} WITH (FORCE)")
+            cur.execute(f"CREATE DATABASE {os.environ['TESTING_DB']} "
+                        f"TEMPLATE {TEMPLATE_DB} OWNER fastapi_db")
         cur.close()
         con.close()
-    except (psycopg2.DatabaseError) as error:
+    except (psycopg2.DatabaseError, asyncpg.PostgresError, OSError) as error:
         print(error)
 
 def pytest_unconfigure(config):
-    """ Drop test database after tests """
+    """ Drop the database of this worker, and the template once every worker is done """
     try:
-        con = psycopg2.connect(
-            dbname=os.environ.get('POSTGRES_DB'),
-            user=os.environ.get('POSTGRES_USER'),
-            password=os.environ.get('POSTGRES_PASSWORD'),
-            port=os.environ.get('POSTGRES_PORT'),
-            host=os.environ.get('POSTGRES_HOST'))
-        con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        con = _admin_connection()
         cur = con.cursor()
-        cur.execute("DROP DATABASE fastapi_db_test WITH (FORCE)")
+        if not _is_controller(config):
+            cur.execute(f"DROP DATABASE IF EXISTS {os.environ['TESTING_DB']} WITH (FORCE)")
+        if not hasattr(config, "workerinput"):
+            cur.execute(f"DROP DATABASE IF EXISTS {TEMPLATE_DB} WITH (FORCE)")
         cur.close()
         con.close()
     except (psycopg2.DatabaseError) as error:
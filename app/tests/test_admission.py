@@ -0,0 +1,93 @@
+""" Test admission control of the database checkouts """
+import asyncio
+import pytest
+from ..database.admission import AdaptiveLimiter, AdmissionRejectedError
+
+
+class TestAdaptiveLimiter:
+    """ Tests for the adaptive concurrency limit """
+    def test_queue_is_fifo(self):
+        """ Test waiters get the released slots in arrival order """
+        limiter = AdaptiveLimiter(1, 1, 10, 2)
+        order = []
+
+        async def checkout(name):
+            await limiter.acquire(1)
+            order.append(name)
+
+        async def scenario():
+            await limiter.acquire(1)
+            waiters = [asyncio.create_task(checkout(name)) for name in ("first", "second")]
+            await asyncio.sleep(0)
+            assert limiter.queue_length == 2
+            limiter.release(0.01)
+            await asyncio.sleep(0)
+            limiter.release(0.01)
+            await asyncio.gather(*waiters)
+
+        asyncio.run(scenario())
+        assert order == ["first", "second"]
+        assert limiter.queued == 2
+        assert limiter.in_flight == 1
+
+    def test_shed_and_timeout(self):
+        """ Test a full queue sheds at once and a waiter gives up at its deadline """
+        limiter = AdaptiveLimiter(1, 1, 1, 2)
+
+        async def scenario():
+            await limiter.acquire(1)
+            waiter = asyncio.create_task(limiter.acquire(0.05))
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejectedError):
+                await limiter.acquire(1)
+            with pytest.raises(AdmissionRejectedError):
+                await waiter
+
+        asyncio.run(scenario())
+        assert limiter.shed == 1
+        assert limiter.timed_out == 1
+        assert limiter.queue_length == 0
+
+    def test_shed_when_expected_wait_exceeds_deadline(self):
+        """ Test a checkout that cannot be served in time is refused without waiting """
+        limiter = AdaptiveLimiter(1, 1, 10, 2)
+
+        async def scenario():
+            await limiter.acquire(1)
+            limiter.release(1.0)
+            await limiter.acquire(1)
+            with pytest.raises(AdmissionRejectedError):
+                await limiter.acquire(0.1)
+
+        asyncio.run(scenario())
+        assert limiter.shed == 1
+
+    def test_cancelled_waiter(self):
+        """ Test a cancelled waiter leaves the queue """
+        limiter = AdaptiveLimiter(1, 1, 10, 2)
+
+        async def scenario():
+            await limiter.acquire(1)
+            waiter = asyncio.create_task(limiter.acquire(1))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            assert limiter.queue_length == 0
+            limiter.release()
+
+        asyncio.run(scenario())
+        assert limiter.in_flight == 0
+
+    def test_limit_adapts_to_latency(self):
+        """ Test the limit shrinks when queries slow down and grows back when they recover """
+        limiter = AdaptiveLimiter(20, 2, 10, 2)
+        for _ in range(20):
+            limiter.observe("get_credentials", 0.001)
+        assert limiter.limit == 20
+        for _ in range(20):
+            limiter.observe("get_credentials", 0.01)
+        assert limiter.limit == 18
+        for _ in range(200):
+            limiter.observe("get_credentials", 0.001)
+        assert limiter.limit == 20
@@ -0,0 +1,57 @@
+""" Test verified credentials cache """
+from datetime import datetime
+import time
+from ..models.users import Principal
+from ..utils.credentials_cache import CredentialsCache
+
+PRINCIPAL = Principal(id=100, email="test@test.fr", created_at=datetime.now(), is_activated=False)
+
+
+class TestCredentialsCache:
+    """ Tests for the credentials cache """
+    def test_hit_and_miss(self):
+        """ Test only verified credentials hit """
+        cache = CredentialsCache(60, 1024 * 1024)
+        assert cache.get("test@test.fr", "testpassword") is None
+        cache.put("test@test.fr", "testpassword", PRINCIPAL)
+        assert cache.get("test@test.fr", "testpassword") == PRINCIPAL
+        assert cache.get("test@test.fr", "wrongpassword") is None
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 2
+
+    def test_expired_entry(self):
+        """ Test entries expire after the TTL """
+        cache = CredentialsCache(0.01, 1024 * 1024)
+        cache.put("test@test.fr", "testpassword", PRINCIPAL)
+        time.sleep(0.02)
+        assert cache.get("test@test.fr", "testpassword") is None
+        assert cache.stats()['entries'] == 0
+
+    def test_invalidate(self):
+        """ Test every entry of a user is evicted """
+        cache = CredentialsCache(60, 1024 * 1024)
+        cache.put("test@test.fr", "testpassword", PRINCIPAL)
+        cache.put("test@test.fr", "otherpassword", PRINCIPAL)
+        cache.put("test@test.com", "testpassword", PRINCIPAL)
+        cache.invalidate("test@test.fr")
+        assert cache.get("test@test.fr", "testpassword") is None
+        assert cache.get("test@test.fr", "otherpassword") is None
+        assert cache.get("test@test.com", "testpassword") == PRINCIPAL
+
+    def test_memory_ceiling(self):
+        """ Test least recently used entries are evicted past the ceiling """
+        cache = CredentialsCache(60, 1500)
+        for i in range(3):
+            cache.put(f"test{i}@test.fr", "testpassword", PRINCIPAL)
+        cache.get("test0@test.fr", "testpassword")
+        cache.put("test3@test.fr", "testpassword", PRINCIPAL)
+        assert cache.stats()['size_bytes'] <= 1500
+        assert cache.get("test0@test.fr", "testpassword") is not None
+        assert cache.get("test1@test.fr", "testpassword") is None
+        assert cache.stats()['evictions'] >= 1
+
+    def test_disabled(self):
+        """ Test a cache without memory never stores anything """
+        cache = CredentialsCache(60, 0)
+        cache.put("test@test.fr", "testpassword", PRINCIPAL)
+        assert cache.get("test@test.fr", "testpassword") is None
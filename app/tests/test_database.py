@@ -0,0 +1,86 @@
+""" Test the connection checkouts """
+import asyncio
+import time
+import pytest
+from ..config.config import Settings
+from ..database.admission import AdaptiveLimiter
+from ..database.database import Database, PoolTimeoutError
+from ..internal.deadline import DeadlineExceededError, current_deadline
+
+
+class FakePool:
+    """ Pool lending itself as the connection, its checkouts time out when exhausted """
+    def __init__(self, exhausted=False):
+        self.exhausted = exhausted
+
+    async def acquire(self, timeout):
+        """ Wait until the timeout when exhausted """
+        if self.exhausted:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        return self
+
+    async def fetchval(self, query, timeout=None):
+        """ Answer the health check query """
+        return 1
+
+    async def release(self, conn):
+        """ Nothing to give back """
+
+
+def ready_database(pool, admission=None):
+    """ Database ready with a fake pool """
+    database = Database()
+    database.pool = pool
+    database.admission = admission
+    database._ready = asyncio.Event()
+    database._ready.set()
+    return database
+
+
+async def checkout(database, deadline_secs=None):
+    """ Check a connection out under a request deadline """
+    if deadline_secs is not None:
+        current_deadline.set(time.monotonic() + deadline_secs)
+    async with database.acquire() as conn:
+        return conn
+
+
+class TestAcquire:
+    """ Tests for the errors of the checkouts """
+    def test_exhausted_pool(self, monkeypatch):
+        """ Test a wait running out of the acquire timeout is an exhausted pool """
+        monkeypatch.setattr(Settings, "POSTGRES_ACQUIRE_TIMEOUT_SECS", 0.01)
+        with pytest.raises(PoolTimeoutError):
+            asyncio.run(checkout(ready_database(FakePool(exhausted=True)), deadline_secs=5))
+
+    def test_wait_cut_by_deadline(self, monkeypatch):
+        """ Test a wait running out of the request deadline is a deadline exceeded """
+        monkeypatch.setattr(Settings, "POSTGRES_ACQUIRE_TIMEOUT_SECS", 5)
+        with pytest.raises(DeadlineExceededError):
+            asyncio.run(checkout(ready_database(FakePool(exhausted=True)), deadline_secs=0.01))
+
+    def test_admission_wait_cut_by_deadline(self, monkeypatch):
+        """ Test a wait for an admission slot running out of the request deadline """
+        monkeypatch.setattr(Settings, "POSTGRES_ACQUIRE_TIMEOUT_SECS", 5)
+        admission = AdaptiveLimiter(1, 1, 10, 2)
+        database = ready_database(FakePool(), admission)
+
+        async def scenario():
+            await admission.acquire(1)
+            await checkout(database, deadline_secs=0.01)
+
+        with pytest.raises(DeadlineExceededError):
+            asyncio.run(scenario())
+
+    def test_health_check_skips_admission(self):
+        """ Test the health check is answered while requests hold every admission slot """
+        admission = AdaptiveLimiter(1, 1, 0, 2)
+        database = ready_database(FakePool(), admission)
+
+        async def scenario():
+            await admission.acquire(1)
+            return await database.check_health()
+
+        assert asyncio.run(scenario())
+        assert admission.in_flight == 1
@@ -0,0 +1,89 @@
+""" Test request deadlines and cancellation on disconnect """
+import asyncio
+import time
+import pytest
+from ..config.config import Settings
+from ..internal.deadline import (DeadlineExceededError, DeadlineMiddleware, current_deadline,
+                                 remaining, request_timeout)
+
+
+def http_scope(method="GET", path="/user/1", headers=()):
+    """ Scope of an HTTP request """
+    return {"type": "http", "method": method, "path": path, "headers": list(headers)}
+
+
+class TestDeadline:
+    """ Tests for the deadline of a request """
+    def test_request_timeout(self, monkeypatch):
+        """ Test the header is capped and routes have their own default """
+        monkeypatch.setattr(Settings, "REQUEST_TIMEOUT_SECS", 30)
+        monkeypatch.setattr(Settings, "REQUEST_MAX_TIMEOUT_SECS", 600)
+        monkeypatch.setattr(Settings, "REQUEST_ROUTE_TIMEOUTS",
+                            {"GET /users": 600, "GET /users/slow": 900})
+        assert request_timeout(http_scope()) == 30
+        assert request_timeout(http_scope(path="/users")) == 600
+        assert request_timeout(http_scope(path="/users/slow/1")) == 900
+        assert request_timeout(http_scope(headers=[(b"x-request-timeout", b"2.5")])) == 2.5
+        assert request_timeout(http_scope(headers=[(b"x-request-timeout", b"9999")])) == 600
+        assert request_timeout(http_scope(headers=[(b"x-request-timeout", b"soon")])) == 30
+
+    def test_remaining(self):
+        """ Test the time left is reported until the deadline is over """
+        token = current_deadline.set(time.monotonic() + 10)
+        assert 9 < remaining() <= 10
+        current_deadline.set(time.monotonic() - 1)
+        with pytest.raises(DeadlineExceededError):
+            remaining()
+        current_deadline.reset(token)
+        assert remaining() is None
+
+    def test_cancel_on_disconnect(self):
+        """ Test the app is cancelled when the client goes away before the response """
+        cancelled = []
+
+        async def slow_app(scope, receive, send):
+            assert remaining() is not None
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def receive():
+            await asyncio.sleep(0.01)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            raise AssertionError("Nothing is sent to a client that is gone")
+
+        asyncio.run(asyncio.wait_for(DeadlineMiddleware(slow_app)(http_scope(), receive, send), 1))
+        assert cancelled == [True]
+
+    def test_body_is_forwarded(self):
+        """ Test the app reads the body chunks in order and its response completes """
+        chunks = [{"type": "http.request", "body": b"[1,", "more_body": True},
+                  {"type": "http.request", "body": b"2]", "more_body": False}]
+        sent = []
+
+        async def echo_app(scope, receive, send):
+            body = b""
+            while True:
+                message = await receive()
+                body += message["body"]
+                if not message["more_body"]:
+                    break
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": body})
+
+        async def receive():
+            if chunks:
+                return chunks.pop(0)
+            await asyncio.sleep(10)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asyncio.wait_for(
+            DeadlineMiddleware(echo_app)(http_scope("POST", "/users/bulk"), receive, send), 1))
+        assert sent[-1]["body"] == b"[1,2]"
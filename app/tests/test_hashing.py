@@ -0,0 +1,62 @@
+""" Test password hashing service """
+import asyncio
+import pytest
+from ..utils.hashing import HashingQueueFullError, PasswordHasher
+from ..utils.helpers import calibrate_rounds, hash_password, hash_rounds
+
+
+class TestPasswordHasher:
+    """ Tests for the bcrypt worker pool """
+    def test_hash_and_check_password(self):
+        """ Test a hashed password can be checked """
+        hasher = PasswordHasher('thread', 2, 4)
+
+        async def scenario():
+            hashed_password = await hasher.hash_password('testpassword')
+            assert await hasher.check_password('testpassword', hashed_password) is True
+            assert await hasher.check_password('wrongpassword', hashed_password) is False
+
+        asyncio.run(scenario())
+        hasher.shutdown()
+        assert hasher.pending == 0
+
+    def test_queue_full(self):
+        """ Test jobs are refused once the queue is full """
+        hasher = PasswordHasher('thread', 1, 0)
+
+        async def scenario():
+            first = asyncio.ensure_future(hasher.hash_password('testpassword'))
+            await asyncio.sleep(0)
+            with pytest.raises(HashingQueueFullError):
+                await hasher.hash_password('otherpassword')
+            await first
+
+        asyncio.run(scenario())
+        hasher.shutdown()
+        assert hasher.pending == 0
+
+    def test_rehash_with_configured_cost(self):
+        """ Test hashes of another cost are detected and made again with the configured one """
+        hasher = PasswordHasher('thread', 1, 0, rounds=4)
+        old_hash = hash_password('testpassword', 5)
+        assert hasher.needs_rehash(old_hash)
+
+        async def scenario():
+            new_hash = await hasher.rehash_password('testpassword')
+            assert hash_rounds(new_hash) == 4
+            assert not hasher.needs_rehash(new_hash)
+            assert await hasher.check_password('testpassword', new_hash) is True
+            # A busy pool skips the rehash instead of queuing it
+            first = asyncio.ensure_future(hasher.hash_password('otherpassword'))
+            await asyncio.sleep(0)
+            assert await hasher.rehash_password('testpassword') is None
+            await first
+
+        asyncio.run(scenario())
+        hasher.shutdown()
+
+    def test_calibrate_rounds(self):
+        """ Test the cost stays within its bounds """
+        assert calibrate_rounds(0, 4, 6) == 4
+        assert calibrate_rounds(3600, 4, 6) == 6
+
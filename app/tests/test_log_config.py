@@ -0,0 +1,28 @@
+""" Test queued logging """
+import logging
+import queue
+from ..internal.log_config import BoundedQueueHandler, JSONFormatter
+
+
+class TestBoundedQueueHandler:
+    """ Tests for the bounded queue handler """
+    def test_drop_when_full(self):
+        """ Test records are dropped and counted once the queue is full """
+        handler = BoundedQueueHandler(queue.Queue(maxsize=1), block=False)
+        test_logger = logging.getLogger('test_drop_when_full')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        test_logger.warning("first %s", "record")
+        test_logger.warning("second record")
+        assert handler.dropped == 1
+        record = handler.queue.get_nowait()
+        assert record.msg == "first record"
+        assert record.args is None
+
+    def test_json_format(self):
+        """ Test a record is formatted on one JSON line """
+        record = logging.makeLogRecord({"name": "simple_example", "levelname": "INFO",
+                                        "msg": "Created %s", "args": ("user",)})
+        line = JSONFormatter().format(record)
+        assert "\n" not in line
+        assert '"message":"Created user"' in line
@@ -10,3 +10,17 @@ def test_get_main():
     response = client.get("/")
     assert response.status_code == 200
     assert response.json() == {"message": "ok"}
+
+
+def test_healthz():
+    """ Test liveness does not need the database """
+    response = client.get("/healthz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+def test_readyz_before_startup():
+    """ Test readiness fails until the database is initialized """
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json() == {"status": "not ready"}
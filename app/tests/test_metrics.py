@@ -0,0 +1,54 @@
+""" Test metrics registry """
+import json
+import os
+from ..internal.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry:
+    """ Tests for metrics collection and merge across workers """
+    def test_render_histogram(self):
+        """ Test histogram buckets are cumulative """
+        registry = MetricsRegistry()
+        histogram = registry.histogram("latency_seconds", "Latency", ("route",), (0.1, 1.0))
+        histogram.labels("/").observe(0.05)
+        histogram.labels("/").observe(0.5)
+        histogram.labels("/").observe(5)
+        text = registry.render()
+        assert 'latency_seconds_bucket{route="/",le="0.1"} 1' in text
+        assert 'latency_seconds_bucket{route="/",le="1.0"} 2' in text
+        assert 'latency_seconds_bucket{route="/",le="+Inf"} 3' in text
+        assert 'latency_seconds_count{route="/"} 3' in text
+
+    def test_merge_workers(self, tmp_path):
+        """ Test counters of every worker are summed and gauges of exited ones dropped """
+        registry = MetricsRegistry(str(tmp_path))
+        counter = registry.counter("requests_total", "Requests")
+        registry.callback("pool_connections", "Connections", lambda: [((), 2)])
+        counter.inc(3)
+        registry.flush()
+        snapshot = json.loads((tmp_path / f"metrics-{os.getpid()}.json").read_text())
+        # A worker that exited with the same metrics
+        snapshot['pid'] = 2 ** 22 + 1
+        (tmp_path / f"metrics-{snapshot['pid']}.json").write_text(json.dumps(snapshot))
+        text = registry.render()
+        assert "requests_total 6" in text
+        assert "pool_connections 2" in text
+
+    def test_archive_exited_worker(self, tmp_path):
+        """ Test the counters of an exited worker are kept once its file is merged """
+        registry = MetricsRegistry(str(tmp_path))
+        counter = registry.counter("requests_total", "Requests")
+        registry.callback("pool_connections", "Connections", lambda: [((), 2)])
+        counter.inc(3)
+        registry.flush()
+        snapshot = json.loads((tmp_path / f"metrics-{os.getpid()}.json").read_text())
+        for pid in (2 ** 22 + 1, 2 ** 22 + 2):
+            snapshot['pid'] = pid
+            (tmp_path / f"metrics-{pid}.json").write_text(json.dumps(snapshot))
+            registry.archive(pid)
+        assert set(os.listdir(tmp_path)) == {"metrics-exited.json", f"metrics-{os.getpid()}.json"}
+        text = registry.render()
+        assert "requests_total 9" in text
+        assert "pool_connections 2" in text
+        registry.clear()
+        assert not os.listdir(tmp_path)
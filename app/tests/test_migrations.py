@@ -0,0 +1,96 @@
+""" Test schema migrations """
+import asyncio
+from contextlib import asynccontextmanager
+from ..database import migrations
+from ..database.migrations import MIGRATIONS, Migration, cover_users_email, migrate
+
+
+class FakeConnection:
+    """ Connection recording statements, with a version table in memory """
+    def __init__(self, versions=None, busy_tries=0):
+        self.versions = versions
+        self.busy_tries = busy_tries
+        self.statements = []
+
+    async def fetchval(self, sql, *args):
+        """ Answer the version and lock queries """
+        if "pg_try_advisory_lock" in sql:
+            self.statements.append(sql)
+            self.busy_tries -= 1
+            return self.busy_tries < 0
+        if "to_regclass" in sql:
+            return self.versions is not None
+        return max(self.versions, default=0)
+
+    async def execute(self, sql, *args):
+        """ Record a statement """
+        self.statements.append(sql.strip())
+        if sql.strip().startswith("CREATE TABLE IF NOT EXISTS public.schema_migrations"):
+            self.versions = self.versions or []
+        if sql.startswith("INSERT INTO public.schema_migrations"):
+            self.versions.append(args[0])
+
+    @asynccontextmanager
+    async def transaction(self):
+        """ Record the transaction boundaries """
+        self.statements.append("BEGIN")
+        yield
+        self.statements.append("COMMIT")
+
+
+MIGRATIONS_FOR_TEST = [Migration(1, "first", "CREATE first"),
+                       Migration(2, "second", "CREATE second", "CREATE third",
+                                 before=("CREATE INDEX CONCURRENTLY fourth",))]
+
+
+class TestMigrations:
+    """ Tests for the migrations runner """
+    def test_versions_are_ordered(self):
+        """ Test versions increase without gaps """
+        assert [migration.version for migration in MIGRATIONS] == list(
+            range(1, len(MIGRATIONS) + 1))
+
+    def test_apply_pending_under_lock(self):
+        """ Test pending migrations run in order, each in a transaction with its version """
+        conn = FakeConnection(versions=[1])
+        assert asyncio.run(migrate(conn, MIGRATIONS_FOR_TEST)) == 1
+        assert conn.versions == [1, 2]
+        assert conn.statements[:2] == ["SELECT pg_try_advisory_lock($1)",
+                                       "SET statement_timeout = 0"]
+        assert conn.statements[3:] == [
+            "CREATE INDEX CONCURRENTLY fourth", "BEGIN", "CREATE second", "CREATE third",
+            "INSERT INTO public.schema_migrations (version, name) VALUES ($1, $2)", "COMMIT",
+            "SELECT pg_advisory_unlock($1)"]
+
+    def test_empty_database(self):
+        """ Test every migration is applied on a new database """
+        conn = FakeConnection()
+        assert asyncio.run(migrate(conn, MIGRATIONS_FOR_TEST)) == 2
+        assert conn.versions == [1, 2]
+
+    def test_lock_tried_again(self, monkeypatch):
+        """ Test a busy lock is tried again instead of waited for in a query """
+        monkeypatch.setattr(migrations, "MIGRATIONS_LOCK_RETRY_SECS", 0)
+        conn = FakeConnection(versions=[1], busy_tries=2)
+        assert asyncio.run(migrate(conn, MIGRATIONS_FOR_TEST)) == 1
+        assert conn.statements[:4] == ["SELECT pg_try_advisory_lock($1)"] * 3 + [
+            "SET statement_timeout = 0"]
+
+    def test_up_to_date_without_lock(self):
+        """ Test an up to date database takes no lock """
+        conn = FakeConnection(versions=[1, 2])
+        assert asyncio.run(migrate(conn, MIGRATIONS_FOR_TEST)) == 0
+        assert not conn.statements
+
+    def test_covering_index_built_concurrently(self):
+        """ Test the covering email constraints take over an index built outside the transaction """
+        migration = cover_users_email(9, "cover", "id", "version",
+                                      before=("ALTER TABLE add version",))
+        assert migration.before == (
+            "ALTER TABLE add version",
+            "DROP INDEX CONCURRENTLY IF EXISTS public.users_email_cover_idx",
+            "CREATE UNIQUE INDEX CONCURRENTLY users_email_cover_idx ON public.users (email) "
+            "INCLUDE (id, version)")
+        assert all("CONCURRENTLY" not in statement and "INCLUDE" not in statement
+                   for statement in migration.statements)
+        assert "UNIQUE USING INDEX users_email_cover_idx" in migration.statements[0]
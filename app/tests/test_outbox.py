@@ -0,0 +1,59 @@
+""" Test activation mail delivery """
+import asyncio
+import json
+from contextlib import asynccontextmanager
+import pytest
+from ..config.config import Settings
+from ..internal import outbox
+from ..internal.mailer import FileTransport, MailTransport
+from ..internal.outbox import backoff_delay, build_mail
+
+
+class FakeDatabase:
+    """ Database lending no connection, the fake queries need none """
+    @asynccontextmanager
+    async def acquire(self):
+        """ No connection """
+        yield None
+
+
+class TestOutbox:
+    """ Tests for outbox helpers and transports """
+    def test_backoff_delay(self):
+        """ Test the delay doubles with each attempt up to the maximum """
+        for attempts, expected in [(1, 2), (2, 4), (3, 8), (10, 60)]:
+            delay = backoff_delay(attempts, 2, 60)
+            assert expected / 2 <= delay <= expected
+
+    def test_incomplete_transport(self):
+        """ Test a transport without send cannot be created """
+        class NoSendTransport(MailTransport):
+            """ Transport missing send """
+
+        with pytest.raises(TypeError):
+            NoSendTransport()
+
+    def test_file_transport(self, tmp_path):
+        """ Test activation mails are appended to the file """
+        message = {"idempotency_key": "activation-100", "kind": "activation",
+                   "recipient": "test@test.fr", "payload": json.dumps({"code": "0042"})}
+        transport = FileTransport(str(tmp_path / "mails.jsonl"))
+        asyncio.run(transport.send(build_mail(message)))
+        lines = (tmp_path / "mails.jsonl").read_text().splitlines()
+        mail = json.loads(lines[0])
+        assert mail['idempotency_key'] == "activation-100"
+        assert mail['to'] == "test@test.fr"
+        assert "0042" in mail['body']
+
+    def test_claim_stops_when_code_expires(self, monkeypatch):
+        """ Test messages are claimed only while the code they carry is valid """
+        calls = []
+
+        async def claim_outbox(conn, limit, lease_secs, max_attempts, max_age_secs):
+            calls.append(max_age_secs)
+            return []
+
+        monkeypatch.setattr(outbox, "database", FakeDatabase())
+        monkeypatch.setattr(outbox.repository, "claim_outbox", claim_outbox)
+        assert asyncio.run(outbox.OutboxWorker().drain_once()) == 0
+        assert calls == [Settings.CODE_VALIDITY_PERIOD_SECS]
@@ -0,0 +1,65 @@
+""" Test the purge of users not activated """
+import asyncio
+from contextlib import asynccontextmanager
+from ..config.config import Settings
+from ..internal import purge
+
+
+class FakeDatabase:
+    """ Database whose pool usage is set by the test """
+    def __init__(self, ratio):
+        self.ratio = ratio
+
+    def in_use_ratio(self):
+        """ Share of the connections in use """
+        return self.ratio
+
+    @asynccontextmanager
+    async def acquire(self):
+        """ No connection is needed by the fake queries """
+        yield None
+
+
+class TestPurgeWorker:
+    """ Tests for the batches of the purge """
+    def test_batches_until_short(self, monkeypatch):
+        """ Test full batches are followed by another one until a short batch """
+        batches = [3, 3, 1]
+        calls = []
+
+        async def purge_users(conn, retention_secs, limit):
+            calls.append((retention_secs, limit))
+            return batches.pop(0)
+
+        monkeypatch.setattr(purge, "database", FakeDatabase(0.0))
+        monkeypatch.setattr(purge.repository, "purge_users", purge_users)
+        monkeypatch.setattr(Settings, "PURGE_BATCH_SIZE", 3)
+        monkeypatch.setattr(Settings, "PURGE_BATCH_PAUSE_SECS", 0)
+        monkeypatch.setattr(Settings, "PURGE_RETENTION_SECS", 1)
+        assert asyncio.run(purge.PurgeWorker().purge()) == 7
+        assert calls == [(Settings.CODE_VALIDITY_PERIOD_SECS, 3)] * 3
+
+    def test_outbox_after_code_validity(self, monkeypatch):
+        """ Test outbox messages are deleted in batches once their code expired """
+        batches = [2, 0]
+        calls = []
+
+        async def purge_outbox(conn, age_secs, limit):
+            calls.append((age_secs, limit))
+            return batches.pop(0)
+
+        monkeypatch.setattr(purge, "database", FakeDatabase(0.0))
+        monkeypatch.setattr(purge.repository, "purge_outbox", purge_outbox)
+        monkeypatch.setattr(Settings, "PURGE_BATCH_SIZE", 2)
+        monkeypatch.setattr(Settings, "PURGE_BATCH_PAUSE_SECS", 0)
+        assert asyncio.run(purge.PurgeWorker().purge_outbox()) == 2
+        assert calls == [(Settings.CODE_VALIDITY_PERIOD_SECS, 2)] * 2
+
+    def test_throttled_when_pool_busy(self, monkeypatch):
+        """ Test nothing is deleted while live traffic holds the connections """
+        async def purge_users(conn, retention_secs, limit):
+            raise AssertionError("The pool is busy")
+
+        monkeypatch.setattr(purge, "database", FakeDatabase(0.9))
+        monkeypatch.setattr(purge.repository, "purge_users", purge_users)
+        assert asyncio.run(purge.PurgeWorker().purge()) == 0
@@ -0,0 +1,89 @@
+""" Test prepared statements registry """
+import asyncio
+import time
+import asyncpg
+import pytest
+from ..database.queries import QueryRegistry
+from ..internal.deadline import DeadlineExceededError, current_deadline
+
+
+class FakeStatement:
+    """ Prepared statement returning its arguments """
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def fetchrow(self, *args, timeout=None):
+        """ Fail once if the connection lost its statements """
+        if timeout is not None and timeout < 1:
+            raise asyncio.TimeoutError()
+        if self.conn.drop_statements:
+            self.conn.drop_statements = False
+            raise asyncpg.InvalidSQLStatementNameError("prepared statement does not exist")
+        return args
+
+
+class FakeConnection:
+    """ Connection counting prepared statements """
+    def __init__(self):
+        self.prepared_statements = {}
+        self.prepare_calls = 0
+        self.drop_statements = False
+
+    async def prepare(self, sql):
+        """ Prepare a fake statement """
+        self.prepare_calls += 1
+        return FakeStatement(self)
+
+
+class TestQueryRegistry:
+    """ Tests for the query registry """
+    def test_prepared_once_per_connection(self):
+        """ Test statements are prepared lazily once per connection """
+        registry = QueryRegistry()
+        query = registry.register("get_user", "SELECT $1")
+        first, second = FakeConnection(), FakeConnection()
+
+        async def scenario():
+            assert await query.fetchrow(first, 1) == (1,)
+            assert await query.fetchrow(first, 2) == (2,)
+            assert await query.fetchrow(second, 3) == (3,)
+
+        asyncio.run(scenario())
+        assert first.prepare_calls == 1
+        assert second.prepare_calls == 1
+        assert registry.stats()['get_user']['calls'] == 3
+        assert registry.stats()['get_user']['prepares'] == 2
+
+    def test_prepared_again_when_dropped(self):
+        """ Test a statement lost by the server is prepared again """
+        registry = QueryRegistry()
+        query = registry.register("get_user", "SELECT $1")
+        conn = FakeConnection()
+
+        async def scenario():
+            await query.fetchrow(conn, 1)
+            conn.drop_statements = True
+            assert await query.fetchrow(conn, 2) == (2,)
+
+        asyncio.run(scenario())
+        assert conn.prepare_calls == 2
+
+    def test_register_twice(self):
+        """ Test a name can only be registered once """
+        registry = QueryRegistry()
+        registry.register("get_user", "SELECT 1")
+        with pytest.raises(ValueError):
+            registry.register("get_user", "SELECT 2")
+
+    def test_cancelled_at_deadline(self):
+        """ Test a query outliving the request deadline is reported as such """
+        registry = QueryRegistry()
+        query = registry.register("get_user", "SELECT $1")
+
+        async def scenario():
+            current_deadline.set(time.monotonic() + 0.5)
+            with pytest.raises(DeadlineExceededError):
+                await query.fetchrow(FakeConnection(), 1)
+
+        asyncio.run(scenario())
+
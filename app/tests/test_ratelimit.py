@@ -0,0 +1,70 @@
+""" Test rate limiting """
+import base64
+from fastapi.testclient import TestClient
+import pytest
+from ..internal.ratelimit import (MemoryBackend, RateLimitBackend, Rule, basic_auth_email,
+                                  rate_limiter)
+from ..main import app
+
+client = TestClient(app)
+
+
+class TestMemoryBackend:
+    """ Tests for the in memory token buckets """
+    def test_burst_then_refill(self):
+        """ Test the burst is spent then tokens come back at the rate """
+        backend = MemoryBackend(100)
+        rule = Rule("ip", 2, 3)
+        assert [backend.take_now(rule, "1.2.3.4", 0)[0] for _ in range(4)] == [
+            True, True, True, False]
+        allowed, retry_after = backend.take_now(rule, "1.2.3.4", 0)
+        assert allowed is False
+        assert retry_after == 0.5
+        assert backend.take_now(rule, "1.2.3.4", 0.5)[0] is True
+        assert backend.take_now(rule, "5.6.7.8", 0)[0] is True
+
+    def test_incomplete_backend(self):
+        """ Test a backend without take cannot be created """
+        class NoTakeBackend(RateLimitBackend):
+            """ Backend missing take """
+
+        with pytest.raises(TypeError):
+            NoTakeBackend()
+
+    def test_memory_bound(self):
+        """ Test least recently used buckets are evicted """
+        backend = MemoryBackend(16, shards=4)
+        rule = Rule("ip", 1, 1)
+        for i in range(100):
+            backend.take_now(rule, str(i), 0)
+        assert backend.size() <= 16
+        assert backend.evictions == 100 - backend.size()
+
+
+class TestRateLimitMiddleware:
+    """ Tests for requests rejected before any database work """
+    def test_basic_auth_email(self):
+        """ Test the email is read from the Basic credentials """
+        encoded = base64.b64encode(b"Test@Test.fr:password")
+        assert basic_auth_email([(b"authorization", b"Basic " + encoded)]) == "test@test.fr"
+        assert basic_auth_email([(b"authorization", b"Basic !!")]) is None
+        assert basic_auth_email([]) is None
+
+    def test_activation_limited(self, monkeypatch):
+        """ Test code guesses are answered 429 without checking the credentials """
+        rate_limiter.reset()
+        monkeypatch.setattr(rate_limiter, "activation_rule", Rule("activation", 1 / 60, 0))
+        response = client.patch("/users/activate/1?code=0000",
+                                auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 429
+        assert response.json() == {"detail": "Too many requests"}
+        assert response.headers['retry-after'] == "60"
+        rate_limiter.reset()
+
+    def test_other_routes_not_limited(self, monkeypatch):
+        """ Test routes that do not check credentials have no bucket """
+        rate_limiter.reset()
+        monkeypatch.setattr(rate_limiter, "ip_rule", Rule("ip", 1, 0))
+        assert client.get("/").status_code == 200
+        assert client.get("/user/1").status_code == 429
+        rate_limiter.reset()
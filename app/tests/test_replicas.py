@@ -0,0 +1,132 @@
+""" Test the routing of reads to the replicas """
+import asyncio
+import pytest
+from ..database.database import Database, PoolTimeoutError
+from ..database.replicas import (RecentWrites, ReplicaBalancer, parse_hosts, sign_write,
+                                 written_within)
+
+
+class FakePool:
+    """ Pool handing out its name as the connection """
+    def __init__(self, name, in_use=0, broken=False, silent=False):
+        self.name = name
+        self.in_use = in_use
+        self.broken = broken
+        self.silent = silent
+
+    def get_size(self):
+        """ Connections opened """
+        return 10
+
+    def get_idle_size(self):
+        """ Connections not checked out """
+        return 10 - self.in_use
+
+    async def acquire(self, timeout):
+        """ Fail like an unreachable server when broken, never answer when silent """
+        if self.broken:
+            raise ConnectionRefusedError("Connection refused")
+        if self.silent:
+            raise asyncio.TimeoutError()
+        return self.name
+
+    async def release(self, conn):
+        """ Nothing to give back """
+
+
+def routed_database(replicas, strategy="round_robin"):
+    """ Database ready with fake pools """
+    database = Database()
+    database.pool = FakePool("primary")
+    database.replicas = replicas
+    database.balancer = ReplicaBalancer(replicas, strategy)
+    return database
+
+
+async def read(database, key=None, recent_write=False):
+    """ Name of the pool a read was sent to """
+    database._ready = asyncio.Event()
+    database._ready.set()
+    async with database.acquire_read(key, recent_write) as conn:
+        return conn
+
+
+class TestReplicas:
+    """ Tests for the replica routing """
+    def test_parse_hosts(self):
+        """ Test the port defaults to the primary one """
+        assert parse_hosts(["replica1", "replica2:5433"], 5432) == [
+            ("replica1", 5432), ("replica2", 5433)]
+
+    def test_recent_writes_expire(self):
+        """ Test a key is only kept for the window """
+        recent_writes = RecentWrites(5)
+        recent_writes.mark("a@test.fr", now=0)
+        assert recent_writes.contains("a@test.fr", now=4)
+        assert not recent_writes.contains("a@test.fr", now=5)
+        recent_writes.mark("b@test.fr", now=6)
+        assert len(recent_writes) == 1
+
+    def test_round_robin(self):
+        """ Test replicas are used in turn """
+        database = routed_database([FakePool("replica1"), FakePool("replica2")])
+        assert [asyncio.run(read(database)) for _ in range(3)] == [
+            "replica1", "replica2", "replica1"]
+
+    def test_least_busy(self):
+        """ Test the replica with the fewest connections in use is used """
+        database = routed_database([FakePool("replica1", in_use=5),
+                                    FakePool("replica2", in_use=1)], "least_busy")
+        assert [asyncio.run(read(database)) for _ in range(2)] == ["replica2", "replica2"]
+
+    def test_read_your_writes(self):
+        """ Test a user just written is read from the primary """
+        database = routed_database([FakePool("replica1")])
+        database.mark_written("test@test.fr")
+        assert asyncio.run(read(database, "test@test.fr")) == "primary"
+        assert asyncio.run(read(database, "other@test.fr")) == "replica1"
+
+    def test_fallback_to_primary(self):
+        """ Test an unreachable replica does not fail the read """
+        database = routed_database([FakePool("replica1", broken=True)])
+        assert asyncio.run(read(database)) == "primary"
+
+    def test_failed_replica_left_out(self):
+        """ Test a replica that failed is not used until the retry delay is over """
+        database = routed_database([FakePool("replica1", broken=True), FakePool("replica2")])
+        assert [asyncio.run(read(database)) for _ in range(3)] == [
+            "primary", "replica2", "replica2"]
+
+    def test_silent_replica_left_out(self):
+        """ Test a replica whose checkout times out gets no more reads """
+        database = routed_database([FakePool("replica1", silent=True)])
+        with pytest.raises(PoolTimeoutError):
+            asyncio.run(read(database))
+        assert asyncio.run(read(database)) == "primary"
+
+    def test_balancer_retries_after_delay(self):
+        """ Test a failed replica is picked again after retry_secs """
+        replica = FakePool("replica1")
+        balancer = ReplicaBalancer([replica], "round_robin", retry_secs=30)
+        balancer.mark_failed(replica, now=0)
+        assert balancer.pick(now=10) is None
+        assert balancer.pick(now=30) is replica
+
+    def test_recent_write_of_the_client(self):
+        """ Test a client that wrote through any worker reads from the primary """
+        database = routed_database([FakePool("replica1")])
+        assert asyncio.run(read(database, "test@test.fr", recent_write=True)) == "primary"
+
+    def test_write_token(self):
+        """ Test only a valid and recent token tells a write """
+        token = sign_write(100, "secret")
+        assert written_within(token, "secret", 5, now=104)
+        assert not written_within(token, "secret", 5, now=105)
+        assert not written_within(token, "other", 5, now=101)
+        assert not written_within(token.replace("100.000", "200.000"), "secret", 5, now=201)
+        assert not written_within(None, "secret", 5)
+
+    def test_malformed_write_token(self):
+        """ Test a malformed or non ASCII cookie is not a recent write """
+        for token in ["1.0.\xe9", "\xe9", "garbage", "1.0.", "."]:
+            assert not written_within(token, "secret", 5, now=1)
@@ -0,0 +1,72 @@
+""" Test user response cache and ETags """
+from datetime import datetime
+import time
+from ..models.users import Principal
+from ..utils.response_cache import ResponseCache, etag_matches, user_etag
+
+PRINCIPAL = Principal(id=100, email="test@test.fr", created_at=datetime.now(), is_activated=False)
+
+
+class TestETags:
+    """ Tests for the ETags of the user responses """
+    def test_etag_changes_with_the_user(self):
+        """ Test the activation and the version change the ETag """
+        etag = user_etag(PRINCIPAL)
+        assert etag == '"100-1-0"'
+        assert user_etag(PRINCIPAL.model_copy(update={"is_activated": True})) != etag
+        assert user_etag(PRINCIPAL.model_copy(update={"version": 2})) != etag
+
+    def test_version_is_not_in_the_response(self):
+        """ Test the version stays out of the body """
+        assert "version" not in PRINCIPAL.model_dump()
+
+    def test_etag_matches(self):
+        """ Test lists, weak ETags and * match """
+        assert etag_matches('"100-1-0"', '"100-1-0"')
+        assert etag_matches('"1-1-0", W/"100-1-0"', '"100-1-0"')
+        assert etag_matches('*', '"100-1-0"')
+        assert not etag_matches('"100-2-1"', '"100-1-0"')
+        assert not etag_matches(None, '"100-1-0"')
+
+
+class TestResponseCache:
+    """ Tests for the user response cache """
+    def test_hit_only_for_the_same_etag(self):
+        """ Test a body is only served for the ETag it was rendered for """
+        cache = ResponseCache(60, 10)
+        assert cache.get(100, '"100-1-0"') is None
+        cache.put(100, '"100-1-0"', b"{}")
+        assert cache.get(100, '"100-1-0"') == b"{}"
+        assert cache.get(100, '"100-2-1"') is None
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_expired_entry(self):
+        """ Test entries expire after the TTL """
+        cache = ResponseCache(0.01, 10)
+        cache.put(100, '"100-1-0"', b"{}")
+        time.sleep(0.02)
+        assert cache.get(100, '"100-1-0"') is None
+
+    def test_invalidate(self):
+        """ Test a change of the user drops its body """
+        cache = ResponseCache(60, 10)
+        cache.put(100, '"100-1-0"', b"{}")
+        cache.invalidate(100)
+        assert cache.get(100, '"100-1-0"') is None
+
+    def test_evicts_least_recently_used(self):
+        """ Test the oldest entry is evicted past the max entries """
+        cache = ResponseCache(60, 2)
+        cache.put(1, '"1-1-0"', b"1")
+        cache.put(2, '"2-1-0"', b"2")
+        cache.get(1, '"1-1-0"')
+        cache.put(3, '"3-1-0"', b"3")
+        assert len(cache) == 2
+        assert cache.get(2, '"2-1-0"') is None
+        assert cache.get(1, '"1-1-0"') == b"1"
+
+    def test_disabled(self):
+        """ Test nothing is kept with a max of 0 entries """
+        cache = ResponseCache(60, 0)
+        cache.put(100, '"100-1-0"', b"{}")
+        assert len(cache) == 0
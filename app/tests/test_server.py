@@ -0,0 +1,186 @@
+""" Test the production server """
+import logging
+import signal
+import time
+from types import SimpleNamespace
+import pytest
+from .. import server
+from ..internal import log_config
+from ..server import plan
+
+
+class TestPlan:
+    """ Tests for the split of the budgets between workers """
+    def test_defaults_to_the_core_count(self):
+        """ Test one worker per core sharing the connections and hashing threads """
+        workers, overrides = plan({'POSTGRES_MAX_CONNECTIONS': '20',
+                                   'METRICS_DIR': '/tmp/metrics'}, 4)
+        assert workers == 4
+        assert overrides['POSTGRES_MAX_CONNECTIONS'] == '5'
+        assert overrides['HASHING_WORKERS'] == '1'
+        assert overrides['POSTGRES_MIN_CONNECTIONS'] == '1'
+        assert 'METRICS_DIR' not in overrides
+
+    def test_never_over_the_connection_budget(self):
+        """ Test there are no more workers than connections """
+        workers, overrides = plan({'SERVER_WORKERS': '8', 'POSTGRES_MAX_CONNECTIONS': '3',
+                                   'POSTGRES_MIN_CONNECTIONS': '2'}, 8)
+        assert workers == 3
+        assert overrides['POSTGRES_MAX_CONNECTIONS'] == '1'
+        assert overrides['POSTGRES_MIN_CONNECTIONS'] == '1'
+
+    def test_replicas_and_metrics(self):
+        """ Test an explicit replica budget is split and workers share a metrics directory """
+        workers, overrides = plan({'SERVER_WORKERS': '2',
+                                   'POSTGRES_REPLICA_MAX_CONNECTIONS': '30'}, 8)
+        assert workers == 2
+        assert overrides['POSTGRES_REPLICA_MAX_CONNECTIONS'] == '15'
+        assert overrides['HASHING_WORKERS'] == '4'
+        assert overrides['METRICS_DIR']
+
+    def test_single_worker(self):
+        """ Test a single worker keeps the whole budget """
+        workers, overrides = plan({'SERVER_WORKERS': '1'}, 8)
+        assert workers == 1
+        assert overrides['POSTGRES_MAX_CONNECTIONS'] == '20'
+        assert 'METRICS_DIR' not in overrides
+
+
+class FakeProcesses:
+    """ fork, kill and waitpid of workers that only exit when told """
+    def __init__(self):
+        self.last_pid = 100
+        self.signals = []
+        self.exited = []
+
+    def fork(self):
+        """ pid of a new worker """
+        self.last_pid += 1
+        return self.last_pid
+
+    def kill(self, pid, sig):
+        """ Record the signal """
+        self.signals.append((pid, sig))
+
+    def waitpid(self, pid, options):
+        """ Next exited worker, (0, 0) when none """
+        if self.exited:
+            return self.exited.pop(0)
+        return 0, 0
+
+    def exit(self, pid, code=0):
+        """ Make a worker exit with code """
+        self.exited.append((pid, code << 8))
+
+
+class FakeMetrics:
+    """ Archive of the exited workers """
+    def __init__(self):
+        self.archived = []
+
+    def archive(self, pid):
+        """ Record the worker """
+        self.archived.append(pid)
+
+
+@pytest.fixture()
+def processes(monkeypatch):
+    """ Workers faked without forking """
+    fake = FakeProcesses()
+    monkeypatch.setattr(server.os, "fork", fake.fork)
+    monkeypatch.setattr(server.os, "kill", fake.kill)
+    monkeypatch.setattr(server.os, "waitpid", fake.waitpid)
+    return fake
+
+def started_arbiter(count=2):
+    """ Arbiter whose workers are forked """
+    arbiter = server.Arbiter(None, [], count, logging.getLogger(__name__), FakeMetrics())
+    assert arbiter.tick()
+    return arbiter
+
+
+class TestArbiter:
+    """ Tests for the supervision of the workers """
+    def test_exited_worker_replaced(self, processes):
+        """ Test a worker that exited, after its max requests for one, is replaced at once """
+        arbiter = started_arbiter()
+        assert set(arbiter.workers) == {101, 102}
+        processes.exit(101)
+        assert arbiter.tick()
+        assert set(arbiter.workers) == {102, 103}
+        assert arbiter.metrics.archived == [101]
+
+    def test_failed_worker_replaced_after_delay(self, processes):
+        """ Test a crashed worker is not forked again in a loop """
+        arbiter = started_arbiter()
+        processes.exit(101, server.STARTUP_FAILURE)
+        assert arbiter.tick()
+        assert set(arbiter.workers) == {102}
+        arbiter.spawn_after = 0.0
+        assert arbiter.tick()
+        assert set(arbiter.workers) == {102, 103}
+
+    def test_request_limit(self, monkeypatch):
+        """ Test the max requests get a jitter, and no limit by default """
+        monkeypatch.setattr(server, "SERVER_MAX_REQUESTS", 100)
+        monkeypatch.setattr(server, "SERVER_MAX_REQUESTS_JITTER", 10)
+        assert all(100 <= server.request_limit() <= 110 for _ in range(50))
+        monkeypatch.setattr(server, "SERVER_MAX_REQUESTS", 0)
+        assert server.request_limit() is None
+
+    def test_worker_gets_its_request_limit(self, monkeypatch):
+        """ Test the forked worker serves with the max requests of the server """
+        config = SimpleNamespace(limit_max_requests=None)
+        limits = []
+
+        def run_worker(config, sockets):
+            limits.append(config.limit_max_requests)
+            return 0
+
+        def exit_worker(code):
+            raise SystemExit(code)
+
+        monkeypatch.setattr(server, "SERVER_MAX_REQUESTS", 100)
+        monkeypatch.setattr(server, "SERVER_MAX_REQUESTS_JITTER", 0)
+        monkeypatch.setattr(server.os, "fork", lambda: 0)
+        monkeypatch.setattr(server.os, "_exit", exit_worker)
+        monkeypatch.setattr(server, "run_worker", run_worker)
+        monkeypatch.setattr(log_config, "stop_listener", lambda: None)
+        arbiter = server.Arbiter(config, [], 1, logging.getLogger(__name__), FakeMetrics())
+        with pytest.raises(SystemExit) as exited:
+            arbiter.spawn()
+        assert exited.value.code == 0
+        assert limits == [100]
+
+    def test_recycle_one_at_a_time(self, processes):
+        """ Test SIGHUP stops the next worker only once the previous one is replaced """
+        arbiter = started_arbiter()
+        arbiter.handle_restart(signal.SIGHUP, None)
+        assert arbiter.tick()
+        assert arbiter.tick()
+        assert processes.signals == [(101, signal.SIGTERM)]
+        processes.exit(101)
+        assert arbiter.tick()
+        assert set(arbiter.workers) == {102, 103}
+        assert arbiter.tick()
+        assert processes.signals == [(101, signal.SIGTERM), (102, signal.SIGTERM)]
+
+    def test_graceful_stop(self, processes):
+        """ Test SIGTERM stops every worker and the arbiter once they exited """
+        arbiter = started_arbiter()
+        arbiter.handle_stop(signal.SIGTERM, None)
+        assert sorted(processes.signals) == [(101, signal.SIGTERM), (102, signal.SIGTERM)]
+        processes.exit(101)
+        assert arbiter.tick()
+        assert set(arbiter.workers) == {102}
+        processes.exit(102)
+        assert not arbiter.tick()
+        assert processes.last_pid == 102
+
+    def test_overdue_worker_killed(self, processes):
+        """ Test a worker still running past the graceful timeout is killed """
+        arbiter = started_arbiter()
+        arbiter.handle_stop(signal.SIGTERM, None)
+        arbiter.workers[101] = time.monotonic() - 1
+        assert arbiter.tick()
+        assert processes.signals[-1] == (101, signal.SIGKILL)
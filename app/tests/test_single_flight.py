@@ -0,0 +1,115 @@
+""" Test coalescing of concurrent calls """
+import asyncio
+import time
+import pytest
+from ..internal.deadline import DeadlineExceededError, current_deadline
+from ..utils.single_flight import SingleFlight
+
+
+class TestSingleFlight:
+    """ Tests for the single flight """
+    def test_concurrent_calls_share_one_run(self):
+        """ Test the callers of a key get the result of a single run """
+        flight = SingleFlight()
+        runs = []
+
+        async def lookup(email):
+            runs.append(email)
+            await asyncio.sleep(0.01)
+            return email.upper()
+
+        async def scenario():
+            results = await asyncio.gather(*(flight.do("key", lookup, "a@test.fr")
+                                             for _ in range(5)))
+            assert results == ["A@TEST.FR"] * 5
+            assert len(flight) == 0
+            # Finished calls are not cached
+            assert await flight.do("key", lookup, "a@test.fr") == "A@TEST.FR"
+
+        asyncio.run(scenario())
+        assert runs == ["a@test.fr", "a@test.fr"]
+        assert flight.calls == 2
+        assert flight.shared == 4
+
+    def test_error_raised_to_every_caller(self):
+        """ Test an exception reaches every caller """
+        flight = SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise ValueError("Incorrect email or password")
+
+        async def scenario():
+            return await asyncio.gather(*(flight.do("key", failing) for _ in range(3)),
+                                        return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        assert [type(result) for result in results] == [ValueError] * 3
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        """ Test the call goes on while a caller waits """
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def scenario():
+            first = asyncio.create_task(flight.do("key", slow))
+            second = asyncio.create_task(flight.do("key", slow))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await first
+            assert await second == "done"
+
+        asyncio.run(scenario())
+
+    def test_call_cancelled_without_callers(self):
+        """ Test the call stops when its last caller is cancelled """
+        flight = SingleFlight()
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def scenario():
+            caller = asyncio.create_task(flight.do("key", slow))
+            await asyncio.sleep(0.01)
+            caller.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await caller
+            assert len(flight) == 0
+            await asyncio.sleep(0)
+
+        asyncio.run(scenario())
+        assert cancelled == [True]
+
+    def test_callers_keep_their_own_deadline(self):
+        """ Test a short deadline of the first caller neither limits the call nor the others """
+        flight = SingleFlight()
+        deadlines = []
+
+        async def slow():
+            deadlines.append(current_deadline.get())
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def caller(timeout):
+            current_deadline.set(time.monotonic() + timeout)
+            return await flight.do("key", slow)
+
+        async def scenario():
+            short = asyncio.create_task(caller(0.01))
+            await asyncio.sleep(0)
+            generous = asyncio.create_task(caller(10))
+            with pytest.raises(DeadlineExceededError):
+                await short
+            assert await generous == "done"
+
+        asyncio.run(scenario())
+        assert deadlines == [None]
@@ -0,0 +1,49 @@
+""" Test streamed JSON bodies """
+import asyncio
+import pytest
+from ..utils.streaming import iter_json_objects
+
+
+def parse(chunks, max_item_bytes=1024):
+    """ Collect the items read from the chunks """
+    async def chunk_iterator():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [item async for item in iter_json_objects(chunk_iterator(), max_item_bytes)]
+
+    return asyncio.run(collect())
+
+
+class TestIterJsonObjects:
+    """ Tests for the streamed JSON parser """
+    def test_json_array(self):
+        """ Test items of an array split across chunks """
+        chunks = [b'[{"email": "a@test.fr"', b', "password": "x"},', b' {"email": "b@te', b'st.fr"}]']
+        assert parse(chunks) == [{"email": "a@test.fr", "password": "x"}, {"email": "b@test.fr"}]
+
+    def test_ndjson(self):
+        """ Test newline delimited items """
+        chunks = [b'{"email": "a@test.fr"}\n{"em', b'ail": "b@test.fr"}\n']
+        assert parse(chunks) == [{"email": "a@test.fr"}, {"email": "b@test.fr"}]
+
+    def test_multibyte_character_split(self):
+        """ Test a UTF-8 character split across chunks """
+        data = '[{"email": "é@test.fr"}]'.encode('utf-8')
+        split = data.index(b'\xc3') + 1
+        assert parse([data[:split], data[split:]]) == [{"email": "é@test.fr"}]
+
+    def test_empty_array(self):
+        """ Test an empty array """
+        assert not parse([b'[ ]'])
+
+    def test_incomplete_body(self):
+        """ Test a truncated body """
+        with pytest.raises(ValueError):
+            parse([b'[{"email": "a@test.fr"}, {"email"'])
+
+    def test_item_too_large(self):
+        """ Test an item larger than the limit """
+        with pytest.raises(ValueError):
+            parse([b'[{"email": "' + b'a' * 100, b'a' * 100], max_item_bytes=50)
@@ -1,50 +1,58 @@
 """ Test user routes """
 from datetime import datetime
 import json
+import time
 from fastapi.testclient import TestClient
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import pytest
-from ..database.database import postgreSQL_pool
-from ..utils.helpers import hash_password
+from ..config.config import Settings
+from ..database.database import PoolTimeoutError, database
+from ..internal.purge import purge_worker
+from ..internal.ratelimit import rate_limiter
+from ..utils.credentials_cache import credentials_cache
+from ..utils.hashing import password_hasher
+from ..utils.response_cache import user_responses
 
 from ..main import app
+from .transaction import PortalConnection, TransactionPool
 
 client = TestClient(app)
 
+# bcrypt hash of "testpassword" with the cost of the tests, computed once
+TEST_PASSWORD_HASH = "$2b$04$jErKeGjiNETQGJ6xb47BduH/tApvXyn7V1cACaJE7gxwVJCPcnSbu"
+
+@pytest.fixture(scope="module", autouse=True)
+def run_lifespan():
+    """ Open the database pool for the tests of this module """
+    with client:
+        client.portal.call(database.wait_ready, 30)
+        yield
+
 @pytest.fixture(autouse=True)
-def run_before_and_after_tests():
-    """ Delete data before tests """
-    try:
-        conn = postgreSQL_pool.getconn()
-        with conn.cursor() as curs:
-            curs.execute("DELETE FROM public.users")
-        conn.commit()
-    except (psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        postgreSQL_pool.putconn(conn)
+def db():
+    """ Run each test in a transaction rolled back after it, and empty the caches
+
+    now() stays at the start of the test in its transaction, expired codes and users
+    are made by backdating created_at rather than by waiting.
+    """
+    credentials_cache.clear()
+    user_responses.clear()
+    rate_limiter.reset()
+    pool = TransactionPool(database.pool)
+    client.portal.call(pool.begin)
+    database.pool = pool
+    yield PortalConnection(client.portal, pool)
+    database.pool = pool.pool
+    client.portal.call(pool.rollback)
 
 
 @pytest.fixture()
-def insert_test_user():
+def insert_test_user(db):
     """ Insert test user before tests """
-    hashed_password = hash_password('testpassword')
-    now = datetime.now()
-    try:
-        conn = postgreSQL_pool.getconn()
-        with conn.cursor() as curs:
-            curs.execute("""
-                INSERT INTO public.users (id, email, password, code, created_at)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING *;
-                """,
-                ("100", "test@test.fr", hashed_password, "0000", now))
-        conn.commit()
-    except (psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        postgreSQL_pool.putconn(conn)
+    db.execute("""
+        INSERT INTO public.users (id, email, password, code, created_at)
+        VALUES ($1, $2, $3, $4, $5)
+        """,
+        100, "test@test.fr", TEST_PASSWORD_HASH, "0000", datetime.now())
 
 class TestGetUsers:
     """ Tests for User GET routes """
@@ -58,6 +66,70 @@ class TestGetUsers:
         assert json_response['is_activated'] is False
         assert json_response['email'] == "test@test.fr"
 
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_get_user_malformed_write_cookie(self):
+        """ Test a non ASCII read your writes cookie is ignored """
+        cookie = f"{Settings.READ_YOUR_WRITES_COOKIE}=1.0.\xe9".encode("latin-1")
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"),
+                              headers={"Cookie": cookie})
+        assert response.status_code == 200
+
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_get_user_after_activation(self):
+        """ Test GET user reflects the activation """
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"))
+        assert response.json()['is_activated'] is False
+        response = client.patch("/users/activate/100?code=0000",
+                                auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 200
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 200
+        assert response.json()['is_activated'] is True
+
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_get_user_not_modified(self):
+        """ Test GET user answers 304 to a matching If-None-Match """
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"))
+        etag = response.headers['etag']
+        assert response.headers['cache-control'] == "private, no-cache"
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"),
+                              headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers['etag'] == etag
+        assert response.content == b""
+
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_get_user_etag_changes_after_activation(self):
+        """ Test an ETag from before the activation no longer matches """
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"))
+        etag = response.headers['etag']
+        response = client.patch("/users/activate/100?code=0000",
+                                auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 200
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"),
+                              headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+        assert response.json()['is_activated'] is True
+
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_get_user_with_stale_cached_principal(self, db):
+        """ Test a change made by another worker shows once the cached credentials expire """
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"))
+        etag = response.headers['etag']
+        # Activated by another worker, the credentials cache of this one is not cleared
+        db.execute("UPDATE public.users SET is_activated = true, version = version + 1 "
+                   "WHERE id = 100")
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"),
+                              headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        credentials_cache.clear()
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"),
+                              headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+        assert response.json()['is_activated'] is True
+
     @pytest.mark.usefixtures('insert_test_user')
     def test_get_user_wrong_login(self):
         """ Test GET user with wrong login """
@@ -86,6 +158,23 @@ class TestGetUsers:
         json_response = response.json()
         assert json_response['detail'] == "User not found"
 
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_get_user_rehashes_password(self, db, monkeypatch):
+        """ Test a hash of another cost is replaced after a login """
+        monkeypatch.setattr(password_hasher, "rounds", 5)
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 200
+        for _ in range(50):
+            stored_hash = db.fetchval("SELECT password FROM public.users WHERE id = 100")
+            if stored_hash.startswith("$2b$05$"):
+                break
+            time.sleep(0.1)
+        assert stored_hash.startswith("$2b$05$")
+        credentials_cache.clear()
+        response = client.get("/user/100", auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 200
+
+
 class TestPostUsers:
     """ Tests for User POST routes """
     def test_post_create_user(self):
@@ -98,6 +187,20 @@ class TestPostUsers:
         assert json_response['id'] is not None
         assert json_response['created_at'] is not None
 
+    def test_post_create_user_sends_activation_mail(self, db):
+        """ Test POST users/ queues the activation mail and the worker sends it """
+        data = {"email":"test@test.com", "password":"testuser"}
+        response = client.post("/users", data=json.dumps(data))
+        assert response.status_code == 201
+        for _ in range(50):
+            mail = db.fetchrow("SELECT recipient, sent_at FROM public.outbox WHERE user_id = $1",
+                               response.json()['id'])
+            if mail['sent_at'] is not None:
+                break
+            time.sleep(0.1)
+        assert mail['recipient'] == "test@test.com"
+        assert mail['sent_at'] is not None
+
     @pytest.mark.usefixtures('insert_test_user')
     def test_post_create_user_existing_email(self):
         """ Test POST users/ to create a user with existing email """
@@ -161,33 +264,139 @@ class TestPostUsers:
         json_response = response.json()
         assert json_response['detail'] == "The password must be at least 8 characters. Consider having a shorter one"
 
+class TestBulkUsers:
+    """ Tests for bulk user creation """
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_post_create_users_json_array(self):
+        """ Test POST users/bulk with a JSON array """
+        data = [
+            {"email":"test1@test.com", "password":"testuser"},
+            {"email":"test@test.fr", "password":"testuser"},
+            {"email":"testtest.fr", "password":"testuser"},
+            {"email":"test1@test.com", "password":"testuser"},
+        ]
+        response = client.post("/users/bulk", data=json.dumps(data))
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result['status'] for result in results] == [
+            "created", "duplicate", "invalid", "duplicate"]
+        assert results[0]['id'] is not None
+        assert results[2]['detail'] == "The email is incorrect"
+
+    def test_post_create_users_ndjson(self):
+        """ Test POST users/bulk with NDJSON, created users can log in """
+        data = "\n".join(json.dumps({"email":f"test{i}@test.com", "password":"testuser"})
+                         for i in range(3))
+        response = client.post("/users/bulk", content=data,
+                               headers={"Content-Type": "application/x-ndjson"})
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result['status'] for result in results] == ["created"] * 3
+        response = client.get(f"/user/{results[1]['id']}", auth=("test1@test.com", "testuser"))
+        assert response.status_code == 200
+
+    def test_post_create_users_invalid_json(self):
+        """ Test POST users/bulk with a truncated body """
+        response = client.post("/users/bulk", content='[{"email":"test@test.com"')
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert results[-1]['status'] == "invalid"
+
+    def test_post_create_users_pool_exhausted(self, monkeypatch):
+        """ Test POST users/bulk reports the batches without a connection as errors """
+        monkeypatch.setattr(Settings, "BULK_BATCH_SIZE", 1)
+        acquire = database.acquire
+        calls = []
+
+        def acquire_once():
+            calls.append(None)
+            if len(calls) > 1:
+                raise PoolTimeoutError("No connection available")
+            return acquire()
+
+        monkeypatch.setattr(database, "acquire", acquire_once)
+        data = [{"email":f"test{i}@test.com", "password":"testuser"} for i in range(3)]
+        response = client.post("/users/bulk", data=json.dumps(data))
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result['status'] for result in results] == ["created", "error", "error"]
+
+class TestListUsers:
+    """ Tests for the users listing """
+    @pytest.fixture(autouse=True)
+    def admin_key(self, monkeypatch):
+        """ Configure the admin key """
+        monkeypatch.setattr(Settings, "ADMIN_API_KEY", "testkey")
+
+    @pytest.fixture()
+    def insert_users(self):
+        """ Insert users to list """
+        data = [{"email":f"test{i}@test.com", "password":"testuser"} for i in range(5)]
+        response = client.post("/users/bulk", data=json.dumps(data))
+        return [json.loads(line)['id'] for line in response.text.splitlines()]
+
+    def test_list_users_pages(self, insert_users):
+        """ Test GET users/ pages follow the ids """
+        response = client.get("/users?limit=3", headers={"X-Admin-Key": "testkey"})
+        assert response.status_code == 200
+        first_page = [json.loads(line) for line in response.text.splitlines()]
+        assert [user['id'] for user in first_page] == insert_users[:3]
+        response = client.get(f"/users?limit=3&after_id={first_page[-1]['id']}",
+                              headers={"X-Admin-Key": "testkey"})
+        second_page = [json.loads(line) for line in response.text.splitlines()]
+        assert [user['id'] for user in second_page] == insert_users[3:]
+
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_list_users_filters(self, insert_users):
+        """ Test GET users/ filters """
+        response = client.get("/users?is_activated=false&created_before=2000-01-01T00:00:00",
+                              headers={"X-Admin-Key": "testkey"})
+        assert response.status_code == 200
+        assert response.text == ""
+
+    def test_list_users_pool_exhausted(self, monkeypatch):
+        """ Test GET users/ ends with an error line when no connection is available """
+        def acquire_read(key=None):
+            raise PoolTimeoutError("No connection available")
+
+        monkeypatch.setattr(database, "acquire_read", acquire_read)
+        response = client.get("/users", headers={"X-Admin-Key": "testkey"})
+        assert response.status_code == 200
+        assert [json.loads(line) for line in response.text.splitlines()] == [
+            {"error": "An error has occured"}]
+
+    def test_list_users_wrong_key(self):
+        """ Test GET users/ with a wrong admin key """
+        response = client.get("/users", headers={"X-Admin-Key": "wrongkey"})
+        assert response.status_code == 403
+        assert response.json() == {"detail": "Incorrect admin key"}
+
 class TestPatchUsers:
     """ Tests for User PATCH routes """
-    def test_patch_activate_user(self):
+    def test_patch_activate_user(self, db):
         """ Test PATCH users/ to activate a user"""
         data = {"email":"test@test.com", "password":"testuser"}
         response = client.post("/users", data=json.dumps(data))
         assert response.status_code == 201
-        try:
-            conn = postgreSQL_pool.getconn()
-            with conn.cursor(cursor_factory=RealDictCursor) as curs:
-                curs.execute("""
-                    SELECT id, code FROM public.users
-                    WHERE email = %s;
-                    """,
-                    ("test@test.com",))
-                user = curs.fetchone()
-            conn.commit()
-        except (psycopg2.DatabaseError) as error:
-            print(error)
-        finally:
-            postgreSQL_pool.putconn(conn)
+        user = db.fetchrow("SELECT id, code FROM public.users WHERE email = $1",
+                           "test@test.com")
 
         response = client.patch(f"/users/activate/{user['id']}?code={user['code']}",
                               auth=("test@test.com", "testuser"))
         assert response.status_code == 200
         assert response.json() == {"message": "User activated"}
 
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_patch_activate_user_twice(self):
+        """ Test only the first activation succeeds """
+        response = client.patch("/users/activate/100?code=0000",
+                                auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 200
+        response = client.patch("/users/activate/100?code=0000",
+                                auth=("test@test.fr", "testpassword"))
+        assert response.status_code == 400
+        assert response.json() == {"detail": "The user is already activated"}
+
     @pytest.mark.usefixtures('insert_test_user')
     def test_patch_activate_user_wrong_code(self):
         """ Test activate a user with wrong code"""
@@ -197,22 +406,9 @@ class TestPatchUsers:
         assert response.json() == {"detail": "The code provided is incorrect"}
 
     @pytest.mark.usefixtures('insert_test_user')
-    def test_patch_activate_already_activated_user(self):
+    def test_patch_activate_already_activated_user(self, db):
         """ Test activate an already activated user"""
-        try:
-            conn = postgreSQL_pool.getconn()
-            with conn.cursor(cursor_factory=RealDictCursor) as curs:
-                curs.execute("""
-                    UPDATE public.users
-                    SET is_activated = true
-                    WHERE id = %s;
-                    """,
-                    ("100",))
-            conn.commit()
-        except (psycopg2.DatabaseError) as error:
-            print(error)
-        finally:
-            postgreSQL_pool.putconn(conn)
+        db.execute("UPDATE public.users SET is_activated = true WHERE id = $1", 100)
 
         response = client.patch("/users/activate/100?code=0000",
                               auth=("test@test.fr", "testpassword"))
@@ -220,22 +416,13 @@ class TestPatchUsers:
         assert response.json() == {"detail": "The user is already activated"}
 
     @pytest.mark.usefixtures('insert_test_user')
-    def test_patch_activate_user_expired_code(self):
+    def test_patch_activate_user_expired_code(self, db):
         """ Test activate a user with expired code"""
-        try:
-            conn = postgreSQL_pool.getconn()
-            with conn.cursor(cursor_factory=RealDictCursor) as curs:
-                curs.execute("""
-                    UPDATE public.users
-                    SET created_at = '2024-01-13 10:00:00.430322'
-                    WHERE id = %s;
-                    """,
-                    ("100",))
-            conn.commit()
-        except (psycopg2.DatabaseError) as error:
-            print(error)
-        finally:
-            postgreSQL_pool.putconn(conn)
+        db.execute("""
+            UPDATE public.users SET created_at = '2024-01-13 10:00:00.430322'
+            WHERE id = $1
+            """,
+            100)
 
         response = client.patch("/users/activate/100?code=0000",
                               auth=("test@test.fr", "testpassword"))
@@ -276,3 +463,41 @@ class TestPatchUsers:
                                 auth=("test@test.fr", "testpassword"))
         assert response.status_code == 404
         assert response.json() == {"detail": "The user was not found"}
+
+
+class TestPurgeUsers:
+    """ Tests for the purge of users not activated """
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_purge_expired_users(self, db, monkeypatch):
+        """ Test only the users not activated before the retention are deleted """
+        db.execute("UPDATE public.users SET created_at = now() - interval '2 days'")
+        db.execute("""
+            INSERT INTO public.users (id, email, password, code, is_activated, created_at)
+            VALUES (101, 'old@test.fr', 'x', '0000', true, now() - interval '2 days'),
+            (102, 'new@test.fr', 'x', '0000', false, now())
+            """)
+        monkeypatch.setattr(Settings, "PURGE_RETENTION_SECS", 86400)
+        monkeypatch.setattr(Settings, "PURGE_BATCH_SIZE", 1)
+        monkeypatch.setattr(Settings, "PURGE_BATCH_PAUSE_SECS", 0)
+        assert client.portal.call(purge_worker.purge) == 1
+        assert [row['id'] for row in db.fetch("SELECT id FROM public.users ORDER BY id")] == [
+            101, 102]
+
+    @pytest.mark.usefixtures('insert_test_user')
+    def test_purge_old_outbox_messages(self, db):
+        """ Test old messages are deleted unless a worker still holds their lease """
+        db.execute("""
+            INSERT INTO public.outbox (idempotency_key, kind, user_id, recipient, payload,
+            next_attempt_at, sent_at, created_at)
+            VALUES ('sent', 'activation', 100, 'test@test.fr', '{}', now(), now(),
+            now() - interval '1 hour'),
+            ('leased', 'activation', 100, 'test@test.fr', '{}', now() + interval '1 minute',
+            NULL, now() - interval '1 hour'),
+            ('given-up', 'activation', 100, 'test@test.fr', '{}', now() - interval '1 minute',
+            NULL, now() - interval '1 hour'),
+            ('recent', 'activation', 100, 'test@test.fr', '{}', now(), now(), now())
+            """)
+        assert client.portal.call(purge_worker.purge_outbox) == 2
+        assert [row['idempotency_key'] for row in db.fetch(
+            "SELECT idempotency_key FROM public.outbox ORDER BY idempotency_key")] == [
+                "leased", "recent"]
@@ -0,0 +1,100 @@
+""" Per test transactions of the database tests
+
+The app pool is replaced during a test by a pool lending a single connection,
+inside a transaction rolled back after the test. The checkouts of the app and
+the queries of the test take turns on it, so they all see the rows of the test.
+"""
+import asyncio
+import asyncpg
+
+
+class TransactionPool:
+    """ Pool lending one connection inside a transaction of the test
+
+    Each checkout runs in a savepoint, a failed statement only undoes its checkout
+    instead of aborting the transaction of the test. Nested transactions of the
+    app become savepoints too. now() is the start of the transaction for the whole
+    test, waiting never makes a row older: a test of expiry backdates its rows.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+        self.transaction = None
+        self.lock = asyncio.Lock()
+
+    async def begin(self):
+        """ Take a connection of the real pool and start the transaction of the test """
+        self.conn = await self.pool.acquire()
+        self.transaction = self.conn.transaction()
+        await self.transaction.start()
+
+    async def rollback(self):
+        """ Undo everything the test wrote and give the connection back """
+        async with self.lock:
+            try:
+                await self.transaction.rollback()
+            finally:
+                await self.pool.release(self.conn)
+
+    async def acquire(self, timeout: float = None):
+        """ Wait for the connection and start a savepoint """
+        await asyncio.wait_for(self.lock.acquire(), timeout)
+        try:
+            await self.conn.execute("SAVEPOINT checkout")
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.conn
+
+    async def release(self, conn):
+        """ Keep the work of the checkout, or undo it after a failed statement """
+        try:
+            try:
+                await conn.execute("RELEASE SAVEPOINT checkout")
+            except asyncpg.InFailedSQLTransactionError:
+                await conn.execute("ROLLBACK TO SAVEPOINT checkout; RELEASE SAVEPOINT checkout")
+        finally:
+            self.lock.release()
+
+    def get_size(self):
+        """ Connections open, for the pool usage """
+        return 1
+
+    def get_idle_size(self):
+        """ Connections not checked out, for the pool usage """
+        return 0 if self.lock.locked() else 1
+
+    def get_max_size(self):
+        """ Connections allowed, for the pool usage """
+        return 1
+
+    async def run(self, method: str, query: str, *args):
+        """ Run a query of the test in its own checkout """
+        conn = await self.acquire()
+        try:
+            return await getattr(conn, method)(query, *args)
+        finally:
+            await self.release(conn)
+
+
+class PortalConnection:
+    """ Blocking queries of a test on its transaction, through the portal of the test client """
+    def __init__(self, portal, pool: TransactionPool):
+        self.portal = portal
+        self.pool = pool
+
+    def execute(self, query: str, *args):
+        """ Run a statement """
+        return self.portal.call(self.pool.run, "execute", query, *args)
+
+    def fetch(self, query: str, *args):
+        """ Rows of a query """
+        return self.portal.call(self.pool.run, "fetch", query, *args)
+
+    def fetchrow(self, query: str, *args):
+        """ First row of a query, None without rows """
+        return self.portal.call(self.pool.run, "fetchrow", query, *args)
+
+    def fetchval(self, query: str, *args):
+        """ First value of the first row """
+        return self.portal.call(self.pool.run, "fetchval", query, *args)
@@ -0,0 +1,110 @@
+""" Cache of verified Basic auth credentials """
+import hashlib
+import hmac
+import secrets
+import time
+from collections import OrderedDict
+from ..config.config import Settings
+from ..internal.metrics import metrics
+
+# Rough per entry overhead of the dict slots, tuple, bytes and principal objects
+ENTRY_OVERHEAD_BYTES: int = 400
+
+
+class CredentialsCache:
+    """ TTL and LRU cache of credentials that already passed bcrypt
+
+    Keys are an HMAC-SHA256 of the email and password with a per process secret,
+    so neither the plain password nor a reusable digest is ever stored.
+    The cache is per process: other workers only see a change after the TTL.
+    """
+    def __init__(self, ttl_secs: float, max_bytes: int):
+        self.ttl_secs = ttl_secs
+        self.max_bytes = max_bytes
+        self._secret = secrets.token_bytes(32)
+        # digest -> (email, principal, expiry, size)
+        self._entries = OrderedDict()
+        # email -> digests, to evict every entry of a user at once
+        self._by_email = {}
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, email: str, password: str):
+        """ Keyed digest of the credentials """
+        message = email.encode('utf-8') + b'\0' + password.encode('utf-8')
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def _remove(self, digest: bytes):
+        """ Remove an entry and its email index """
+        email, _, _, size = self._entries.pop(digest)
+        self._size -= size
+        digests = self._by_email.get(email)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_email[email]
+
+    def get(self, email: str, password: str):
+        """ Return the principal if the credentials were verified recently """
+        if self.max_bytes <= 0:
+            return None
+        digest = self.digest(email, password)
+        entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[2] <= time.monotonic():
+            self._remove(digest)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, email: str, password: str, principal):
+        """ Remember the principal of credentials that passed bcrypt """
+        if self.max_bytes <= 0:
+            return
+        digest = self.digest(email, password)
+        if digest in self._entries:
+            self._remove(digest)
+        size = ENTRY_OVERHEAD_BYTES + len(digest) + 2 * len(email)
+        self._entries[digest] = (email, principal, time.monotonic() + self.ttl_secs, size)
+        self._by_email.setdefault(email, set()).add(digest)
+        self._size += size
+        while self._size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, email: str):
+        """ Forget every entry of a user, on password or activation change """
+        for digest in list(self._by_email.get(email, ())):
+            self._remove(digest)
+
+    def clear(self):
+        """ Forget everything """
+        self._entries.clear()
+        self._by_email.clear()
+        self._size = 0
+
+    def stats(self):
+        """ Counters of the cache """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_bytes": self._size,
+        }
+
+
+credentials_cache = CredentialsCache(Settings.CREDENTIALS_CACHE_TTL_SECS,
+                                     Settings.CREDENTIALS_CACHE_MAX_BYTES)
+
+metrics.callback("credentials_cache_requests_total", "Credentials cache lookups by result",
+                 lambda: [(("hit",), credentials_cache.hits), (("miss",), credentials_cache.misses)],
+                 ("result",), "counter")
+metrics.callback("credentials_cache_size_bytes", "Estimated size of the credentials cache",
+                 lambda: [((), credentials_cache.stats()['size_bytes'])])
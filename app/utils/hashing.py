@@ -0,0 +1,105 @@
+""" Password hashing service running bcrypt outside of the event loop """
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ..config.config import Settings
+from ..internal.metrics import BCRYPT_DURATION, metrics
+from .helpers import check_password, hash_password, hash_rounds
+
+
+class HashingQueueFullError(Exception):
+    """ Raised when too many hashing jobs are already waiting """
+
+
+class PasswordHasher:
+    """ Run bcrypt jobs in a bounded thread or process pool """
+    def __init__(self, executor_type: str, max_workers: int, max_queue: int, rounds: int = 12):
+        self.executor_type = executor_type
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.rounds = rounds
+        self._executor = None
+        # Jobs running or waiting for a worker, only touched from the event loop
+        self._pending = 0
+        self._durations = {func: BCRYPT_DURATION.labels(func.__name__)
+                           for func in (hash_password, check_password)}
+
+    @property
+    def pending(self):
+        """ Number of jobs running or waiting for a worker """
+        return self._pending
+
+    def _get_executor(self):
+        """ Create the executor on first use """
+        if self._executor is None:
+            if self.executor_type == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='bcrypt')
+        return self._executor
+
+    async def _run(self, func, *args):
+        """ Run a job in the pool """
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._pending -= 1
+            self._durations[func].observe(time.perf_counter() - start)
+
+    async def _submit(self, func, *args):
+        """ Run a job in the pool, refusing it when the queue is full """
+        if self._pending >= self.max_workers + self.max_queue:
+            raise HashingQueueFullError(f"{self._pending} hashing jobs already pending")
+        return await self._run(func, *args)
+
+    async def hash_password(self, password: str):
+        """ Hash a provided password """
+        return await self._submit(hash_password, password, self.rounds)
+
+    async def hash_passwords(self, passwords, concurrency: int):
+        """ Hash many passwords, waiting for workers instead of refusing jobs
+
+        At most concurrency jobs are in the pool at once, so single requests
+        only wait behind a few of them.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def hash_one(password):
+            async with semaphore:
+                return await self._run(hash_password, password, self.rounds)
+
+        return await asyncio.gather(*(hash_one(password) for password in passwords))
+
+    async def check_password(self, password: str, hashed_password: str):
+        """ Check a provided password against a stored hash """
+        return await self._submit(check_password, password, hashed_password)
+
+    def needs_rehash(self, hashed_password: str):
+        """ True if a stored hash was made with another cost than the configured one """
+        return hash_rounds(hashed_password) != self.rounds
+
+    async def rehash_password(self, password: str):
+        """ Hash again with the configured cost, None when no worker is idle """
+        # Never delays a login or a signup, the next login retries
+        if self._pending >= self.max_workers:
+            return None
+        return await self._run(hash_password, password, self.rounds)
+
+    def shutdown(self):
+        """ Stop the workers """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(Settings.HASHING_EXECUTOR,
+                                 Settings.HASHING_WORKERS,
+                                 Settings.HASHING_MAX_QUEUE,
+                                 Settings.BCRYPT_ROUNDS)
+
+metrics.callback("bcrypt_pending_jobs", "bcrypt jobs running or waiting for a worker",
+                 lambda: [((), password_hasher.pending)])
@@ -1,10 +1,58 @@
 """ Contains helper functions """
+import re
+import time
 import bcrypt
 
+# Same rules as the constraints of the users table
+EMAIL_PATTERN = re.compile(r'^[A-Za-z0-9._+%-]+@[A-Za-z0-9.-]+[.][A-Za-z]+$', re.IGNORECASE | re.ASCII)
+EMAIL_MIN_SIZE: int = 7
+EMAIL_MAX_SIZE: int = 50
+PASSWORD_MIN_SIZE: int = 8
+# Bounds of the bcrypt cost picked by the calibration
+BCRYPT_MIN_ROUNDS: int = 10
+BCRYPT_MAX_ROUNDS: int = 16
 
-def hash_password(password: str):
+
+def hash_password(password: str, rounds: int = 12):
     """ Hash a provided password """
     password_bytes = password.encode('utf-8')
-    salt = bcrypt.gensalt(12)
+    salt = bcrypt.gensalt(rounds)
     hashed_password = bcrypt.hashpw(password_bytes, salt).decode()
     return hashed_password
+
+def hash_rounds(hashed_password: str):
+    """ Cost of a bcrypt hash, read from its "$2b$12$..." prefix """
+    return int(hashed_password.split('$')[2])
+
+def calibrate_rounds(target_secs: float, min_rounds: int = BCRYPT_MIN_ROUNDS,
+                     max_rounds: int = BCRYPT_MAX_ROUNDS):
+    """ Highest cost whose hash takes at most target_secs on this machine
+
+    Only the minimum cost is timed, each extra round doubles the time.
+    """
+    start = time.perf_counter()
+    hash_password("calibration", min_rounds)
+    elapsed = time.perf_counter() - start
+    rounds = min_rounds
+    while rounds < max_rounds and elapsed * 2 <= target_secs:
+        elapsed *= 2
+        rounds += 1
+    return rounds
+
+def check_password(password: str, hashed_password: str):
+    """ Check a provided password against a stored hash """
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+def validate_new_user(email: str, password: str):
+    """ Return the reason why a user cannot be created, None if it can """
+    # Check if password is empty
+    if password in [None, '']:
+        return "The password is empty"
+    # Check if password is too short (< 8 chars)
+    if len(password) < PASSWORD_MIN_SIZE:
+        return "The password must be at least 8 characters. Consider having a shorter one"
+    if len(email) > EMAIL_MAX_SIZE:
+        return "The email is over 50 characters"
+    if len(email) < EMAIL_MIN_SIZE or EMAIL_PATTERN.fullmatch(email) is None:
+        return "The email is incorrect"
+    return None
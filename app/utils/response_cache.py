@@ -0,0 +1,77 @@
+""" Short lived cache of rendered user responses """
+import time
+from collections import OrderedDict
+from ..config.config import Settings
+from ..internal.metrics import metrics
+
+
+def user_etag(user):
+    """ Strong ETag of a user response, it changes with the activation and the row version """
+    return f'"{user.id}-{user.version}-{int(user.is_activated)}"'
+
+def etag_matches(if_none_match: str, etag: str):
+    """ True if an If-None-Match header lists the ETag, weak or not, or is * """
+    if if_none_match is None:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in (etag, "*"):
+            return True
+    return False
+
+
+class ResponseCache:
+    """ TTL and LRU cache of response bodies by user id
+
+    An entry is only served for the ETag it was rendered for, so a newer
+    principal never gets an older body.
+    """
+    def __init__(self, ttl_secs: float, max_entries: int):
+        self.ttl_secs = ttl_secs
+        self.max_entries = max_entries
+        # user id -> (etag, body, expiry)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: int, etag: str):
+        """ Body rendered for this ETag, None if missing or expired """
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] != etag or entry[2] <= time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id: int, etag: str, body: bytes):
+        """ Remember a rendered body """
+        if self.max_entries <= 0:
+            return
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (etag, body, time.monotonic() + self.ttl_secs)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """ Forget the body of a user after a change """
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        """ Forget everything """
+        self._entries.clear()
+
+
+user_responses = ResponseCache(Settings.USER_RESPONSE_CACHE_TTL_SECS,
+                               Settings.USER_RESPONSE_CACHE_MAX_ENTRIES)
+
+metrics.callback("user_response_cache_requests_total", "User response cache lookups by result",
+                 lambda: [(("hit",), user_responses.hits), (("miss",), user_responses.misses)],
+                 ("result",), metric_type="counter")
+metrics.callback("user_response_cache_entries", "User responses in the cache",
+                 lambda: [((), len(user_responses))])
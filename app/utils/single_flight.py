@@ -0,0 +1,74 @@
+""" Coalescing of concurrent identical calls """
+import asyncio
+import contextvars
+from ..internal.deadline import (DeadlineExceededError, current_deadline,
+                                 remaining as deadline_remaining)
+
+
+class _Call:
+    """ Task shared by the callers of a key """
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """ Run one coroutine per key at a time, concurrent callers of a key await its result
+
+    An exception is raised to every caller. A cancelled caller stops waiting without
+    affecting the others, the call itself is cancelled when no caller waits anymore.
+    Nothing is kept once the call is done, the next caller starts a new one.
+
+    The call runs without the request deadline of the caller that started it, each
+    caller waits for it until its own deadline only.
+    """
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _forget(self, key, call):
+        """ Remove a finished call, unless a newer one took its key """
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def _leave(self, key, call):
+        """ Cancel the call when its last caller stops waiting """
+        if call.waiters == 1 and not call.task.done():
+            # New callers must not join a call being cancelled
+            self._forget(key, call)
+            call.task.cancel()
+
+    async def do(self, key, function, *args):
+        """ Return the result of function(*args), shared with the callers of the same key """
+        left = deadline_remaining()
+        call = self._calls.get(key)
+        if call is None:
+            context = contextvars.copy_context()
+            context.run(current_deadline.set, None)
+            call = _Call(asyncio.get_running_loop().create_task(function(*args),
+                                                                context=context))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self._calls[key] = call
+            self.calls += 1
+        else:
+            self.shared += 1
+        call.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(call.task), left)
+        except asyncio.TimeoutError as error:
+            if call.task.done():
+                # Raised by the call itself
+                raise
+            self._leave(key, call)
+            raise DeadlineExceededError("The deadline of the request is over") from error
+        except asyncio.CancelledError:
+            self._leave(key, call)
+            raise
+        finally:
+            call.waiters -= 1
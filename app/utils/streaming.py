@@ -0,0 +1,80 @@
+""" Helpers to read and write JSON bodies one item at a time """
+import codecs
+import json
+import orjson
+from starlette.responses import StreamingResponse
+
+WHITESPACE: str = ' \t\n\r'
+
+
+class NDJSONResponse(StreamingResponse):
+    """ Newline delimited JSON response streamed from an async iterator of objects
+
+    With reads_request it does not listen for the disconnect message while
+    streaming, so the body iterator may still read the request body.
+    """
+    media_type = "application/x-ndjson"
+
+    def __init__(self, content, reads_request: bool = False, **kwargs):
+        super().__init__(self._encode(content), **kwargs)
+        self.reads_request = reads_request
+
+    @staticmethod
+    async def _encode(content):
+        """ Encode each object on its own line """
+        async for item in content:
+            yield orjson.dumps(item) + b'\n'
+
+    async def __call__(self, scope, receive, send):
+        if not self.reads_request:
+            await super().__call__(scope, receive, send)
+            return
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def iter_json_objects(chunks, max_item_bytes: int):
+    """ Yield the items of a JSON array or NDJSON body as they arrive
+
+    Raises ValueError if the body is not valid JSON or an item is too large.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_array = None
+    closed = False
+    async for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        position = 0
+        while not closed:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position == len(buffer):
+                break
+            if in_array is None:
+                in_array = buffer[position] == '['
+                if in_array:
+                    position += 1
+                    continue
+            if in_array and buffer[position] == ',':
+                position += 1
+                continue
+            if in_array and buffer[position] == ']':
+                closed = True
+                position += 1
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Wait for the rest of the item
+                break
+            yield item
+        buffer = buffer[position:]
+        if closed and buffer.strip(WHITESPACE):
+            raise ValueError("Unexpected data after the JSON array")
+        if len(buffer) > max_item_bytes:
+            raise ValueError("The JSON item is too large or invalid")
+    buffer += utf8.decode(b'', final=True)
+    if buffer.strip(WHITESPACE) or (in_array and not closed):
+        raise ValueError("The JSON body is incomplete or invalid")
@@ -0,0 +1,30 @@
+""" Time bcrypt on this machine and suggest BCRYPT_ROUNDS for a target hash time
+
+Run with: python -m benchmarks.bcrypt_cost --target-secs 0.25
+Run it on the production hardware and set the same BCRYPT_ROUNDS on every
+worker, hashes of another cost are replaced at the next login.
+"""
+import argparse
+import time
+from app.utils.helpers import BCRYPT_MAX_ROUNDS, BCRYPT_MIN_ROUNDS, calibrate_rounds, hash_password
+
+
+def main():
+    """ Print the time of each cost up to the suggested one """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target-secs", type=float, default=0.25)
+    parser.add_argument("--min-rounds", type=int, default=BCRYPT_MIN_ROUNDS)
+    parser.add_argument("--max-rounds", type=int, default=BCRYPT_MAX_ROUNDS)
+    args = parser.parse_args()
+
+    rounds = calibrate_rounds(args.target_secs, args.min_rounds, args.max_rounds)
+    for cost in range(args.min_rounds, rounds + 1):
+        start = time.perf_counter()
+        hash_password("calibration", cost)
+        print(f"rounds {cost:>2}: {(time.perf_counter() - start) * 1000:8.1f} ms")
+    print(f"BCRYPT_ROUNDS={rounds}")
+
+
+if __name__ == "__main__":
+    main()
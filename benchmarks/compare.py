@@ -0,0 +1,57 @@
+""" Compare two load test results and fail on regressions
+
+    python -m benchmarks.compare baseline.json current.json --tolerance 0.10
+
+Exits with 1 if the throughput of an endpoint dropped, or its p95 or p99
+latency grew, by more than the tolerance.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    """ Read a results file """
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+def compare(baseline, current, tolerance):
+    """ Return a line per metric and the list of regressions """
+    lines = []
+    regressions = []
+    for endpoint in sorted(set(baseline['endpoints']) & set(current['endpoints'])):
+        before = baseline['endpoints'][endpoint]
+        after = current['endpoints'][endpoint]
+        metrics = [("throughput_rps", before['throughput_rps'], after['throughput_rps'], False)]
+        for name in ["p95", "p99"]:
+            metrics.append((f"{name}_ms", before['latency_ms'][name], after['latency_ms'][name],
+                            True))
+        for name, old, new, lower_is_better in metrics:
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = change > tolerance if lower_is_better else change < -tolerance
+            lines.append(f"{endpoint:<36} {name:<15} {old:>10.2f} -> {new:>10.2f} "
+                         f"({change:+.1%}){'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append((endpoint, name, change))
+    return lines, regressions
+
+def main():
+    """ Print the comparison and exit with 1 on regression """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    lines, regressions = compare(load(args.baseline), load(args.current), args.tolerance)
+    print("\n".join(lines))
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
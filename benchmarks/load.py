@@ -0,0 +1,300 @@
+""" Load test of the user endpoints against the real ASGI app
+
+Starts uvicorn with the requested number of workers (or targets --url), seeds
+users, runs a workload for a fixed duration and writes the results as JSON.
+Postgres is reached with the usual POSTGRES_* variables. The started server
+runs without rate limiting since the whole load comes from one address, 429
+answers of a --url target are counted apart from the errors.
+
+    python -m benchmarks.load --workload mixed --workers 4 --concurrency 64 \
+        --duration 30 --output benchmarks/results/mixed.json
+"""
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+import asyncpg
+import httpx
+
+PASSWORD: str = "benchpassword"
+
+# Share of each operation in a workload
+WORKLOADS = {
+    "signup": {"signup": 0.8, "read": 0.2},
+    "read": {"signup": 0.05, "read": 0.95},
+    "activation": {"activate": 0.9, "read": 0.1},
+    "mixed": {"signup": 0.2, "read": 0.7, "activate": 0.1},
+}
+
+ENDPOINTS = {
+    "signup": "POST /users",
+    "read": "GET /user/{user_id}",
+    "activate": "PATCH /users/activate/{user_id}",
+}
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+def summarize(latencies, duration):
+    """ Throughput and latency percentiles in milliseconds """
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / duration,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+
+class Recorder:
+    """ Latencies and status codes per endpoint """
+    def __init__(self):
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS.values()}
+        self.status = {endpoint: {} for endpoint in ENDPOINTS.values()}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS.values()}
+        self.rate_limited = {endpoint: 0 for endpoint in ENDPOINTS.values()}
+
+    def record(self, endpoint, start, status):
+        """ Record one request """
+        self.latencies[endpoint].append((time.perf_counter() - start) * 1000)
+        key = str(status)
+        self.status[endpoint][key] = self.status[endpoint].get(key, 0) + 1
+        if status is None or status >= 500:
+            self.errors[endpoint] += 1
+        elif status == 429:
+            self.rate_limited[endpoint] += 1
+
+
+class Workload:
+    """ Users and operations of a run """
+    def __init__(self, client, shares, run_id):
+        self.client = client
+        self.operations = list(shares)
+        self.weights = list(shares.values())
+        self.run_id = run_id
+        self.counter = 0
+        # (id, email) that can log in
+        self.users = []
+        # (id, email, code) not activated yet
+        self.pending_activations = []
+
+    def next_email(self):
+        """ Unique email of this run """
+        self.counter += 1
+        return f"bench-{self.run_id}-{self.counter}@bench.test"
+
+    async def signup(self):
+        """ Create a user """
+        email = self.next_email()
+        response = await self.client.post("/users", json={"email": email, "password": PASSWORD})
+        if response.status_code == 201:
+            self.users.append((response.json()['id'], email))
+        return response.status_code
+
+    async def read(self):
+        """ Read an existing user """
+        user_id, email = random.choice(self.users)
+        response = await self.client.get(f"/user/{user_id}", auth=(email, PASSWORD))
+        return response.status_code
+
+    async def activate(self):
+        """ Activate a pending user, or retry an already activated one """
+        if self.pending_activations:
+            user_id, email, code = self.pending_activations.pop()
+        else:
+            user_id, email = random.choice(self.users)
+            code = "0000"
+        response = await self.client.patch(f"/users/activate/{user_id}?code={code}",
+                                           auth=(email, PASSWORD))
+        return response.status_code
+
+    async def run_one(self, recorder):
+        """ Run one random operation """
+        operation = random.choices(self.operations, self.weights)[0]
+        start = time.perf_counter()
+        try:
+            status = await getattr(self, operation)()
+        except httpx.HTTPError:
+            status = None
+        recorder.record(ENDPOINTS[operation], start, status)
+
+
+async def seed_users(client, workload, count):
+    """ Create users through the bulk endpoint and read their codes from the database """
+    lines = "\n".join(json.dumps({"email": workload.next_email(), "password": PASSWORD})
+                      for _ in range(count))
+    response = await client.post("/users/bulk", content=lines,
+                                 headers={"Content-Type": "application/x-ndjson"},
+                                 timeout=None)
+    response.raise_for_status()
+    created = [json.loads(line) for line in response.text.splitlines()]
+    created = [result for result in created if result['status'] == "created"]
+    conn = await connect_db()
+    try:
+        rows = await conn.fetch("SELECT id, email, code FROM public.users WHERE email = any($1)",
+                                [result['email'] for result in created])
+    finally:
+        await conn.close()
+    workload.users.extend((row['id'], row['email']) for row in rows)
+    workload.pending_activations.extend((row['id'], row['email'], row['code']) for row in rows)
+
+async def connect_db():
+    """ Connect to the database used by the app """
+    return await asyncpg.connect(database=os.environ.get('POSTGRES_DB'),
+                                 user=os.environ.get('POSTGRES_USER'),
+                                 password=os.environ.get('POSTGRES_PASSWORD'),
+                                 host=os.environ.get('POSTGRES_HOST'),
+                                 port=os.environ.get('POSTGRES_PORT', 5432))
+
+async def cleanup(run_id):
+    """ Delete the users of the run """
+    conn = await connect_db()
+    try:
+        await conn.execute("DELETE FROM public.users WHERE email LIKE $1",
+                           f"bench-{run_id}-%@bench.test")
+    finally:
+        await conn.close()
+
+async def probe_loop_lag(client, stop, interval, samples):
+    """ Time the cheapest route at a fixed interval, its latency above the
+    idle baseline is time the server event loop spent on other work """
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            await client.get("/")
+            samples.append((time.perf_counter() - start) * 1000)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+async def run(args):
+    """ Seed, warm up and run the workload """
+    run_id = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        workload = Workload(client, WORKLOADS[args.workload], run_id)
+        await seed_users(client, workload, args.seed_users)
+
+        idle = []
+        for _ in range(20):
+            start = time.perf_counter()
+            await client.get("/")
+            idle.append((time.perf_counter() - start) * 1000)
+        baseline = percentile(sorted(idle), 0.5)
+
+        recorder = Recorder()
+        stop = asyncio.Event()
+        lag_samples = []
+        deadline = time.perf_counter() + args.duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                await workload.run_one(recorder)
+
+        probe = asyncio.ensure_future(probe_loop_lag(client, stop, 0.05, lag_samples))
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe
+
+    if args.cleanup:
+        await cleanup(run_id)
+
+    endpoints = {}
+    for endpoint, latencies in recorder.latencies.items():
+        if not latencies:
+            continue
+        endpoints[endpoint] = summarize(latencies, elapsed)
+        endpoints[endpoint]['errors'] = recorder.errors[endpoint]
+        endpoints[endpoint]['rate_limited'] = recorder.rate_limited[endpoint]
+        endpoints[endpoint]['status'] = recorder.status[endpoint]
+    lag = sorted(max(0.0, sample - baseline) for sample in lag_samples)
+    return {
+        "workload": args.workload,
+        "workers": args.workers,
+        "concurrency": args.concurrency,
+        "duration_secs": elapsed,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "total": summarize([latency for latencies in recorder.latencies.values()
+                            for latency in latencies], elapsed),
+        "endpoints": endpoints,
+        "event_loop_lag_ms": {
+            "p50": percentile(lag, 0.50),
+            "p95": percentile(lag, 0.95),
+            "p99": percentile(lag, 0.99),
+            "max": lag[-1] if lag else None,
+        },
+    }
+
+def start_server(args):
+    """ Start uvicorn and wait until it answers """
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app",
+                                "--host", "127.0.0.1", "--port", str(args.port),
+                                "--workers", str(args.workers), "--log-level", "warning"],
+                                env={**os.environ, "RATE_LIMIT_ENABLED": "false"})
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{args.url}/").status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        if process.poll() is not None:
+            raise RuntimeError("uvicorn exited during startup")
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start in time")
+
+def main():
+    """ Parse arguments, run the benchmark and save the results """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--seed-users", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="Target a running server instead of starting uvicorn")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the users of the run")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    process = None
+    if args.url is None:
+        args.url = f"http://127.0.0.1:{args.port}"
+        process = start_server(args)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
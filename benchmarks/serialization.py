@@ -0,0 +1,49 @@
+""" Micro-benchmark of the user response serialization
+
+Compares the former path (jsonable_encoder on a dict row, response model
+validation, JSONResponse) with building UserResponse from the row and
+rendering it with orjson. Run with: python -m benchmarks.serialization
+"""
+from datetime import datetime
+import timeit
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel, TypeAdapter
+from app.models.users import UserResponse
+
+ROW = (100, "test@test.fr", datetime(2024, 1, 13, 10, 0, 0, 430322), False)
+
+
+class LegacyUserResponse(BaseModel):
+    """ User response model before the fast path """
+    id: int
+    email: str
+    created_at: str
+    is_activated: bool
+
+
+legacy_adapter = TypeAdapter(LegacyUserResponse)
+
+
+def legacy_path():
+    """ Row dict, jsonable_encoder, response model validation and serialization """
+    row = dict(zip(["id", "email", "created_at", "is_activated"], ROW))
+    content = jsonable_encoder(row)
+    value = legacy_adapter.validate_python(content)
+    return JSONResponse(legacy_adapter.dump_python(value, mode="json")).body
+
+def fast_path():
+    """ UserResponse built from the row and rendered by orjson """
+    return ORJSONResponse(UserResponse.from_row(ROW).model_dump()).body
+
+def main():
+    """ Check both paths render the same bytes and time them """
+    assert legacy_path() == fast_path(), (legacy_path(), fast_path())
+    number = 100000
+    for name, func in [("legacy", legacy_path), ("fast", fast_path)]:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        print(f"{name:>8}: {best / number * 1e6:.2f} us per response")
+
+
+if __name__ == "__main__":
+    main()